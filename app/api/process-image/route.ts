@@ -2,6 +2,22 @@ import { NextResponse } from 'next/server'
 import { spawn } from 'child_process'
 import path from 'path'
 import fs from 'fs'
+import os from 'os'
+
+// Reads the JSON-lines stage metrics written by image_processor.py --metrics
+function readMetrics(metricsPath: string): any[] {
+  try {
+    return fs.readFileSync(metricsPath, 'utf-8')
+      .split('\n')
+      .filter(line => line.trim())
+      .map(line => JSON.parse(line))
+  } catch (err) {
+    console.warn('API: Could not read processing metrics:', err)
+    return []
+  } finally {
+    fs.rmSync(metricsPath, { force: true })
+  }
+}
 
 export async function POST(request: Request) {
   try {
@@ -138,7 +154,8 @@ export async function POST(request: Request) {
         return resolve(NextResponse.json({ error: `Python script not found at ${scriptPath}` }, { status: 500 }));
       }
 
-      const scriptArgs = [scriptPath, inputFilePath, outputPrefix]; 
+      const metricsPath = path.join(os.tmpdir(), `${outputPrefix}_${Date.now()}_metrics.jsonl`)
+      const scriptArgs = [scriptPath, inputFilePath, outputPrefix, '--cache', '--metrics', metricsPath]; 
       console.log(`Running Python: ${pythonPath} ${scriptArgs.join(' ')}`);
 
       const pythonProcess = spawn(pythonPath, scriptArgs, {
@@ -163,6 +180,7 @@ export async function POST(request: Request) {
 
       pythonProcess.on('close', (code) => {
         console.log(`Python process exited with code ${code}`)
+        const metrics = readMetrics(metricsPath)
         if (code !== 0) {
             const errorMsg = scriptError || `Python script failed with code ${code}`;
             console.error("Python script execution failed:", errorMsg);
@@ -197,7 +215,8 @@ export async function POST(request: Request) {
             png: expectedPngFiles.map(f => `/output/images/${f}`),
             json: `/output/json/${expectedJsonFile}`
           },
-          outputLog: scriptOutput
+          outputLog: scriptOutput,
+          metrics
         }))
       });
 
@@ -0,0 +1,318 @@
+"""Индекс площадных запросов (<prefix>_area.bin): интегральные изображения и пирамиды min/max слоев.
+
+Статистика произвольного пиксельного или lon/lat прямоугольника считается
+без чтения исходного растра: суммы - за O(1), min/max - за O(log).
+"""
+import math
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from containers import (
+    DEFAULT_MEMORY_BUDGET_MB, container_array, container_layout, iter_shape_windows, open_container,
+    open_container_reference,
+)
+from georef import lonlat_rect_to_pixels, projected_from_lonlat_transform
+
+AREA_INDEX_MAGIC = b'LAREAIDX'
+# Версия 4: куб слоев - ссылка с sha256 его заголовка
+AREA_INDEX_VERSION = 4
+# Прямоугольники не больше этого числа пикселей считаются напрямую по уровню 0:
+# разность больших накопленных сумм квадратов теряет точность на малых площадях
+AREA_QUERY_DIRECT_PIXELS = 64 * 1024
+
+def _pyramid_shapes(shape):
+    """Формы уровней пирамиды min/max: уровень k - блоки 2^k x 2^k, до одной ячейки"""
+    shapes = [tuple(shape)]
+    while shapes[-1][0] > 1 or shapes[-1][1] > 1:
+        h, w = shapes[-1]
+        shapes.append(((h + 1) // 2, (w + 1) // 2))
+    return shapes
+
+def _fill_integral_images(data, sat_sum, sat_sumsq, sat_count, shift, memory_budget_mb):
+    """Интегральные изображения (H+1, W+1) полосами: накопленные суммы строк плюс перенос от прошлых полос"""
+    height, width = data.shape
+    carries = [np.zeros(width + 1, dtype=out.dtype) for out in (sat_sum, sat_sumsq, sat_count)]
+    for out in (sat_sum, sat_sumsq, sat_count):
+        out[0] = 0
+    for yoff, ysize in iter_shape_windows((height, width), memory_budget_mb):
+        block = np.asarray(data[yoff:yoff + ysize], dtype=np.float64)
+        valid = ~np.isnan(block)
+        # Сдвиг на типичное значение слоя уменьшает потерю точности в разностях больших сумм
+        block -= shift
+        block[~valid] = 0
+        for out, values, carry in ((sat_sum, block, carries[0]), (sat_sumsq, np.square(block), carries[1]),
+                                   (sat_count, valid, carries[2])):
+            rows = out[yoff + 1:yoff + ysize + 1]
+            rows[:, 0] = 0
+            np.cumsum(values, axis=1, dtype=out.dtype, out=rows[:, 1:])
+            np.cumsum(rows, axis=0, out=rows)
+            rows += carry
+            carry[:] = rows[-1]
+
+def _reduce_blocks_2x2(src, dst, ufunc, memory_budget_mb):
+    """Следующий уровень пирамиды: ufunc (fmin/fmax) по блокам 2x2, NaN игнорируются"""
+    height, width = src.shape
+    for yoff, ysize in iter_shape_windows(dst.shape, memory_budget_mb):
+        block = np.asarray(src[2 * yoff:min(height, 2 * (yoff + ysize))])
+        if block.shape[0] % 2 or width % 2:
+            # Нечетный край дополняем NaN - он не влияет на fmin/fmax
+            padded = np.full((2 * ysize, 2 * dst.shape[1]), np.nan, dtype=block.dtype)
+            padded[:block.shape[0], :width] = block
+            block = padded
+        rows = ufunc(block[0::2], block[1::2])
+        dst[yoff:yoff + ysize] = ufunc(rows[:, 0::2], rows[:, 1::2])
+
+def build_area_index(path, layers_data, geotransform=None, projection=None,
+                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, cube=None, window=None):
+    """Индекс площадных запросов для произвольных прямоугольников.
+
+    Для каждого слоя: интегральные изображения (H+1, W+1) суммы и суммы
+    квадратов (float64, относительно сдвига shift) и числа валидных пикселей,
+    сам слой (уровень 0) и уровни min/max по блокам 2^k x 2^k (float32).
+    С cube (container_reference уже записанного куба слоев рядом с индексом)
+    уровень 0 не дублируется: значения читаются из куба, а его заголовок
+    сверяется со ссылкой при открытии. window - окно в пикселях исходного растра.
+    Массивы заполняются полосами прямо в файле через memory-map; при
+    нехватке места на диске индекс не строится.
+    """
+    present = {name: data for name, data in layers_data.items() if data is not None}
+    if not present:
+        print("Нет слоев для индекса площадных запросов.")
+        return False
+    height, width = next(iter(present.values())).shape
+    count_dtype = '<i4' if height * width < 2 ** 31 else '<i8'
+    level_shapes = _pyramid_shapes((height, width))
+
+    specs = []
+    def add(dtype, shape):
+        specs.append((dtype, shape))
+        return len(specs) - 1
+
+    layers_header = {}
+    for layer_name, data in layers_data.items():
+        if data is None:
+            layers_header[layer_name] = None
+            continue
+        # Сдвиг - медиана разреженной выборки слоя
+        step = max(1, int(math.sqrt(height * width / 1e6)))
+        sample = np.asarray(data[::step, ::step])
+        shift = float(np.nanmedian(sample)) if np.any(~np.isnan(sample)) else 0.0
+        layers_header[layer_name] = {
+            "shift": shift,
+            "sum": add('<f8', (height + 1, width + 1)),
+            "sumsq": add('<f8', (height + 1, width + 1)),
+            "count": add(count_dtype, (height + 1, width + 1)),
+            "values": None if cube else add('<f4', level_shapes[0]),
+            # Уровни 1, 2, ...; уровень 0 - значения слоя
+            "levels": [{"min": add('<f4', shape), "max": add('<f4', shape)} for shape in level_shapes[1:]],
+        }
+
+    header = {
+        "version": AREA_INDEX_VERSION,
+        "width": width,
+        "height": height,
+        "window": list(window) if window else [0, 0, width, height],
+        "geotransform": list(geotransform) if geotransform else None,
+        "projection": projection or None,
+        "cube": cube,
+        "layers": layers_header,
+        "arrays": [],
+    }
+    encoded = container_layout(AREA_INDEX_MAGIC, header, specs)
+    last = header["arrays"][-1]
+    size = last["offset"] + np.dtype(last["dtype"]).itemsize * int(np.prod(last["shape"]))
+    print(f"Индекс площадных запросов: {len(present)} слоев ({', '.join(present)}), "
+          f"{size / 1024 / 1024:.1f} МБ, {size / (height * width):.1f} байт/пиксель")
+    free = shutil.disk_usage(Path(path).parent).free
+    if size > free:
+        print(f"Ошибка: для индекса площадных запросов нужно {size / 1024 / 1024:.1f} МБ, "
+              f"свободно {free / 1024 / 1024:.1f} МБ (уменьшите --area-layers)")
+        return False
+
+    with open(path, 'wb') as f:
+        f.write(AREA_INDEX_MAGIC)
+        f.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+        f.write(encoded)
+        f.truncate(size)
+    mmap = np.memmap(path, dtype=np.uint8, mode='r+')
+    try:
+        array = lambda index: container_array(mmap, header["arrays"][index])
+        for layer_name, data in present.items():
+            entry = layers_header[layer_name]
+            _fill_integral_images(data, array(entry["sum"]), array(entry["sumsq"]), array(entry["count"]),
+                                  entry["shift"], memory_budget_mb)
+            if entry["values"] is not None:
+                values = array(entry["values"])
+                for yoff, ysize in iter_shape_windows((height, width), memory_budget_mb):
+                    values[yoff:yoff + ysize] = data[yoff:yoff + ysize]
+            # Первый уровень строится прямо из данных слоя
+            previous_min = previous_max = data
+            for level in entry["levels"]:
+                _reduce_blocks_2x2(previous_min, array(level["min"]), np.fmin, memory_budget_mb)
+                _reduce_blocks_2x2(previous_max, array(level["max"]), np.fmax, memory_budget_mb)
+                previous_min, previous_max = array(level["min"]), array(level["max"])
+        mmap.flush()
+    finally:
+        del mmap
+    return True
+
+def _pyramid_extreme(levels, ufunc, x0, y0, x1, y1):
+    """min/max прямоугольника по пирамиде: на каждом уровне - рамка толщиной в одну ячейку.
+
+    Уровень k покрывает ячейки, целиком лежащие в прямоугольнике; внутренняя
+    часть берется с уровня k+1. Число операций - O(число уровней), объем
+    просматриваемых данных - O(периметр).
+    """
+    height, width = levels[0].shape
+    result = np.nan
+
+    def covered(k):
+        # Ячейки уровня k, целиком внутри [x0, x1) x [y0, y1); последняя ячейка может быть неполной
+        size = 1 << k
+        rows, cols = levels[k].shape
+        row_stop = rows if y1 >= height else y1 // size
+        col_stop = cols if x1 >= width else x1 // size
+        return -(-y0 // size), row_stop, -(-x0 // size), col_stop
+
+    for k in range(len(levels)):
+        r0, r1, c0, c1 = covered(k)
+        if r0 >= r1 or c0 >= c1:
+            break
+        inner = covered(k + 1) if k + 1 < len(levels) else (0, 0, 0, 0)
+        ir0, ir1, ic0, ic1 = inner[0] * 2, min(inner[1] * 2, r1), inner[2] * 2, min(inner[3] * 2, c1)
+        level = levels[k]
+        if inner[0] >= inner[1] or inner[2] >= inner[3]:
+            parts = [level[r0:r1, c0:c1]]
+        else:
+            parts = [level[r0:ir0, c0:c1], level[ir1:r1, c0:c1], level[ir0:ir1, c0:ic0], level[ir0:ir1, ic1:c1]]
+        for part in parts:
+            if part.size:
+                result = ufunc(result, ufunc.reduce(part, axis=None))
+        if inner[0] >= inner[1] or inner[2] >= inner[3]:
+            break
+    return float(result)
+
+class AreaIndexReader:
+    """Запросы mean/std/min/max/доли валидных пикселей для произвольных прямоугольников.
+
+    Суммы берутся из интегральных изображений за O(1), min/max - по пирамиде
+    за O(log) операций; прямоугольники до AREA_QUERY_DIRECT_PIXELS пикселей
+    считаются точно по значениям слоя. Файл открывается через memory-map;
+    если значения слоев хранятся в кубе (header cube), он открывается рядом
+    и должен совпадать с кубом, по которому строился индекс.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header, self._mmap = open_container(self.path, AREA_INDEX_MAGIC, "area index")
+        if self.header.get("version") != AREA_INDEX_VERSION:
+            raise ValueError(f"{self.path}: unsupported area index version {self.header.get('version')}")
+        self.width = self.header["width"]
+        self.height = self.header["height"]
+        self.window = self.header["window"]
+        self.geotransform = self.header["geotransform"]
+        self.projection = self.header["projection"]
+        self._transform = None
+        self._cube = None
+
+    @property
+    def layers(self):
+        return list(self.header["layers"])
+
+    def _array(self, index):
+        return container_array(self._mmap, self.header["arrays"][index])
+
+    def _values(self, layer_name):
+        """Значения слоя (уровень 0): из индекса или из куба слоев"""
+        entry = self.header["layers"][layer_name]
+        if entry["values"] is not None:
+            return self._array(entry["values"])
+        if self._cube is None:
+            header, mmap = open_container_reference(self.path.parent, self.header["cube"], "layer cube")
+            values = container_array(mmap, header["arrays"][0])
+            if values.shape[:2] != (self.height, self.width) or layer_name not in header["layers"]:
+                raise ValueError(f"{self.path.parent / self.header['cube']['file']} does not match {self.path}")
+            self._cube = (header["layers"], values)
+        layers, values = self._cube
+        return values[:, :, layers.index(layer_name)]
+
+    def rect_sums(self, layer_name, x0, y0, x1, y1):
+        """Число валидных пикселей, сумма и сумма квадратов для массивов прямоугольников (векторно).
+
+        Прямоугольники [x0, x1) x [y0, y1) должны лежать в пределах растра;
+        сумма и сумма квадратов - относительно сдвига слоя (header shift).
+        """
+        entry = self.header["layers"][layer_name]
+        x0, y0, x1, y1 = (np.asarray(v, dtype=np.int64) for v in (x0, y0, x1, y1))
+        result = []
+        for key in ("count", "sum", "sumsq"):
+            table = self._array(entry[key])
+            result.append(table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0])
+        return tuple(result)
+
+    def rect_stats(self, layer_name, x0, y0, x1, y1):
+        """count/valid_fraction/mean/std для массивов прямоугольников (без min/max)"""
+        entry = self.header["layers"].get(layer_name)
+        if entry is None:
+            return None
+        count, total, total_sq = self.rect_sums(layer_name, x0, y0, x1, y1)
+        area = (np.asarray(x1) - np.asarray(x0)) * (np.asarray(y1) - np.asarray(y0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(total_sq / count - np.square(mean), 0))
+            valid_fraction = count / area
+        return {"count": count, "valid_fraction": valid_fraction, "mean": mean + entry["shift"], "std": std}
+
+    def query_pixel_rect(self, x_min, y_min, x_max, y_max, layers=None):
+        """Статистика слоев в пиксельном прямоугольнике [x_min, x_max) x [y_min, y_max) (обрезается по растру)"""
+        x0 = max(0, int(np.floor(x_min)))
+        y0 = max(0, int(np.floor(y_min)))
+        x1 = min(self.width, int(np.ceil(x_max)))
+        y1 = min(self.height, int(np.ceil(y_max)))
+        result = {"x_min": x0, "y_min": y0, "x_max": x1, "y_max": y1, "layers": {}}
+        for layer_name in layers or self.layers:
+            entry = self.header["layers"].get(layer_name)
+            if entry is None or x0 >= x1 or y0 >= y1:
+                result["layers"][layer_name] = None
+                continue
+            if (x1 - x0) * (y1 - y0) <= AREA_QUERY_DIRECT_PIXELS:
+                result["layers"][layer_name] = self._direct_stats(layer_name, x0, y0, x1, y1)
+                continue
+            stats = {key: float(value) for key, value in self.rect_stats(layer_name, x0, y0, x1, y1).items()}
+            stats["count"] = int(stats["count"])
+            if stats["count"]:
+                values = self._values(layer_name)
+                levels_min = [values] + [self._array(level["min"]) for level in entry["levels"]]
+                levels_max = [values] + [self._array(level["max"]) for level in entry["levels"]]
+                stats["min"] = _pyramid_extreme(levels_min, np.fmin, x0, y0, x1, y1)
+                stats["max"] = _pyramid_extreme(levels_max, np.fmax, x0, y0, x1, y1)
+            else:
+                stats.update(mean=None, std=None, min=None, max=None)
+            result["layers"][layer_name] = stats
+        return result
+
+    def _direct_stats(self, layer_name, x0, y0, x1, y1):
+        """Точная статистика небольшого прямоугольника по значениям слоя (уровень 0)"""
+        values = np.asarray(self._values(layer_name)[y0:y1, x0:x1], dtype=np.float64)
+        valid = values[~np.isnan(values)]
+        stats = {"count": int(valid.size), "valid_fraction": valid.size / values.size}
+        if valid.size:
+            stats.update(mean=float(valid.mean()), std=float(valid.std()),
+                         min=float(valid.min()), max=float(valid.max()))
+        else:
+            stats.update(mean=None, std=None, min=None, max=None)
+        return stats
+
+    def query_lonlat_rect(self, lon_min, lat_min, lon_max, lat_max, layers=None):
+        """Статистика слоев в охватывающем пиксельном прямоугольнике для прямоугольника lon/lat"""
+        if self._transform is None:
+            self._transform = projected_from_lonlat_transform(self.projection)
+        if self._transform is None or not self.geotransform:
+            raise ValueError(f"{self.path} has no georeferencing")
+        rect = lonlat_rect_to_pixels(lon_min, lat_min, lon_max, lat_max, self.geotransform, self._transform,
+                                     self.width, self.height)
+        if rect is None:
+            return {"x_min": None, "y_min": None, "x_max": None, "y_max": None,
+                    "layers": {name: None for name in layers or self.layers}}
+        return self.query_pixel_rect(*rect, layers=layers)
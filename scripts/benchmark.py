@@ -0,0 +1,461 @@
+"""Бенчмарк image_processor.py на синтетических лунных растрах.
+
+Генерирует 6-канальные GeoTIFF с раскладкой каналов, которую ожидает
+image_processor (2 - освещенность, 4 - тени, 5 - уклон, 6 - высоты в км),
+в полярной стереографической проекции Луны и замеряет этапы обработки
+по отдельности. Результаты пишутся в JSON для сравнения версий (--compare).
+"""
+from osgeo import gdal, osr
+import numpy as np
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+
+import image_processor as ip
+import tile_stats
+from containers import DEFAULT_MEMORY_BUDGET_MB
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+
+# Полярная стереографическая проекция южного полюса Луны (сфера R = 1737.4 км)
+MOON_SOUTH_POLAR_STEREO = "+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +R=1737400 +units=m +no_defs"
+
+DEFAULT_SIZES = (1024, 2048, 4096)
+DEFAULT_PIXEL_SIZE = 20.0  # м
+DEFAULT_NODATA_FRACTION = 0.02
+# Значение nodata для высот, уклона и освещенности (маскируется image_processor);
+# в канале теней nodata записывается как NaN, так как скрипт его не маскирует
+NODATA_VALUE = -9999.0
+# Строк за одну запись при генерации
+GENERATE_BLOCK_ROWS = 512
+# Кратеры синтетического рельефа
+NUM_CRATERS = 16
+# Высота Солнца над горизонтом для освещенности, градусы
+SUN_ELEVATION_DEG = 1.5
+SUN_AZIMUTH_DEG = 135.0
+
+STAGES = ('read', 'ice', 'tiles', 'png', 'json')
+# Байт на пиксель 6-канального float32 растра драйвера MEM
+MEM_RASTER_BYTES_PER_PIXEL = 6 * 4
+# Замедление этапа относительно базового результата, считающееся регрессией
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+# --- Генерация синтетических растров ---
+
+def _crater_field(seed, extent):
+    """Параметры кратеров: центры (м), радиусы (м), глубины (км)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-extent / 2, extent / 2, size=(NUM_CRATERS, 2))
+    radii = rng.uniform(0.02, 0.12, size=NUM_CRATERS) * extent
+    depths = rng.uniform(0.5, 3.0, size=NUM_CRATERS)
+    return centers, radii, depths
+
+def synthetic_elevation(x, y, extent, craters):
+    """Высоты в км: крупные волны рельефа и гауссовы чаши кратеров"""
+    dem = (1.5 * np.sin(2 * np.pi * x / extent) * np.cos(2 * np.pi * y / (0.7 * extent))
+           + 0.6 * np.sin(2 * np.pi * (x + y) / (0.23 * extent)))
+    centers, radii, depths = craters
+    for (cx, cy), radius, depth in zip(centers, radii, depths):
+        dem -= depth * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius ** 2))
+    return dem
+
+def synthetic_block(y0, y1, width, height, pixel_size, craters, nodata_fraction, seed):
+    """Каналы для строк [y0, y1): высоты, уклон, тени, освещенность (float32)"""
+    extent = max(width, height) * pixel_size
+    # Строка сверху и снизу для градиента на границах блока
+    rows = np.arange(y0 - 1, y1 + 1, dtype=np.float64)
+    x = (np.arange(width, dtype=np.float64) - width / 2 + 0.5) * pixel_size
+    y = (height / 2 - rows - 0.5) * pixel_size
+    xx, yy = np.meshgrid(x, y)
+    dem_km = synthetic_elevation(xx, yy, extent, craters)
+    del xx, yy
+
+    dz_dy, dz_dx = np.gradient(dem_km * 1000, pixel_size)
+    dem_km = dem_km[1:-1]
+    dz_dx = dz_dx[1:-1]
+    dz_dy = -dz_dy[1:-1]  # Строки растут на юг
+    slope = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+    # Освещенность по Ламберту для низкого Солнца, тени - почти неосвещенные участки
+    sun_el = np.radians(SUN_ELEVATION_DEG)
+    sun_az = np.radians(SUN_AZIMUTH_DEG)
+    sun = (np.cos(sun_el) * np.sin(sun_az), np.cos(sun_el) * np.cos(sun_az), np.sin(sun_el))
+    norm = np.sqrt(dz_dx ** 2 + dz_dy ** 2 + 1)
+    illumination = np.clip((-dz_dx * sun[0] - dz_dy * sun[1] + sun[2]) / norm, 0, 1)
+    shadows = (illumination < 0.02).astype(np.float32)
+
+    bands = {
+        'elevation': dem_km.astype(np.float32),
+        'slope': slope.astype(np.float32),
+        'shadows': shadows,
+        'illumination': illumination.astype(np.float32),
+    }
+    if nodata_fraction > 0:
+        rng = np.random.default_rng([seed, y0])
+        mask = rng.random((y1 - y0, width)) < nodata_fraction
+        for name, data in bands.items():
+            data[mask] = np.nan if name == 'shadows' else NODATA_VALUE
+    return bands
+
+def generate_raster(path, size, driver='GTiff', pixel_size=DEFAULT_PIXEL_SIZE,
+                    nodata_fraction=DEFAULT_NODATA_FRACTION, seed=0):
+    """Создание синтетического растра size x size (MEM или GTiff); возвращает датасет"""
+    width = height = size
+    gdal_driver = gdal.GetDriverByName(driver)
+    if gdal_driver is None:
+        raise RuntimeError(f"GDAL driver not available: {driver}")
+    options = []
+    if driver == 'GTiff':
+        options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'BIGTIFF=IF_SAFER']
+    ds = gdal_driver.Create(str(path) if driver != 'MEM' else '', width, height, 6, gdal.GDT_Float32, options)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(MOON_SOUTH_POLAR_STEREO)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((-width / 2 * pixel_size, pixel_size, 0.0, height / 2 * pixel_size, 0.0, -pixel_size))
+
+    for band_index in range(1, 7):
+        band = ds.GetRasterBand(band_index)
+        band.SetNoDataValue(float('nan') if band_index == ip.LAYER_BANDS['shadows'] else NODATA_VALUE)
+    # Каналы 1 и 3 скриптом не используются
+    for band_index in (1, 3):
+        ds.GetRasterBand(band_index).Fill(0)
+
+    craters = _crater_field(seed, size * pixel_size)
+    for y0 in range(0, height, GENERATE_BLOCK_ROWS):
+        y1 = min(y0 + GENERATE_BLOCK_ROWS, height)
+        block = synthetic_block(y0, y1, width, height, pixel_size, craters, nodata_fraction, seed)
+        for name, data in block.items():
+            ds.GetRasterBand(ip.LAYER_BANDS[name]).WriteArray(data, 0, y0)
+    ds.FlushCache()
+    return ds
+
+# --- Замеры ---
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Подавление print() image_processor на время замера"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def timed(func, repeat=1, verbose=False):
+    """Запуск func repeat раз; возвращает (результат последнего запуска, времена в секундах)"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        result = None  # Освобождаем результат предыдущего запуска до замера
+        start = time.perf_counter()
+        with quiet(not verbose):
+            result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+def _summary(times, megapixels):
+    best = min(times)
+    return {
+        "min": round(best, 4),
+        "median": round(float(np.median(times)), 4),
+        "runs": [round(t, 4) for t in times],
+        "megapixels_per_sec": round(megapixels / best, 3) if best > 0 else None,
+    }
+
+def redirect_outputs(out_dir):
+    """Перенаправление выходных каталогов image_processor во временный каталог бенчмарка"""
+    for attr, name in (('IMAGES_DIR', 'images'), ('LAYERS_DIR', 'layers'), ('JSON_DIR', 'json'), ('TILES_DIR', 'tiles')):
+        path = out_dir / name
+        path.mkdir(parents=True, exist_ok=True)
+        setattr(ip, attr, path)
+
+def fits_in_memory(size, memory_budget_mb):
+    """Помещаются ли полные слои растра size x size в бюджет памяти"""
+    return size * size * ip.IN_MEMORY_BYTES_PER_PIXEL <= memory_budget_mb * 1024 * 1024
+
+def check_sizes(sizes, driver, memory_budget_mb):
+    """Проверка размеров до генерации: растр MEM целиком находится в памяти"""
+    for size in sizes:
+        if size < 1:
+            raise ValueError(f"Размер растра должен быть положительным: {size}")
+        needed_mb = size * size * MEM_RASTER_BYTES_PER_PIXEL / 1024 / 1024
+        if driver == 'MEM' and needed_mb > memory_budget_mb:
+            raise ValueError(f"Растр MEM {size}x{size} займет {needed_mb:.0f} МБ при бюджете "
+                             f"{memory_budget_mb} МБ; используйте --driver GTiff")
+
+def benchmark_stages(ds, out_dir, stages=STAGES, repeat=1, num_tiles=ip.DEFAULT_NUM_TILES, verbose=False,
+                     memory_budget_mb=None):
+    """Замер этапов обработки по отдельности на открытом датасете.
+
+    Если полные слои не помещаются в memory_budget_mb (по умолчанию 75%
+    физической памяти), этапы замеряются в потоковом режиме.
+    """
+    memory_budget_mb = memory_budget_mb or ip.default_batch_memory_mb()
+    if not fits_in_memory(max(ds.RasterXSize, ds.RasterYSize), memory_budget_mb):
+        print(f"Слои не помещаются в {memory_budget_mb} МБ, этапы замеряются в потоковом режиме")
+        return benchmark_stages_streaming(ds, out_dir, stages, repeat, num_tiles, verbose, memory_budget_mb)
+    megapixels = ds.RasterXSize * ds.RasterYSize / 1e6
+    results = {}
+    readers = {
+        'elevation': ip.process_elevation_layer,
+        'slope': ip.process_slope_layer,
+        'shadows': ip.process_shadow_layer,
+        'illumination': ip.process_illumination_layer,
+    }
+    layers_data = {}
+    # Чтение каналов нужно всем остальным этапам, поэтому выполняется всегда
+    for name, reader in readers.items():
+        layers_data[name], times = timed(lambda: reader(ds), repeat if 'read' in stages else 1, verbose)
+        if 'read' in stages:
+            results[f"read_{name}"] = _summary(times, megapixels)
+
+    layers_data['ice'], times = timed(
+        lambda: ip.process_ice_layer(layers_data['elevation'], layers_data['slope'], layers_data['shadows']),
+        repeat if 'ice' in stages else 1, verbose)
+    if 'ice' in stages:
+        results["ice"] = _summary(times, megapixels)
+
+    with quiet(not verbose):
+        tile_processor = ip.TileProcessor(ds, num_tiles=num_tiles)
+    tiles = None
+    if 'tiles' in stages or 'json' in stages:
+        tiles, times = timed(lambda: tile_processor.process_tiles(layers_data), repeat if 'tiles' in stages else 1, verbose)
+        if 'tiles' in stages:
+            results["tiles"] = _summary(times, megapixels)
+
+    if 'png' in stages:
+        for name, data in layers_data.items():
+            cmap = ip.LAYER_RENDER_SETTINGS[name]['cmap']
+            _, times = timed(lambda: ip.save_layer_png(data, name, 'bench', cmap), repeat, verbose)
+            results[f"png_{name}"] = _summary(times, megapixels)
+
+    if 'json' in stages:
+        json_path = out_dir / 'json' / 'bench_tiles.json'
+        _, times = timed(lambda: tile_stats.write_tiles_json(json_path, tiles), repeat, verbose)
+        results["json"] = _summary(times, megapixels)
+    return results
+
+def benchmark_stages_streaming(ds, out_dir, stages=STAGES, repeat=1, num_tiles=ip.DEFAULT_NUM_TILES, verbose=False,
+                               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Замер этапов в потоковом режиме для растров больше памяти.
+
+    Чтение, лед и статистика тайлов выполняются одним проходом полосами
+    (этап streaming), слои хранятся в memmap, PNG пишутся в исходном разрешении
+    полосами в пределах бюджета (render_chunk_for_budget), тайлы считаются
+    полосами из memmap.
+    """
+    megapixels = ds.RasterXSize * ds.RasterYSize / 1e6
+    results = {}
+    with quiet(not verbose):
+        tile_processor = ip.TileProcessor(ds, num_tiles=num_tiles)
+    layers_dir = out_dir / 'streaming_layers'
+
+    def run_streaming():
+        shutil.rmtree(layers_dir, ignore_errors=True)
+        layers_dir.mkdir(parents=True)
+        return ip.process_layers_streaming(ds, tile_processor, layers_dir, memory_budget_mb)
+
+    measured = 'read' in stages or 'ice' in stages
+    layers_data = None
+    try:
+        (layers_data, layers_stats), times = timed(run_streaming, repeat if measured else 1, verbose)
+        if measured:
+            results["streaming"] = _summary(times, megapixels)
+
+        if 'tiles' in stages:
+            _, times = timed(lambda: ip.accumulate_tile_stats(layers_data, tile_processor, memory_budget_mb),
+                             repeat, verbose)
+            results["tiles"] = _summary(times, megapixels)
+
+        if 'png' in stages:
+            chunk_pixels = ip.render_chunk_for_budget(memory_budget_mb)
+            for name, data in layers_data.items():
+                cmap = ip.LAYER_RENDER_SETTINGS[name]['cmap']
+                _, times = timed(lambda: ip.save_layer_png(data, name, 'bench', cmap, chunk_pixels=chunk_pixels),
+                                 repeat, verbose)
+                results[f"png_{name}"] = _summary(times, megapixels)
+
+        if 'json' in stages:
+            json_path = out_dir / 'json' / 'bench_tiles.json'
+            _, times = timed(lambda: tile_stats.write_tiles_json(json_path, tile_processor.iter_tiles(layers_stats)),
+                             repeat, verbose)
+            results["json"] = _summary(times, megapixels)
+    finally:
+        layers_data = None
+        shutil.rmtree(layers_dir, ignore_errors=True)
+    return results
+
+def benchmark_end_to_end(path, repeat=1, verbose=False, **options):
+    """Замер полного process_image без кэша"""
+    ds = gdal.Open(str(path))
+    megapixels = ds.RasterXSize * ds.RasterYSize / 1e6
+    ds = None
+    success, times = timed(lambda: ip.process_image(Path(path), 'bench_e2e', use_cache=False, **options),
+                           repeat, verbose)
+    summary = _summary(times, megapixels)
+    summary["success"] = bool(success)
+    return summary
+
+def environment_info():
+    """Версии и окружение, чтобы результаты разных машин и версий можно было различить"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "gdal": gdal.VersionInfo('RELEASE_NAME'),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def compare_results(current, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """Сравнение с базовым результатом: список (размер, этап, базовое, текущее, отношение, регрессия?)"""
+    rows = []
+    for size, entry in current["sizes"].items():
+        base_entry = baseline.get("sizes", {}).get(size)
+        if base_entry is None:
+            continue
+        for stage, summary in entry["stages"].items():
+            base = base_entry["stages"].get(stage)
+            if base is None or not base["min"]:
+                continue
+            ratio = summary["min"] / base["min"]
+            rows.append((size, stage, base["min"], summary["min"], ratio, ratio > 1 + threshold))
+    return rows
+
+def run_benchmark(sizes=DEFAULT_SIZES, driver='GTiff', stages=STAGES, repeat=1, nodata_fraction=DEFAULT_NODATA_FRACTION,
+                  pixel_size=DEFAULT_PIXEL_SIZE, seed=0, num_tiles=ip.DEFAULT_NUM_TILES, end_to_end=False,
+                  streaming=False, work_dir=None, keep=False, verbose=False, memory_budget_mb=None):
+    """Генерация растров заданных размеров и замер этапов; возвращает словарь результатов.
+
+    Растры, слои которых не помещаются в memory_budget_mb (по умолчанию 75%
+    физической памяти), обрабатываются в потоковом режиме, в том числе
+    полный прогон; растр MEM больше бюджета отклоняется до генерации.
+    """
+    memory_budget_mb = memory_budget_mb or ip.default_batch_memory_mb()
+    check_sizes(sizes, driver, memory_budget_mb)
+    own_dir = work_dir is None
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix='lunar_bench_'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    redirect_outputs(work_dir / 'output')
+    gdal.UseExceptions()
+
+    results = {
+        "environment": environment_info(),
+        "parameters": {
+            "driver": driver, "stages": list(stages), "repeat": repeat, "nodata_fraction": nodata_fraction,
+            "pixel_size": pixel_size, "seed": seed, "num_tiles": num_tiles,
+            "end_to_end": end_to_end, "streaming": streaming, "memory_budget_mb": memory_budget_mb,
+        },
+        "sizes": {},
+    }
+    try:
+        for size in sizes:
+            print(f"\n=== {size}x{size} ===")
+            path = work_dir / f"synthetic_{size}.tif"
+            start = time.perf_counter()
+            ds = generate_raster(path, size, driver, pixel_size, nodata_fraction, seed)
+            generate_time = time.perf_counter() - start
+            print(f"Растр сгенерирован за {generate_time:.2f} c ({driver})")
+            if driver == 'GTiff':
+                # Замеряем чтение из файла, а не из буферов, оставшихся после записи
+                ds = None
+                ds = gdal.Open(str(path))
+
+            entry = {"megapixels": round(size * size / 1e6, 3), "generate": round(generate_time, 4)}
+            entry["stages"] = benchmark_stages(ds, work_dir / 'output', stages, repeat, num_tiles, verbose,
+                                               memory_budget_mb)
+            ds = None
+            if end_to_end:
+                size_streaming = streaming or not fits_in_memory(size, memory_budget_mb)
+                options = dict(streaming=size_streaming, num_tiles=num_tiles)
+                if size_streaming:
+                    options["memory_budget_mb"] = memory_budget_mb
+                entry["stages"]["end_to_end"] = benchmark_end_to_end(path, repeat, verbose, **options)
+            for stage, summary in entry["stages"].items():
+                print(f"  {stage:<20} {summary['min']:>9.3f} c  {summary['megapixels_per_sec'] or 0:>9.1f} Мпикс/с")
+            results["sizes"][str(size)] = entry
+            if not keep and path.exists():
+                path.unlink()
+    finally:
+        if own_dir and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif keep:
+            print(f"Растры и результаты сохранены в {work_dir}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк image_processor.py на синтетических растрах.')
+    parser.add_argument('--sizes', type=str, default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Размеры растров (стороны квадрата) через запятую, например 1024,4096,32768.')
+    parser.add_argument('--driver', choices=('GTiff', 'MEM'), default='GTiff',
+                        help='Драйвер GDAL для синтетического растра (MEM - без дискового ввода-вывода).')
+    parser.add_argument('--stages', type=str, default=','.join(STAGES),
+                        help=f'Замеряемые этапы через запятую ({", ".join(STAGES)}) или none.')
+    parser.add_argument('--repeat', type=int, default=3, help='Повторов каждого этапа (берется минимум).')
+    parser.add_argument('--nodata-fraction', type=float, default=DEFAULT_NODATA_FRACTION,
+                        help=f'Доля пикселей nodata (по умолчанию {DEFAULT_NODATA_FRACTION}).')
+    parser.add_argument('--pixel-size', type=float, default=DEFAULT_PIXEL_SIZE, help='Размер пикселя в метрах.')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно генератора рельефа.')
+    parser.add_argument('--tiles', type=int, default=ip.DEFAULT_NUM_TILES, help='Число тайлов по каждой оси.')
+    parser.add_argument('--end-to-end', action='store_true', help='Дополнительно замерить полный process_image (только GTiff).')
+    parser.add_argument('--streaming', action='store_true', help='Полный прогон в потоковом режиме.')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='Бюджет памяти в МБ: большие растры замеряются в потоковом режиме '
+                             '(по умолчанию 75%% физической памяти).')
+    parser.add_argument('--work-dir', type=str, default=None, help='Каталог для растров и выходных файлов.')
+    parser.add_argument('--keep', action='store_true', help='Не удалять сгенерированные растры.')
+    parser.add_argument('--output', type=str, default=None, help='Файл для результатов в JSON.')
+    parser.add_argument('--compare', type=str, default=None, help='JSON предыдущего прогона для сравнения.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='Допустимое замедление при сравнении (0.1 = 10%%).')
+    parser.add_argument('--verbose', action='store_true', help='Не подавлять вывод image_processor.')
+    args = parser.parse_args()
+
+    stages = () if args.stages == 'none' else tuple(s.strip() for s in args.stages.split(',') if s.strip())
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        parser.error(f"неизвестные этапы: {', '.join(unknown)}")
+    if args.end_to_end and args.driver == 'MEM':
+        parser.error('--end-to-end требует --driver GTiff')
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    try:
+        check_sizes(sizes, args.driver, args.memory_budget or ip.default_batch_memory_mb())
+    except ValueError as e:
+        parser.error(str(e))
+
+    results = run_benchmark(sizes=sizes, driver=args.driver,
+                            stages=stages, repeat=args.repeat, nodata_fraction=args.nodata_fraction,
+                            pixel_size=args.pixel_size, seed=args.seed, num_tiles=args.tiles,
+                            end_to_end=args.end_to_end, streaming=args.streaming, work_dir=args.work_dir,
+                            keep=args.keep, verbose=args.verbose, memory_budget_mb=args.memory_budget)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nСравнение с {args.compare} (коммит {baseline.get('environment', {}).get('commit')}):")
+        for size, stage, base, current, ratio, regression in compare_results(results, baseline, args.threshold):
+            regressions += regression
+            mark = '  РЕГРЕССИЯ' if regression else ''
+            print(f"  {size:>6} {stage:<20} {base:>9.3f} -> {current:>9.3f} c  x{ratio:.2f}{mark}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,179 @@
+"""Бинарные контейнеры: magic, заголовок JSON и выровненные массивы, заполняемые полосами через memory-map."""
+import hashlib
+import json
+import math
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from georef import lonlat_to_pixels, projected_from_lonlat_transform
+
+# Бюджет памяти на полосу по умолчанию (МБ)
+DEFAULT_MEMORY_BUDGET_MB = 512
+# Оценка байт на пиксель полосы: 4 канала float32, лед, маски и временные массивы
+STREAMING_BYTES_PER_PIXEL = 48
+# Выравнивание массивов в контейнере (байт)
+CONTAINER_ALIGNMENT = 64
+
+# Куб слоев (<prefix>_cube.bin): все слои попиксельно (H, W, слои), float32
+LAYER_CUBE_MAGIC = b'LAYRCUBE'
+LAYER_CUBE_VERSION = 2
+
+def iter_shape_windows(shape, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, block_height=1):
+    """Полосы (yoff, ysize) массива формы shape, укладывающиеся в бюджет памяти"""
+    height, width = shape
+    block_height = max(1, block_height)
+    rows = (memory_budget_mb * 1024 * 1024) // max(1, width * STREAMING_BYTES_PER_PIXEL)
+    rows = max(block_height, rows // block_height * block_height)
+    for yoff in range(0, height, rows):
+        yield yoff, min(rows, height - yoff)
+
+def _align(offset):
+    """Смещение, выровненное вверх по CONTAINER_ALIGNMENT"""
+    return -(-offset // CONTAINER_ALIGNMENT) * CONTAINER_ALIGNMENT
+
+def container_layout(magic, header, specs):
+    """Смещения массивов бинарного контейнера и закодированный заголовок.
+
+    Контейнер: magic, длина заголовка (uint32 LE), заголовок JSON, затем
+    массивы, выровненные по CONTAINER_ALIGNMENT. specs - список (dtype, shape);
+    смещения записываются в header["arrays"].
+    """
+    def layout(header_size):
+        offset = _align(len(magic) + 4 + header_size)
+        entries = []
+        for dtype, shape in specs:
+            dtype = np.dtype(dtype)
+            entries.append({"offset": offset, "dtype": dtype.str, "shape": list(shape)})
+            offset = _align(offset + dtype.itemsize * int(np.prod(shape)))
+        return entries
+
+    # Смещения зависят от длины заголовка, поэтому считаем их с запасом на сам список смещений
+    header_bytes = json.dumps(header).encode('utf-8')
+    while True:
+        header["arrays"] = layout(len(header_bytes))
+        encoded = json.dumps(header).encode('utf-8')
+        if len(encoded) <= len(header_bytes):
+            break
+        header_bytes = encoded
+    # Дополняем заголовок пробелами до зарезервированной длины
+    return encoded.ljust(len(header_bytes))
+
+def open_container(path, magic, description):
+    """Заголовок и memory-map бинарного контейнера"""
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a {description} file")
+        header_size = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, np.memmap(path, dtype=np.uint8, mode='r')
+
+def container_array(mmap, entry):
+    """Массив контейнера как представление memory-map (без копирования)"""
+    return np.ndarray(entry["shape"], dtype=np.dtype(entry["dtype"]), buffer=mmap, offset=entry["offset"])
+
+def container_digest(header):
+    """sha256 канонического JSON заголовка контейнера"""
+    return hashlib.sha256(json.dumps(header, sort_keys=True).encode('utf-8')).hexdigest()
+
+def container_reference(path, magic, description):
+    """Ссылка из другого файла на контейнер: имя файла, magic и sha256 заголовка"""
+    header, _ = open_container(path, magic, description)
+    return {"file": Path(path).name, "magic": magic.decode('ascii'), "digest": container_digest(header)}
+
+def open_container_reference(directory, reference, description):
+    """Заголовок и memory-map контейнера по ссылке; ValueError, если файл с тех пор заменен"""
+    path = Path(directory) / reference["file"]
+    header, mmap = open_container(path, reference["magic"].encode('ascii'), description)
+    if container_digest(header) != reference["digest"]:
+        raise ValueError(f"{path} was replaced after it was referenced")
+    return header, mmap
+
+# --- Куб слоев для точечных запросов ---
+
+def write_layer_cube(path, layers_data, geotransform=None, projection=None,
+                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, window=None):
+    """Куб слоев: один массив (H, W, слои) float32, значения пикселя лежат подряд.
+
+    Точечный запрос читает одну непрерывную запись из слоев. Заголовок содержит
+    имена слоев, окно в пикселях исходного растра, геопривязку и проекцию.
+    Заполняется полосами через memory-map.
+    """
+    present = {name: data for name, data in layers_data.items() if data is not None}
+    if not present:
+        print("Нет слоев для куба.")
+        return False
+    height, width = next(iter(present.values())).shape
+    header = {
+        "version": LAYER_CUBE_VERSION,
+        # Каждая запись куба отличается заголовком: ссылки на прежний куб (индекс) его не примут
+        "id": uuid.uuid4().hex,
+        "width": width,
+        "height": height,
+        "layers": list(present),
+        "window": list(window) if window else [0, 0, width, height],
+        "geotransform": list(geotransform) if geotransform else None,
+        "projection": projection or None,
+        "arrays": [],
+    }
+    shape = (height, width, len(present))
+    encoded = container_layout(LAYER_CUBE_MAGIC, header, [('<f4', shape)])
+    entry = header["arrays"][0]
+    with open(path, 'wb') as f:
+        f.write(LAYER_CUBE_MAGIC)
+        f.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+        f.write(encoded)
+        f.truncate(entry["offset"] + 4 * int(np.prod(shape)))
+    mmap = np.memmap(path, dtype=np.uint8, mode='r+')
+    try:
+        cube = container_array(mmap, entry)
+        for yoff, ysize in iter_shape_windows((height, width), memory_budget_mb):
+            for index, data in enumerate(present.values()):
+                cube[yoff:yoff + ysize, :, index] = data[yoff:yoff + ysize]
+        mmap.flush()
+    finally:
+        del mmap
+    print(f"Куб слоев сохранен: {path} ({', '.join(present)})")
+    return True
+
+class LayerCube:
+    """Пакетные точечные запросы значений всех слоев по пикселям или lon/lat (memory-map)"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header, self._mmap = open_container(self.path, LAYER_CUBE_MAGIC, "layer cube")
+        self.width = self.header["width"]
+        self.height = self.header["height"]
+        self.layers = list(self.header["layers"])
+        # Кубы до LAYER_CUBE_VERSION 2 строились только по всему растру
+        self.window = self.header.get("window") or [0, 0, self.width, self.height]
+        self.geotransform = self.header["geotransform"]
+        self.projection = self.header["projection"]
+        self.values = container_array(self._mmap, self.header["arrays"][0])
+        self._transform = None
+
+    def query_pixels(self, px, py):
+        """Значения слоев (N, число слоев) для пиксельных координат; вне растра - NaN"""
+        px = np.atleast_1d(np.asarray(px, dtype=np.float64))
+        py = np.atleast_1d(np.asarray(py, dtype=np.float64))
+        inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        result = np.full((px.size, len(self.layers)), np.nan, dtype=np.float32)
+        result[inside] = self.values[py[inside].astype(np.int64), px[inside].astype(np.int64)]
+        return result
+
+    def query_pixel(self, x, y):
+        """Значения слоев одного пикселя без векторных накладных расходов; None вне растра"""
+        col = math.floor(x)
+        row = math.floor(y)
+        if not (0 <= col < self.width and 0 <= row < self.height):
+            return None
+        return self.values[row, col]
+
+    def query_lonlat(self, lon, lat):
+        """Значения слоев (N, число слоев) для географических координат"""
+        if self._transform is None:
+            self._transform = projected_from_lonlat_transform(self.projection)
+        if self._transform is None or not self.geotransform:
+            raise ValueError(f"{self.path} has no georeferencing")
+        px, py = lonlat_to_pixels(np.atleast_1d(lon), np.atleast_1d(lat), self.geotransform, self._transform)
+        return self.query_pixels(px, py)
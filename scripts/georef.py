@@ -0,0 +1,124 @@
+"""Пакетный перевод координат между пикселями растра и lon/lat."""
+import numpy as np
+
+try:
+    from osgeo import osr
+except ImportError:  # Без GDAL доступны переводы с готовым преобразованием
+    osr = None
+
+# Пакетное преобразование координат: точек за один вызов TransformPoints
+TRANSFORM_CHUNK_SIZE = 1_000_000
+# Точек на сторону при переводе прямоугольника lon/lat в пиксельный (границы в проекции кривые)
+AREA_QUERY_EDGE_SAMPLES = 64
+
+def pixels_to_lonlat(px, py, geotransform, transform):
+    """Векторный перевод пиксельных координат в (lon, lat); точки с ошибкой преобразования - NaN"""
+    px, py = np.broadcast_arrays(np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64))
+    gt = geotransform
+    # Координаты в исходной проекции для всех точек сразу
+    x = (gt[0] + px * gt[1] + py * gt[2]).ravel()
+    y = (gt[3] + px * gt[4] + py * gt[5]).ravel()
+
+    lon = np.full(x.shape, np.nan)
+    lat = np.full(x.shape, np.nan)
+    for start in range(0, x.size, TRANSFORM_CHUNK_SIZE):
+        stop = min(start + TRANSFORM_CHUNK_SIZE, x.size)
+        points = np.column_stack((x[start:stop], y[start:stop]))
+        try:
+            result = np.asarray(transform.TransformPoints(points), dtype=np.float64)
+        except Exception as e:
+            print(f"Error during batch coordinate transformation of {stop - start} points: {e}")
+            continue
+        lon[start:stop] = result[:, 0]
+        lat[start:stop] = result[:, 1]
+
+    # Неудачные преобразования GDAL помечает бесконечностями
+    invalid = ~(np.isfinite(lon) & np.isfinite(lat))
+    lon[invalid] = np.nan
+    lat[invalid] = np.nan
+    return lon.reshape(px.shape), lat.reshape(px.shape)
+
+def projected_from_lonlat_transform(projection):
+    """Преобразование географических координат в проекцию растра (обратное TileProcessor) или None"""
+    if not projection:
+        return None
+    if osr is None:
+        raise ImportError("lon/lat conversion needs GDAL (osgeo.osr)")
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromWkt(projection)
+    geo_srs = src_srs.CloneGeogCS()
+    if geo_srs is None:
+        return None
+    return osr.CoordinateTransformation(geo_srs, src_srs)
+
+def lonlat_from_projected_transform(projection):
+    """Преобразование из проекции растра в географические координаты (как в TileProcessor) или None"""
+    if not projection:
+        return None
+    if osr is None:
+        raise ImportError("lon/lat conversion needs GDAL (osgeo.osr)")
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromWkt(projection)
+    geo_srs = src_srs.CloneGeogCS()
+    if geo_srs is None:
+        return None
+    return osr.CoordinateTransformation(src_srs, geo_srs)
+
+def lonlat_to_pixels(lon, lat, geotransform, transform):
+    """Векторный перевод lon/lat в дробные пиксельные координаты (px, py); NaN при ошибке.
+
+    transform - результат projected_from_lonlat_transform; порядок осей тот же,
+    что у TileProcessor.pixels_to_lonlat, поэтому преобразования взаимно обратны.
+    """
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    shape = lon.shape
+    lon = lon.ravel()
+    lat = lat.ravel()
+    x = np.full(lon.shape, np.nan)
+    y = np.full(lon.shape, np.nan)
+    for start in range(0, lon.size, TRANSFORM_CHUNK_SIZE):
+        stop = min(start + TRANSFORM_CHUNK_SIZE, lon.size)
+        try:
+            result = np.asarray(transform.TransformPoints(np.column_stack((lon[start:stop], lat[start:stop]))),
+                                dtype=np.float64)
+        except Exception as e:
+            print(f"Error during batch coordinate transformation of {stop - start} points: {e}")
+            continue
+        x[start:stop] = result[:, 0]
+        y[start:stop] = result[:, 1]
+
+    # Обратное аффинное преобразование геопривязки
+    gt = geotransform
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    dx = x - gt[0]
+    dy = y - gt[3]
+    px = (gt[5] * dx - gt[2] * dy) / det
+    py = (gt[1] * dy - gt[4] * dx) / det
+    invalid = ~(np.isfinite(px) & np.isfinite(py))
+    px[invalid] = np.nan
+    py[invalid] = np.nan
+    return px.reshape(shape), py.reshape(shape)
+
+def lonlat_rect_to_pixels(lon_min, lat_min, lon_max, lat_max, geotransform, transform, width, height,
+                          samples=AREA_QUERY_EDGE_SAMPLES):
+    """Охватывающий пиксельный прямоугольник [x0, x1) x [y0, y1) для прямоугольника lon/lat.
+
+    В полярной проекции стороны прямоугольника lon/lat - кривые, поэтому
+    переводятся samples точек каждой стороны. Возвращает None, если
+    прямоугольник не пересекает растр.
+    """
+    t = np.linspace(0, 1, samples)
+    lon = np.concatenate([lon_min + (lon_max - lon_min) * t, np.full(samples, lon_max),
+                          lon_max - (lon_max - lon_min) * t, np.full(samples, lon_min)])
+    lat = np.concatenate([np.full(samples, lat_min), lat_min + (lat_max - lat_min) * t,
+                          np.full(samples, lat_max), lat_max - (lat_max - lat_min) * t])
+    px, py = lonlat_to_pixels(lon, lat, geotransform, transform)
+    if np.all(np.isnan(px)):
+        return None
+    x0 = max(0, int(np.floor(np.nanmin(px))))
+    y0 = max(0, int(np.floor(np.nanmin(py))))
+    x1 = min(width, int(np.ceil(np.nanmax(px))))
+    y1 = min(height, int(np.ceil(np.nanmax(py))))
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
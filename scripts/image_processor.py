@@ -1,16 +1,47 @@
-import matplotlib.pyplot as plt
 from osgeo import gdal, osr
 import numpy as np
 import os
 import sys
 import json
+import math
 from pathlib import Path
-from tqdm import tqdm
 import argparse
+import shutil
+import tempfile
+import functools
+import struct
+import zlib
+import socketserver
+import threading
+import time
+import cProfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 # Настройки matplotlib
 import matplotlib
 matplotlib.use("Agg")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from PIL import Image
+
+from area_index import AREA_INDEX_VERSION, build_area_index
+from containers import (
+    DEFAULT_MEMORY_BUDGET_MB, LAYER_CUBE_MAGIC, LAYER_CUBE_VERSION, LayerCube, container_reference,
+    iter_shape_windows, write_layer_cube,
+)
+from georef import lonlat_rect_to_pixels, pixels_to_lonlat, projected_from_lonlat_transform
+from instrumentation import (
+    Instrumentation, count_gdal_read, job_metrics, pipeline_stage, progress_handler, progress_iter, write_metrics,
+)
+from result_cache import CACHE_DIR, DEFAULT_CACHE_SIZE_MB, ResultCache, cache_digest
+from sites import DEFAULT_SITE_FOOTPRINT, SITE_MODEL, SITES_VERSION, find_sites, resolve_site_model, write_sites_json
+from tile_stats import (
+    TILE_STATS_VERSION, TileAccumulator, compute_tile_percentiles, reduce_tile_stats, summarize_tile_stats,
+    tile_edges, write_tile_stats_binary, write_tiles_json,
+)
 
 # Определяем пути к директориям
 SCRIPT_DIR = Path(__file__).parent.absolute()
@@ -23,6 +54,7 @@ INPUT_DIR = PUBLIC_DIR / 'input'    # Путь к директории input
 IMAGES_DIR = OUTPUT_DIR / 'images'  # Путь к директории images
 JSON_DIR = OUTPUT_DIR / 'json'      # Путь к директории json
 LAYERS_DIR = OUTPUT_DIR / 'layers'   # Путь к директории layers
+TILES_DIR = OUTPUT_DIR / 'tiles'     # Путь к директории пирамид тайлов
 
 # Создаем директории, если они не существуют
 IMAGES_DIR.mkdir(parents=True, exist_ok=True)
@@ -30,14 +62,17 @@ JSON_DIR.mkdir(parents=True, exist_ok=True)
 LAYERS_DIR.mkdir(parents=True, exist_ok=True)
 INPUT_DIR.mkdir(parents=True, exist_ok=True)  # Создаем директорию для входных файлов
 
-print(f"Script directory: {SCRIPT_DIR}")
-print(f"Project root: {PROJECT_ROOT}")
-print(f"Public directory: {PUBLIC_DIR}")
-print(f"Input directory: {INPUT_DIR}")
-print(f"Layers directory: {LAYERS_DIR}")
-print(f"Output directory: {OUTPUT_DIR}")
-print(f"JSON directory: {JSON_DIR}")
-print(f"Images directory: {IMAGES_DIR}")
+def print_directories():
+    """Вывод путей к рабочим директориям (один раз при запуске)"""
+    print(f"Script directory: {SCRIPT_DIR}")
+    print(f"Project root: {PROJECT_ROOT}")
+    print(f"Public directory: {PUBLIC_DIR}")
+    print(f"Input directory: {INPUT_DIR}")
+    print(f"Layers directory: {LAYERS_DIR}")
+    print(f"Output directory: {OUTPUT_DIR}")
+    print(f"JSON directory: {JSON_DIR}")
+    print(f"Images directory: {IMAGES_DIR}")
+    print(f"Tiles directory: {TILES_DIR}")
 
 # Создаем директории если их нет
 OUTPUT_DIR.mkdir(exist_ok=True)
@@ -46,14 +81,92 @@ PUBLIC_DIR.mkdir(exist_ok=True)
 LAYERS_DIR.mkdir(exist_ok=True)
 IMAGES_DIR.mkdir(exist_ok=True)  # Создаем директорию для изображений
 
+# Номера каналов входного GeoTIFF (порядок определяет порядок слоев в JSON)
+LAYER_BANDS = {
+    'elevation': 6,
+    'slope': 5,
+    'shadows': 4,
+    'illumination': 2,
+}
+
+# Параметры задания, которые принимает process_image (CLI, сервер и пакетный режим)
+JOB_OPTIONS = (
+    'streaming', 'memory_budget_mb', 'num_tiles', 'include_edges', 'tile_std',
+    'tile_percentiles', 'png_downsample', 'render_workers', 'pyramid',
+    'use_cache', 'cache_dir', 'cache_size_mb', 'ice_model', 'area_index', 'layer_cube',
+    'sites', 'site_footprint', 'site_model', 'roi', 'roi_lonlat', 'cog', 'area_layers',
+)
+
+# Модель вероятности льда: вес каждого признака и пороги (slope_min <= уклон < slope_max,
+# тень == shadow_value, elevation_min < высота < elevation_max)
+ICE_MODEL = {
+    'slope_weight': 0.4,
+    'slope_min': 0.0,
+    'slope_max': 5.0,
+    'shadow_weight': 0.3,
+    'shadow_value': 1.0,
+    'elevation_weight': 0.3,
+    'elevation_min': 0.0,
+    'elevation_max': 3000.0,
+}
+# Пикселей в блоке расчета льда (временные буферы выделяются один раз на блок)
+ICE_CHUNK_PIXELS = 1024 * 1024
+
+# Резидентный сервер заданий
+DEFAULT_SERVER_WORKERS = 2
+
+# Пакетный режим
+BATCH_INPUT_PATTERNS = ('*.tif', '*.tiff', '*.TIF', '*.TIFF')
+# Оценка памяти обработки в памяти: байт на пиксель сверх каналов входного растра
+# (5 слоев float32, маски, индексы LUT и буферы RGBA при отрисовке)
+IN_MEMORY_BYTES_PER_PIXEL = 40
+# Постоянная часть: интерпретатор, GDAL, matplotlib
+BATCH_BASE_MEMORY_MB = 200
+
+# Размер сетки тайлов по умолчанию (тайлов по каждой оси)
+DEFAULT_NUM_TILES = 25
+
+# Кэш решеток углов тайлов: (геопривязка, проекция, сетка) -> (lon, lat)
+CORNER_LATTICE_CACHE_SIZE = 16
+_CORNER_LATTICE_CACHE = {}
+# Задания сервера выполняются в потоках и делят кэш решеток
+_corner_lattice_lock = threading.Lock()
+
+# Экспорт слоев в Cloud-Optimized GeoTIFF (layers/<prefix>_layers_<группа>.tif). GeoTIFF
+# хранит один тип данных на все каналы, поэтому слои сгруппированы по компактному типу:
+# непрерывные - float32 с NaN, тени и квантованная вероятность льда - uint8.
+# resampling - метод внутренних обзоров (тени категориальные, поэтому NEAREST).
+COG_GROUPS = {
+    'f32': {'layers': ('elevation', 'slope', 'illumination'), 'dtype': 'float32', 'resampling': 'AVERAGE'},
+    'u8': {'layers': ('shadows', 'ice'), 'dtype': 'uint8', 'resampling': 'NEAREST'},
+}
+# Масштаб uint8-слоев: хранится round(значение / масштаб), COG_BYTE_NODATA - нет данных
+COG_BYTE_SCALES = {'shadows': 1.0, 'ice': 1 / 250}
+COG_BYTE_NODATA = 255
+COG_BLOCK_SIZE = 512
+COG_VERSION = 2
+
+# --- Статистика по тайлам ---
+
 class TileProcessor:
-    def __init__(self, ds):
+    def __init__(self, ds, num_tiles=DEFAULT_NUM_TILES, include_edges=False):
+        if num_tiles < 1:
+            raise ValueError(f"Число тайлов должно быть не меньше 1: {num_tiles}")
         self.ds = ds
         self.width = ds.RasterXSize
         self.height = ds.RasterYSize
-        self.num_tiles = 25
+        # Окно в пикселях исходного растра (весь растр без области интереса)
+        self.window = raster_window(ds)
+        self.roi = isinstance(ds, RasterWindow)
+        self.num_tiles = num_tiles
         self.tile_size_x = self.width // self.num_tiles
         self.tile_size_y = self.height // self.num_tiles
+        self.include_edges = include_edges
+        self.x_edges = tile_edges(self.width, self.num_tiles, include_edges)
+        self.y_edges = tile_edges(self.height, self.num_tiles, include_edges)
+        if not include_edges and (self.width % num_tiles or self.height % num_tiles):
+            print(f"Warning: {self.width % num_tiles} columns and {self.height % num_tiles} rows "
+                  f"at the raster edge are not covered by the tile grid (use --include-edges).")
         
         # Геопривязка
         self.geotransform = ds.GetGeoTransform()
@@ -92,33 +205,101 @@ class TileProcessor:
             print(f"Error during coordinate transformation for pixel ({px}, {py}): {e}")
             return None, None
 
-    def process_tiles(self, layers_data):
+    def pixels_to_lonlat(self, px, py):
+        """Векторная конвертация массивов пиксельных координат в географические.
+
+        Возвращает массивы (lon, lat) формы px/py; точки, которые не удалось
+        преобразовать, получают NaN. Без геопривязки возвращает (None, None).
+        """
+        if not self.geotransform or not self.coord_transform:
+            return None, None
+        return pixels_to_lonlat(px, py, self.geotransform, self.coord_transform)
+
+    def corner_lattice(self):
+        """Географические координаты всех углов тайлов: массивы (lon, lat) формы (ny+1, nx+1).
+
+        Соседние тайлы делят углы, поэтому решетка считается одним вызовом
+        и кэшируется для пары (датасет, сетка).
+        """
+        if not self.geotransform or not self.coord_transform:
+            return None, None
+        key = (tuple(self.geotransform), self.projection,
+               self.x_edges.tobytes(), self.y_edges.tobytes())
+        with _corner_lattice_lock:
+            lattice = _CORNER_LATTICE_CACHE.get(key)
+        if lattice is None:
+            # Преобразование - вне блокировки; одновременный расчет той же решетки безвреден
+            px, py = np.meshgrid(self.x_edges, self.y_edges)
+            lattice = self.pixels_to_lonlat(px, py)
+            with _corner_lattice_lock:
+                _CORNER_LATTICE_CACHE[key] = lattice
+                while len(_CORNER_LATTICE_CACHE) > CORNER_LATTICE_CACHE_SIZE:
+                    _CORNER_LATTICE_CACHE.pop(next(iter(_CORNER_LATTICE_CACHE)))
+        return lattice
+
+    def compute_stats(self, data, with_std=False, percentiles=None):
+        """Статистика всех тайлов слоя (массив или memmap)"""
+        if data is None:
+            return None
+        stats = reduce_tile_stats(data, self.x_edges, self.y_edges, with_m2=with_std)
+        if percentiles:
+            stats['percentiles'] = compute_tile_percentiles(data, self.x_edges, self.y_edges, percentiles)
+        return stats
+
+    def process_tiles(self, layers_data, with_std=False, percentiles=None):
         """Генерация данных по тайлам"""
-        tiles = []
+        print(f"Starting tile processing ({self.num_tiles}x{self.num_tiles})...")
+        layers_stats = {
+            layer_name: self.compute_stats(data, with_std, percentiles)
+            for layer_name, data in layers_data.items()
+        }
+        return self.tiles_from_stats(layers_stats)
+
+    def tiles_from_stats(self, layers_stats):
+        """Генерация данных по тайлам из статистики слоев"""
+        tiles = list(self.iter_tiles(layers_stats))
+        print("Tile processing finished.")
+        return tiles
+
+    def iter_tiles(self, layers_stats):
+        """Данные по тайлам в формате JSON по одному (без построения всего списка)"""
+        # Итоговые величины считаем сразу для всей сетки
+        summaries = {}
+        for layer_name, stats in layers_stats.items():
+            if stats is None:
+                summaries[layer_name] = None
+                continue
+            has_data, summary = summarize_tile_stats(stats)
+            # Списки Python заметно быстрее поэлементного доступа к numpy
+            summaries[layer_name] = (has_data.tolist(), {key: values.tolist() for key, values in summary.items()})
+
+        # Географические координаты углов всех тайлов (одно пакетное преобразование)
+        lattice_lon, lattice_lat = self.corner_lattice()
+        if lattice_lon is not None:
+            lattice_lon = lattice_lon.tolist()
+            lattice_lat = lattice_lat.tolist()
+
+        x0, y0 = self.window[:2]
         tile_id = 0
-        
-        print("Starting tile processing...")
-        for i in tqdm(range(self.num_tiles), desc="Обработка тайлов"):
+        for i in range(self.num_tiles):
             for j in range(self.num_tiles):
                 # Границы тайла
-                x_min = j * self.tile_size_x
-                y_min = i * self.tile_size_y
-                x_max = x_min + self.tile_size_x
-                y_max = y_min + self.tile_size_y
-                
-                # Географические координаты углов
-                lon_min, lat_min = self.pixel_to_coords(x_min, y_min)
-                lon_max, lat_max = self.pixel_to_coords(x_max, y_max)
-                
+                x_min = self.x_edges[j]
+                y_min = self.y_edges[i]
+                x_max = self.x_edges[j + 1]
+                y_max = self.y_edges[i + 1]
+
                 # Если координаты не удалось получить, пропускаем гео-блок
                 geo_coords_data = None
-                if lon_min is not None and lat_min is not None and lon_max is not None and lat_max is not None:
-                    geo_coords_data = {
-                        "lon_min": round(lon_min, 6),
-                        "lat_min": round(lat_min, 6),
-                        "lon_max": round(lon_max, 6),
-                        "lat_max": round(lat_max, 6)
-                    }
+                if lattice_lon is not None:
+                    corners = (lattice_lon[i][j], lattice_lat[i][j], lattice_lon[i + 1][j + 1], lattice_lat[i + 1][j + 1])
+                    if not any(map(math.isnan, corners)):
+                        geo_coords_data = {
+                            "lon_min": round(corners[0], 6),
+                            "lat_min": round(corners[1], 6),
+                            "lon_max": round(corners[2], 6),
+                            "lat_max": round(corners[3], 6)
+                        }
 
                 # Собираем данные по слоям
                 tile_data = {
@@ -132,45 +313,51 @@ class TileProcessor:
                     "geo_coords": geo_coords_data, # Может быть None
                     "layers": {}
                 }
-                
-                # Анализ данных слоев
-                for layer_name, data in layers_data.items():
-                    if data is not None:  # Проверка, что данные слоя существуют
-                        # Проверяем, что границы тайла не выходят за пределы данных
-                        if y_max <= data.shape[0] and x_max <= data.shape[1]:
-                             tile_slice = data[y_min:y_max, x_min:x_max]
-                             if tile_slice.size > 0 and not np.all(np.isnan(tile_slice)):
-                                 try:
-                                     tile_data["layers"][layer_name] = {
-                                         "mean": round(float(np.nanmean(tile_slice)), 2),
-                                         "max": round(float(np.nanmax(tile_slice)), 2),
-                                         "min": round(float(np.nanmin(tile_slice)), 2)
-                                     }
-                                 except Exception as e:
-                                     print(f"Warning: Error calculating stats for tile {tile_id}, layer {layer_name}. Slice shape: {tile_slice.shape}. Error: {e}")
-                                     tile_data["layers"][layer_name] = {"mean": None, "max": None, "min": None}
-                             else:
-                                 tile_data["layers"][layer_name] = {"mean": None, "max": None, "min": None}
-                        else:
-                             # Границы тайла вышли за пределы массива данных
-                             # print(f"Warning: Tile slice {tile_id} ({y_min}:{y_max}, {x_min}:{x_max}) out of bounds for layer {layer_name} with shape {data.shape}")
-                             tile_data["layers"][layer_name] = {"mean": None, "max": None, "min": None}
-                    else:
+                if self.roi:
+                    # Те же границы в пикселях исходного растра (только при области интереса)
+                    tile_data["source_pixel_coords"] = {
+                        "x_min": int(x_min) + x0,
+                        "y_min": int(y_min) + y0,
+                        "x_max": int(x_max) + x0,
+                        "y_max": int(y_max) + y0
+                    }
+
+                for layer_name, layer_summary in summaries.items():
+                    if layer_summary is None:
                         tile_data["layers"][layer_name] = None # Устанавливаем None, если данных слоя нет
-                
-                tiles.append(tile_data)
+                        continue
+                    has_data, summary = layer_summary
+                    if has_data[i][j]:
+                        tile_data["layers"][layer_name] = {
+                            key: round(values[i][j], 2) for key, values in summary.items()
+                        }
+                    else:
+                        tile_data["layers"][layer_name] = {key: None for key in summary}
+
+                yield tile_data
                 tile_id += 1
-        print("Tile processing finished.")
-        return tiles
 
-def process_image(input_file_path: Path, output_prefix: str):
-    """Основная функция обработки изображения"""
+def process_image(input_file_path: Path, output_prefix: str, streaming: bool = False,
+                  memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB, num_tiles: int = DEFAULT_NUM_TILES,
+                  include_edges: bool = False, tile_std: bool = False, tile_percentiles=None,
+                  png_downsample: int = 1, render_workers: int = None, pyramid: bool = False,
+                  use_cache: bool = False, cache_dir=None, cache_size_mb: int = DEFAULT_CACHE_SIZE_MB,
+                  ice_model=None, area_index: bool = False, layer_cube: bool = False,
+                  sites: int = 0, site_footprint: int = DEFAULT_SITE_FOOTPRINT, site_model=None,
+                  roi=None, roi_lonlat=None, cog: bool = False, area_layers=None):
+    """Основная функция обработки изображения.
+
+    С roi (пиксели x0, y0, x1, y1) или roi_lonlat (lon_min, lat_min, lon_max, lat_max)
+    обрабатывается только окно растра: каналы читаются окном, а геопривязка
+    результатов совпадает с исходным растром.
+    """
     print(f"\nОбработка файла: {input_file_path.name} с префиксом '{output_prefix}'")
 
     gdal.UseExceptions() # Включаем исключения GDAL для лучшей диагностики
     ds = None
     try:
-        ds = gdal.Open(str(input_file_path))
+        with pipeline_stage('open'):
+            ds = gdal.Open(str(input_file_path))
     except RuntimeError as e:
          print(f"GDAL Error opening file {input_file_path}: {e}")
          return False
@@ -180,6 +367,18 @@ def process_image(input_file_path: Path, output_prefix: str):
         print(f"Ошибка: Не удалось открыть файл {input_file_path} (ds is None)")
         return False
 
+    # Область интереса: дальше весь конвейер работает с окном растра
+    roi_window = None
+    if roi is not None or roi_lonlat is not None:
+        try:
+            roi_window = resolve_roi(ds, roi, roi_lonlat)
+        except (TypeError, ValueError) as e:
+            print(f"Ошибка: {e}")
+            return False
+        x0, y0, x1, y1 = roi_window
+        print(f"Область интереса: x {x0}-{x1}, y {y0}-{y1} (растр {ds.RasterXSize}x{ds.RasterYSize})")
+        ds = RasterWindow(ds, *roi_window)
+
     # Получаем размеры и проекцию
     width = ds.RasterXSize
     height = ds.RasterYSize
@@ -188,42 +387,515 @@ def process_image(input_file_path: Path, output_prefix: str):
     print(f"Image size: {width}x{height}")
     print(f"Projection: {projection}")
     
+    try:
+        resolve_ice_model(ice_model)
+        resolve_site_model(site_model)
+        area_layers = resolve_area_layers(area_layers)
+        if sites and site_footprint < 1:
+            raise ValueError(f"Размер окна площадки должен быть положительным: {site_footprint}")
+    except (TypeError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        return False
+
     # Инициализация процессора тайлов
-    tile_processor = TileProcessor(ds)
+    try:
+        tile_processor = TileProcessor(ds, num_tiles=num_tiles, include_edges=include_edges)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return False
 
-    # Словарь для хранения данных слоев
-    layers_data = {}
+    layer_names = list(LAYER_BANDS) + ['ice']
+    if render_workers is None:
+        render_workers = min(len(layer_names), os.cpu_count() or 1)
+    render_chunk_pixels = RENDER_CHUNK_PIXELS
+    if streaming:
+        print(f"Потоковый режим, бюджет памяти: {memory_budget_mb} МБ")
+        # PNG пишутся в исходном разрешении полосами, буферы всех потоков раскраски - в пределах бюджета
+        render_chunk_pixels = render_chunk_for_budget(memory_budget_mb, render_workers)
+
+    output_bin_path = JSON_DIR / f"{output_prefix}_tiles.bin"
+    output_json_path = JSON_DIR / f"{output_prefix}_tiles.json"
+    output_area_path = JSON_DIR / f"{output_prefix}_area.bin"
+    output_cube_path = JSON_DIR / f"{output_prefix}_cube.bin"
+    output_sites_path = JSON_DIR / f"{output_prefix}_sites.json"
+    output_cog_paths = {group: LAYERS_DIR / f"{output_prefix}_layers_{group}.tif" for group in COG_GROUPS}
+
+    # Ключи кэша для слоев и выходных файлов
+    cache = None
+    keys = None
+    if use_cache:
+        cache = ResultCache(cache_dir or CACHE_DIR, cache_size_mb)
+        with pipeline_stage('cache'):
+            input_digest = cache.input_digest(input_file_path)
+            if roi_window is not None:
+                input_digest = cache_digest('roi', input_digest, roi_window)
+            keys = cache_keys(input_digest, output_prefix, tile_processor,
+                              png_downsample, tile_std, tile_percentiles, ice_model,
+                              sites, site_footprint, site_model, area_layers, layer_cube)
+
+    # Выходные файлы, которые еще нужно построить (остальные восстановлены из кэша)
+    outputs = {('png', name): IMAGES_DIR / f"{output_prefix}_{name}.png" for name in layer_names}
+    outputs.update({('legend', name): LAYERS_DIR / f"{output_prefix}_{name}.png" for name in layer_names})
+    outputs[('tiles_bin', None)] = output_bin_path
+    outputs[('tiles_json', None)] = output_json_path
+    if area_index:
+        outputs[('area_index', None)] = output_area_path
+    if layer_cube:
+        outputs[('layer_cube', None)] = output_cube_path
+    if sites:
+        outputs[('sites', None)] = output_sites_path
+    if cog:
+        outputs.update({('cog', group): path for group, path in output_cog_paths.items()})
+    pending = {
+        output: path for output, path in outputs.items()
+        if cache is None or not cache.restore(keys[output], path, kind=output[0])
+    }
+    # Индекс ссылается на заголовок куба: новый куб требует нового индекса
+    if ('layer_cube', None) in pending and area_index:
+        pending[('area_index', None)] = output_area_path
+    # Устаревшие файлы предыдущей обработки с тем же префиксом не должны попасть в кэш
+    for path in pending.values():
+        if path.is_file():
+            path.unlink()
+    pending_pyramids = []
+    if pyramid:
+        pending_pyramids = [
+            name for name in layer_names
+            if not pyramid_complete(name, output_prefix, keys[('layer', name)] if keys else None)
+        ]
+
+    # Временный каталог для слоев в потоковом режиме (memory-mapped .npy)
+    work_dir = None
+    layers_stats = None
+    try:
+        if pending or pending_pyramids:
+            if streaming:
+                layers_data = None
+                if cache is not None:
+                    cached = {name: cache.load_array(keys[('layer', name)], mmap=True) for name in layer_names}
+                    if all(data is not None for data in cached.values()):
+                        layers_data = cached
+                if layers_data is None:
+                    work_dir = Path(tempfile.mkdtemp(prefix=f"{output_prefix}_"))
+                    with pipeline_stage('streaming'):
+                        layers_data, layers_stats = process_layers_streaming(ds, tile_processor, work_dir,
+                                                                             memory_budget_mb, with_std=tile_std,
+                                                                             ice_model=ice_model)
+                    if cache is not None:
+                        for name, data in layers_data.items():
+                            if data is not None:
+                                layers_data[name] = cache.adopt_array(keys[('layer', name)], data)
+                layers = LayerLoader(ds, preloaded=layers_data)
+            else:
+                layers = LayerLoader(ds, cache, keys, ice_model=ice_model)
+
+            # --- Создание PNG визуализаций --- 
+            bare_layers = {name for (kind, name) in pending if kind == 'png'}
+            legend_layers = {name for (kind, name) in pending if kind == 'legend'}
+            if bare_layers or legend_layers:
+                print("--- Создание PNG изображений ---")
+                png_data = {name: layers.get(name) for name in layer_names if name in bare_layers | legend_layers}
+                with pipeline_stage('png'):
+                    save_layers_png(png_data, output_prefix, downsample=png_downsample, workers=render_workers,
+                                    bare_layers=bare_layers, legend_layers=legend_layers,
+                                    chunk_pixels=render_chunk_pixels)
+            if pending_pyramids:
+                print("--- Построение пирамид тайлов ---")
+                with pipeline_stage('pyramid'):
+                    build_layer_pyramids({name: layers.get(name) for name in pending_pyramids}, output_prefix,
+                                         workers=render_workers,
+                                         source_keys={name: keys[('layer', name)] for name in pending_pyramids} if keys else None)
+
+            # Статистика по тайлам
+            if ('tiles_bin', None) in pending or ('tiles_json', None) in pending:
+                print(f"Starting tile processing ({num_tiles}x{num_tiles})...")
+                with pipeline_stage('tiles'):
+                    if streaming:
+                        layers_data = {name: layers.get(name) for name in layer_names}
+                        if layers_stats is None:
+                            layers_stats = accumulate_tile_stats(layers_data, tile_processor, memory_budget_mb, tile_std)
+                        if tile_percentiles:
+                            # Перцентили требуют всех значений тайла - читаем их построчно из memmap
+                            for layer_name, stats in layers_stats.items():
+                                if stats is not None:
+                                    stats['percentiles'] = compute_tile_percentiles(
+                                        layers_data[layer_name], tile_processor.x_edges, tile_processor.y_edges, tile_percentiles)
+                    else:
+                        layers_stats = {
+                            layer_name: tile_processor.compute_stats(layers.get(layer_name), tile_std, tile_percentiles)
+                            for layer_name in layer_names
+                        }
+
+            # Куб слоев для точечных запросов
+            if ('layer_cube', None) in pending:
+                with pipeline_stage('layer_cube'):
+                    write_layer_cube(output_cube_path, {name: layers.get(name) for name in layer_names},
+                                     tile_processor.geotransform, tile_processor.projection, memory_budget_mb,
+                                     window=tile_processor.window)
+
+            # Индекс площадных запросов
+            if ('area_index', None) in pending:
+                print(f"Построение индекса площадных запросов: {output_area_path}")
+                with pipeline_stage('area_index'):
+                    # Вместе с записанным кубом слоев значения (уровень 0) берутся из него, а не дублируются
+                    cube = None
+                    if layer_cube and output_cube_path.is_file():
+                        cube = container_reference(output_cube_path, LAYER_CUBE_MAGIC, "layer cube")
+                    build_area_index(output_area_path, {name: layers.get(name) for name in area_layers},
+                                     tile_processor.geotransform, tile_processor.projection, memory_budget_mb,
+                                     cube=cube, window=tile_processor.window)
+
+            # Поиск площадок
+            if ('sites', None) in pending:
+                print(f"Поиск {sites} площадок {site_footprint}x{site_footprint} пикселей...")
+                with pipeline_stage('sites'):
+                    found = find_sites({name: layers.get(name) for name in layer_names}, site_footprint, sites,
+                                       site_model, memory_budget_mb)
+                    if found is not None:
+                        write_sites_json(output_sites_path, found, tile_processor, site_footprint, site_model)
+
+            # Экспорт слоев в Cloud-Optimized GeoTIFF
+            for group, settings in COG_GROUPS.items():
+                if ('cog', group) in pending:
+                    with pipeline_stage('cog'):
+                        write_layers_cog(output_cog_paths[group], {name: layers.get(name) for name in settings['layers']},
+                                         settings['dtype'], settings['resampling'], tile_processor.geotransform,
+                                         tile_processor.projection, memory_budget_mb, window=tile_processor.window)
+    finally:
+        layers = None
+        layers_data = None
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if ('tiles_bin', None) in pending:
+        # Сохранение в бинарный колоночный формат
+        print(f"Сохранение бинарной статистики тайлов в: {output_bin_path}")
+        with pipeline_stage('binary'):
+            write_tile_stats_binary(output_bin_path, tile_processor, layers_stats)
+
+    if ('tiles_json', None) in pending:
+        # Сохранение в JSON
+        print(f"Сохранение JSON в: {output_json_path}")
+        with pipeline_stage('json'):
+            write_tiles_json(output_json_path, tile_processor.iter_tiles(layers_stats))
+        print("Tile processing finished.")
 
-    # Обработка слоев с сохранением данных
-    layers_data['elevation'] = process_elevation_layer(ds)
-    layers_data['slope'] = process_slope_layer(ds)
-    layers_data['shadows'] = process_shadow_layer(ds)
-    layers_data['illumination'] = process_illumination_layer(ds)
-    # Рассчитываем лед только после того, как собрали остальные данные
-    layers_data['ice'] = process_ice_layer(layers_data['elevation'], layers_data['slope'], layers_data['shadows'])
-
-    # --- Создание PNG визуализаций --- 
-    print("--- Создание PNG изображений ---")
-    save_elevation_png(layers_data.get('elevation'), output_prefix)
-    save_slope_png(layers_data.get('slope'), output_prefix)
-    save_shadows_png(layers_data.get('shadows'), output_prefix)
-    save_illumination_png(layers_data.get('illumination'), output_prefix)
-    save_ice_png(layers_data.get('ice'), output_prefix)
-
-    # Генерация тайлов
-    tiles = tile_processor.process_tiles(layers_data)
-
-    # Сохранение в JSON
-    output_json_filename = f"{output_prefix}_tiles.json"
-    output_json_path = JSON_DIR / output_json_filename
-    print(f"Сохранение JSON в: {output_json_path}")
-    with open(output_json_path, 'w') as f:
-        json.dump(tiles, f, indent=2)
+    if cache is not None:
+        for output, path in pending.items():
+            if path.is_file():
+                cache.store_file(keys[output], path)
+        cache.evict()
+        cache.report()
     
     ds = None
     print(f"Файл {input_file_path.name} успешно обработан (префикс: {output_prefix}).")
     return True
 
+# --- Кэш результатов ---
+
+def cache_keys(input_digest, output_prefix, tile_processor, png_downsample=1, tile_std=False, tile_percentiles=None,
+               ice_model=None, sites=0, site_footprint=DEFAULT_SITE_FOOTPRINT, site_model=None,
+               area_layers=None, layer_cube=False):
+    """Ключи кэша слоев и выходных файлов.
+
+    Ключ слоя зависит только от входного растра и параметров этого слоя,
+    ключ производного результата - от ключей его слоев и собственных
+    параметров, поэтому изменение одного этапа инвалидирует только зависящие
+    от него записи.
+    """
+    keys = {}
+    for name, band_index in LAYER_BANDS.items():
+        keys[('layer', name)] = cache_digest('layer', name, input_digest, band_index)
+    keys[('layer', 'ice')] = cache_digest(
+        'layer', 'ice', [keys[('layer', name)] for name in ('elevation', 'slope', 'shadows')],
+        resolve_ice_model(ice_model))
+
+    for name in list(LAYER_BANDS) + ['ice']:
+        layer_key = keys[('layer', name)]
+        cmap = LAYER_RENDER_SETTINGS[name]['cmap']
+        keys[('png', name)] = cache_digest('png', layer_key, cmap, png_downsample)
+        # Версия с легендой содержит префикс в заголовке
+        keys[('legend', name)] = cache_digest('legend', layer_key, cmap, png_downsample, output_prefix)
+
+    tiles_key = cache_digest(
+        'tiles', input_digest, sorted(key for (kind, _), key in keys.items() if kind == 'layer'),
+        tile_processor.x_edges.tolist(), tile_processor.y_edges.tolist(), tile_std, tile_percentiles)
+    keys[('tiles_bin', None)] = cache_digest('tiles_bin', tiles_key, TILE_STATS_VERSION)
+    keys[('tiles_json', None)] = cache_digest('tiles_json', tiles_key, TILE_STATS_VERSION)
+    keys[('layer_cube', None)] = cache_digest(
+        'layer_cube', [keys[('layer', name)] for name in list(LAYER_BANDS) + ['ice']], LAYER_CUBE_VERSION)
+    keys[('area_index', None)] = cache_digest(
+        'area_index', [keys[('layer', name)] for name in resolve_area_layers(area_layers)],
+        keys[('layer_cube', None)] if layer_cube else None, AREA_INDEX_VERSION)
+    keys[('sites', None)] = cache_digest(
+        'sites', [keys[('layer', name)] for name in ('ice', 'slope', 'shadows', 'illumination')],
+        sites, site_footprint, resolve_site_model(site_model), SITES_VERSION)
+    for group, settings in COG_GROUPS.items():
+        keys[('cog', group)] = cache_digest(
+            'cog', group, [keys[('layer', name)] for name in settings['layers']], settings,
+            {name: COG_BYTE_SCALES.get(name) for name in settings['layers']}, COG_BLOCK_SIZE, COG_VERSION)
+    return keys
+
+class LayerLoader:
+    """Ленивое получение слоев: уже загруженные, из кэша или расчет из датасета.
+
+    В кэш пишутся только слои, запрошенные через get(); слои, нужные лишь
+    для расчета льда, не сохраняются.
+    """
+    def __init__(self, ds, cache=None, keys=None, preloaded=None, ice_model=None):
+        self.ds = ds
+        self.cache = cache
+        self.keys = keys
+        self.ice_model = ice_model
+        self.layers = dict(preloaded or {})
+        # Слои, которые уже есть в кэше
+        self.cached = set()
+
+    def get(self, layer_name):
+        data = self._load(layer_name)
+        if data is not None and self.cache is not None and layer_name not in self.cached:
+            self.cache.store_array(self.keys[('layer', layer_name)], data)
+            self.cached.add(layer_name)
+        return data
+
+    def _load(self, layer_name):
+        if layer_name in self.layers:
+            return self.layers[layer_name]
+
+        data = None
+        key = self.keys[('layer', layer_name)] if self.cache is not None else None
+        if key is not None:
+            data = self.cache.load_array(key)
+            if data is not None:
+                self.cached.add(layer_name)
+        if data is None:
+            with pipeline_stage(layer_name):
+                if layer_name == 'ice':
+                    # Рассчитываем лед только после того, как собрали остальные данные
+                    data = process_ice_layer(self._load('elevation'), self._load('slope'), self._load('shadows'),
+                                             ice_model=self.ice_model)
+                else:
+                    processors = {
+                        'elevation': process_elevation_layer,
+                        'slope': process_slope_layer,
+                        'shadows': process_shadow_layer,
+                        'illumination': process_illumination_layer,
+                    }
+                    data = processors[layer_name](self.ds)
+        self.layers[layer_name] = data
+        return data
+
+# --- Индекс площадных запросов ---
+
+def resolve_area_layers(area_layers=None):
+    """Слои индекса площадных запросов в порядке слоев конвейера (по умолчанию - все)"""
+    layer_names = list(LAYER_BANDS) + ['ice']
+    if area_layers is None:
+        return layer_names
+    unknown = sorted(set(area_layers) - set(layer_names))
+    if unknown:
+        raise ValueError(f"Неизвестные слои индекса площадных запросов: {', '.join(unknown)}")
+    if not area_layers:
+        raise ValueError("Список слоев индекса площадных запросов пуст")
+    return [name for name in layer_names if name in area_layers]
+
+# --- Экспорт слоев в Cloud-Optimized GeoTIFF ---
+
+def _encode_cog_block(name, block, dtype):
+    """Полоса слоя в типе файла COG: uint8 квантуется по COG_BYTE_SCALES, NaN -> COG_BYTE_NODATA"""
+    values = np.asarray(block, dtype=np.float32)
+    if dtype == 'float32':
+        return values
+    values = values / np.float32(COG_BYTE_SCALES[name])
+    nodata = np.isnan(values)
+    np.rint(values, out=values)
+    np.clip(values, 0, COG_BYTE_NODATA - 1, out=values)
+    values[nodata] = COG_BYTE_NODATA
+    return values.astype(np.uint8)
+
+def write_layers_cog(path, layers_data, dtype='float32', resampling='AVERAGE', geotransform=None, projection=None,
+                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, window=None):
+    """Многоканальный Cloud-Optimized GeoTIFF из слоев одного типа (float32 или uint8).
+
+    Слои пишутся полосами во временный тайловый GeoTIFF без сжатия (канал на
+    слой, имя слоя - описание канала, нет данных - NaN или COG_BYTE_NODATA,
+    uint8-слои с масштабом). Затем драйвер COG копирует его со сжатием DEFLATE
+    и внутренними обзорами.
+    """
+    present = {name: data for name, data in layers_data.items() if data is not None}
+    if not present:
+        print("Нет слоев для COG.")
+        return False
+    height, width = next(iter(present.values())).shape
+    gdal_type = gdal.GDT_Float32 if dtype == 'float32' else gdal.GDT_Byte
+
+    work_dir = Path(tempfile.mkdtemp(prefix='cog_'))
+    src = None
+    dst = None
+    try:
+        src = gdal.GetDriverByName('GTiff').Create(
+            str(work_dir / 'layers.tif'), width, height, len(present), gdal_type,
+            ['TILED=YES', f'BLOCKXSIZE={COG_BLOCK_SIZE}', f'BLOCKYSIZE={COG_BLOCK_SIZE}', 'BIGTIFF=IF_SAFER'])
+        if geotransform:
+            src.SetGeoTransform(geotransform)
+        if projection:
+            src.SetProjection(projection)
+        # Окно в пикселях исходного растра: x0,y0,x1,y1
+        window = window or [0, 0, width, height]
+        src.SetMetadataItem('SOURCE_WINDOW', ','.join(str(value) for value in window))
+        for index, name in enumerate(present, start=1):
+            band = src.GetRasterBand(index)
+            band.SetDescription(name)
+            if dtype == 'float32':
+                band.SetNoDataValue(float('nan'))
+            else:
+                band.SetNoDataValue(COG_BYTE_NODATA)
+                band.SetScale(COG_BYTE_SCALES[name])
+                band.SetOffset(0.0)
+        for yoff, ysize in iter_shape_windows((height, width), memory_budget_mb, COG_BLOCK_SIZE):
+            for index, (name, data) in enumerate(present.items(), start=1):
+                src.GetRasterBand(index).WriteArray(_encode_cog_block(name, data[yoff:yoff + ysize], dtype), 0, yoff)
+        src.FlushCache()
+
+        dst = gdal.GetDriverByName('COG').CreateCopy(str(path), src, options=[
+            'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', 'PREDICTOR=YES', f'BLOCKSIZE={COG_BLOCK_SIZE}',
+            f'RESAMPLING={resampling}', 'NUM_THREADS=ALL_CPUS'])
+        if dst is None:
+            raise RuntimeError(f"GDAL не смог записать {path}")
+        dst.FlushCache()
+    finally:
+        dst = None
+        src = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"COG сохранен: {path} ({', '.join(present)}, {dtype})")
+    return True
+
+# --- Область интереса ---
+
+def resolve_roi(ds, roi=None, roi_lonlat=None):
+    """Пиксельное окно (x0, y0, x1, y1) области интереса, обрезанное по растру.
+
+    roi - пиксельный прямоугольник [x0, x1) x [y0, y1) исходного растра,
+    roi_lonlat - [lon_min, lat_min, lon_max, lat_max], переводится в охватывающий
+    пиксельный прямоугольник так же, как площадные запросы.
+    """
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    if roi is not None and roi_lonlat is not None:
+        raise ValueError("Укажите только одну область интереса: roi или roi_lonlat")
+    if roi_lonlat is not None:
+        if len(roi_lonlat) != 4:
+            raise ValueError(f"roi_lonlat: ожидается lon_min,lat_min,lon_max,lat_max, получено {roi_lonlat}")
+        lon_min, lat_min, lon_max, lat_max = (float(value) for value in roi_lonlat)
+        geotransform = ds.GetGeoTransform()
+        transform = projected_from_lonlat_transform(ds.GetProjection())
+        if transform is None or not geotransform:
+            raise ValueError("Растр без геопривязки: область интереса в lon/lat недоступна")
+        window = lonlat_rect_to_pixels(lon_min, lat_min, lon_max, lat_max, geotransform, transform, width, height)
+        if window is None:
+            raise ValueError(f"Область интереса {list(roi_lonlat)} не пересекает растр")
+        return window
+    if len(roi) != 4:
+        raise ValueError(f"roi: ожидается x0,y0,x1,y1, получено {roi}")
+    x0, y0, x1, y1 = (int(value) for value in roi)
+    window = (max(0, x0), max(0, y0), min(width, x1), min(height, y1))
+    if window[0] >= window[2] or window[1] >= window[3]:
+        raise ValueError(f"Область интереса {x0},{y0},{x1},{y1} не пересекает растр {width}x{height}")
+    return window
+
+class RasterWindow:
+    """Окно датасета GDAL с интерфейсом датасета.
+
+    Каналы читают только свое окно исходного растра (ReadAsArray со смещением),
+    геопривязка сдвинута на начало окна, поэтому координаты всех результатов
+    совпадают с координатами исходного растра.
+    """
+    def __init__(self, ds, x0, y0, x1, y1):
+        self.ds = ds
+        self.xoff = x0
+        self.yoff = y0
+        self.RasterXSize = x1 - x0
+        self.RasterYSize = y1 - y0
+        self.window = (x0, y0, x1, y1)
+
+    def GetGeoTransform(self):
+        gt = self.ds.GetGeoTransform()
+        if not gt:
+            return gt
+        return (gt[0] + self.xoff * gt[1] + self.yoff * gt[2], gt[1], gt[2],
+                gt[3] + self.xoff * gt[4] + self.yoff * gt[5], gt[4], gt[5])
+
+    def GetRasterBand(self, index):
+        band = self.ds.GetRasterBand(index)
+        return None if band is None else RasterWindowBand(band, self)
+
+    def __getattr__(self, name):
+        # Остальное (RasterCount, GetProjection, ...) - как у исходного датасета
+        return getattr(self.ds, name)
+
+def raster_window(ds):
+    """Окно датасета в пикселях исходного растра [x0, y0, x1, y1]; без области интереса - весь растр"""
+    if isinstance(ds, RasterWindow):
+        return [int(value) for value in ds.window]
+    return [0, 0, ds.RasterXSize, ds.RasterYSize]
+
+class RasterWindowBand:
+    """Канал окна растра: чтения смещаются на начало окна"""
+    def __init__(self, band, window):
+        self.band = band
+        self.window = window
+        self.XSize = window.RasterXSize
+        self.YSize = window.RasterYSize
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None, **kwargs):
+        if xsize is None:
+            xsize = self.XSize - xoff
+        if ysize is None:
+            ysize = self.YSize - yoff
+        return self.band.ReadAsArray(self.window.xoff + xoff, self.window.yoff + yoff, xsize, ysize, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.band, name)
+
+def read_band_float32(band, xoff=0, yoff=0, xsize=None, ysize=None):
+    """Чтение окна канала сразу в float32 (без промежуточной копии)"""
+    if xsize is None:
+        xsize = band.XSize - xoff
+    if ysize is None:
+        ysize = band.YSize - yoff
+    data = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_type=gdal.GDT_Float32)
+    if data is not None:
+        count_gdal_read(data.nbytes)
+    return data
+
+def prepare_elevation(dem):
+    """Перевод высот в метры и маскирование некорректных значений (на месте)"""
+    dem *= 1000  # Конвертация в метры
+    # Используем np.nan для некорректных значений
+    dem[dem < -10000] = np.nan
+    return dem
+
+def prepare_slope(slope):
+    """Маскирование отрицательных уклонов (на месте)"""
+    slope[slope < 0] = np.nan
+    return slope
+
+def prepare_shadows(shadows):
+    """Тени используются как есть"""
+    return shadows
+
+def prepare_illumination(illumination):
+    """Маскирование отрицательной освещенности (на месте)"""
+    illumination[illumination < 0] = np.nan
+    return illumination
+
+LAYER_PREPARERS = {
+    'elevation': prepare_elevation,
+    'slope': prepare_slope,
+    'shadows': prepare_shadows,
+    'illumination': prepare_illumination,
+}
+
 def process_elevation_layer(ds):
     """Обработка высот с возвратом данных"""
     print("Обработка высот...")
@@ -232,14 +904,12 @@ def process_elevation_layer(ds):
         if band is None:
             print("Ошибка: Не найден 6-й канал (высоты).")
             return None
-        dem = band.ReadAsArray().astype(np.float32)
+        dem = read_band_float32(band)
         # Проверяем, не пустой ли массив перед конвертацией
         if dem.size == 0: 
              print("Ошибка: Канал высот пуст.")
              return None
-        dem *= 1000  # Конвертация в метры
-        # Используем np.nan для некорректных значений
-        dem[dem < -10000] = np.nan 
+        dem = prepare_elevation(dem)
         print("Данные высот обработаны.")
         return dem
     except Exception as e:
@@ -254,11 +924,11 @@ def process_slope_layer(ds):
         if band is None:
             print("Ошибка: Не найден 5-й канал (наклон).")
             return None
-        slope = band.ReadAsArray().astype(np.float32)
+        slope = read_band_float32(band)
         if slope.size == 0:
              print("Ошибка: Канал наклона пуст.")
              return None
-        slope[slope < 0] = np.nan # Используем np.nan
+        slope = prepare_slope(slope)
         print("Данные наклона обработаны.")
         return slope
     except Exception as e:
@@ -273,7 +943,7 @@ def process_shadow_layer(ds):
         if band is None:
             print("Ошибка: Не найден 4-й канал (тени).")
             return None
-        shadows = band.ReadAsArray().astype(np.float32)
+        shadows = read_band_float32(band)
         if shadows.size == 0:
              print("Ошибка: Канал теней пуст.")
              return None
@@ -292,18 +962,18 @@ def process_illumination_layer(ds):
         if band is None:
             print("Ошибка: Не найден 2-й канал (освещенность).")
             return None
-        illumination = band.ReadAsArray().astype(np.float32)
+        illumination = read_band_float32(band)
         if illumination.size == 0:
              print("Ошибка: Канал освещенности пуст.")
              return None
-        illumination[illumination < 0] = np.nan # Используем np.nan
+        illumination = prepare_illumination(illumination)
         print("Данные освещенности обработаны.")
         return illumination
     except Exception as e:
         print(f"Ошибка при обработке освещенности: {e}")
         return None
 
-def process_ice_layer(dem, slope, shadows):
+def process_ice_layer(dem, slope, shadows, ice_model=None):
     """Генерация данных по льду на основе других слоев"""
     print("Расчет вероятности льда...")
     if dem is None or slope is None or shadows is None:
@@ -316,27 +986,312 @@ def process_ice_layer(dem, slope, shadows):
              print(f"Ошибка: Размеры массивов не совпадают - DEM:{dem.shape}, Slope:{slope.shape}, Shadows:{shadows.shape}")
              return None
              
-        ice_prob = np.zeros_like(dem, dtype=np.float32)
-        # Условия расчета вероятности (могут быть скорректированы)
-        # Применяем маски NaN перед расчетами
-        valid_mask = ~np.isnan(dem) & ~np.isnan(slope) & ~np.isnan(shadows)
-        
-        ice_prob[valid_mask] += 0.4 * ((slope[valid_mask] < 5) & (slope[valid_mask] >= 0))
-        ice_prob[valid_mask] += 0.3 * (shadows[valid_mask] == 1)
-        ice_prob[valid_mask] += 0.3 * ((dem[valid_mask] > 0) & (dem[valid_mask] < 3000))
-        
-        # Устанавливаем NaN там, где были NaN во входных данных
-        ice_prob[~valid_mask] = np.nan 
+        ice_prob = compute_ice_probability(dem, slope, shadows, ice_model=ice_model)
         print("Вероятность льда рассчитана.")
-        return np.clip(ice_prob, 0, 1)
+        return ice_prob
     except Exception as e:
         print(f"Ошибка при расчете вероятности льда: {e}")
         return None
 
+def resolve_ice_model(ice_model=None):
+    """Полная модель льда: значения по умолчанию ICE_MODEL с переопределениями"""
+    ice_model = dict(ice_model or {})
+    unknown = sorted(set(ice_model) - set(ICE_MODEL))
+    if unknown:
+        raise ValueError(f"Неизвестные параметры модели льда: {', '.join(unknown)}")
+    return {name: float(ice_model.get(name, default)) for name, default in ICE_MODEL.items()}
+
+def compute_ice_probability(dem, slope, shadows, out=None, ice_model=None):
+    """Расчет вероятности льда для массивов (или окон) одинакового размера.
+
+    Взвешенная сумма считается за один проход блоками по ICE_CHUNK_PIXELS
+    в out (float32, создается при необходимости) через ufunc с out=/where=,
+    без выборок по булевой маске и полноразмерных временных массивов.
+    Пиксели, где хотя бы один вход NaN, получают NaN.
+    """
+    model = resolve_ice_model(ice_model)
+    if out is None:
+        out = np.empty(dem.shape, dtype=np.float32)
+    if not out.flags.c_contiguous:
+        raise ValueError("out должен быть непрерывным массивом")
+    result = out
+    dem, slope, shadows, out = (np.ravel(a) for a in (dem, slope, shadows, out))
+
+    chunk = min(ICE_CHUNK_PIXELS, out.size)
+    condition = np.empty(chunk, dtype=bool)
+    scratch = np.empty(chunk, dtype=bool)
+    for start in range(0, out.size, chunk):
+        stop = min(start + chunk, out.size)
+        n = stop - start
+        cond, tmp, o = condition[:n], scratch[:n], out[start:stop]
+        d, sl, sh = dem[start:stop], slope[start:stop], shadows[start:stop]
+
+        # Уклон
+        np.greater_equal(sl, model['slope_min'], out=cond)
+        np.less(sl, model['slope_max'], out=tmp)
+        cond &= tmp
+        o.fill(0)
+        np.copyto(o, model['slope_weight'], where=cond)
+        # Постоянная тень
+        np.equal(sh, model['shadow_value'], out=cond)
+        # Сложение в double с округлением в float32 - как в прежней формуле
+        np.add(o, model['shadow_weight'], out=o, where=cond, dtype=np.float64)
+        # Высота
+        np.greater(d, model['elevation_min'], out=cond)
+        np.less(d, model['elevation_max'], out=tmp)
+        cond &= tmp
+        np.add(o, model['elevation_weight'], out=o, where=cond, dtype=np.float64)
+        np.clip(o, 0, 1, out=o)
+
+        # Устанавливаем NaN там, где были NaN во входных данных
+        np.isnan(d, out=cond)
+        cond |= np.isnan(sl, out=tmp)
+        cond |= np.isnan(sh, out=tmp)
+        np.copyto(o, np.nan, where=cond)
+    return result
+
+# --- Потоковый режим ---
+
+def iter_row_windows(ds, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Окна-полосы во всю ширину растра, выровненные по высоте блока GeoTIFF"""
+    _, block_height = ds.GetRasterBand(1).GetBlockSize()
+    return iter_shape_windows((ds.RasterYSize, ds.RasterXSize), memory_budget_mb, block_height)
+
+def accumulate_tile_stats(layers_data, tile_processor, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, with_std=False):
+    """Статистика тайлов по готовым слоям (memmap) полосами в пределах бюджета памяти"""
+    present = {name: data for name, data in layers_data.items() if data is not None}
+    accumulator = TileAccumulator(tile_processor, present.keys(), with_std=with_std)
+    shape = (tile_processor.height, tile_processor.width)
+    for yoff, ysize in iter_shape_windows(shape, memory_budget_mb):
+        for layer_name, data in present.items():
+            accumulator.update(layer_name, np.asarray(data[yoff:yoff + ysize]), yoff)
+    return {name: (accumulator.stats[name] if data is not None else None) for name, data in layers_data.items()}
+
+def process_layers_streaming(ds, tile_processor, work_dir, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                             with_std=False, ice_model=None):
+    """Потоковая обработка слоев полосами с накоплением статистики тайлов.
+
+    Полные слои пишутся в memory-mapped файлы в work_dir, в памяти
+    одновременно находится только одна полоса всех каналов.
+    """
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+
+    bands = {}
+    for layer_name, band_index in LAYER_BANDS.items():
+        try:
+            bands[layer_name] = ds.GetRasterBand(band_index)
+        except RuntimeError as e:
+            bands[layer_name] = None
+        if bands[layer_name] is None:
+            print(f"Ошибка: Не найден {band_index}-й канал ({layer_name}).")
+    ice_ready = all(bands[name] is not None for name in ('elevation', 'slope', 'shadows'))
+    if not ice_ready:
+        print("Ошибка: Недостаточно данных для расчета вероятности льда (один из слоев = None).")
+
+    layers_data = {}
+    for layer_name in list(LAYER_BANDS) + ['ice']:
+        available = ice_ready if layer_name == 'ice' else bands[layer_name] is not None
+        if available:
+            layers_data[layer_name] = np.lib.format.open_memmap(
+                work_dir / f"{layer_name}.npy", mode='w+', dtype=np.float32, shape=(height, width))
+        else:
+            layers_data[layer_name] = None
+
+    accumulator = TileAccumulator(tile_processor, layers_data.keys(), with_std=with_std)
+    windows = list(iter_row_windows(ds, memory_budget_mb))
+    print(f"Полос для обработки: {len(windows)} (по {windows[0][1] if windows else 0} строк)")
+    for yoff, ysize in progress_iter(windows, 'streaming', desc="Потоковая обработка"):
+        window = {}
+        for layer_name, band in bands.items():
+            if band is not None:
+                raw = read_band_float32(band, 0, yoff, width, ysize)
+                window[layer_name] = LAYER_PREPARERS[layer_name](raw)
+        for layer_name, data in window.items():
+            layers_data[layer_name][yoff:yoff + ysize] = data
+        if ice_ready:
+            # Лед пишется сразу в полосу memmap, без промежуточного массива
+            window['ice'] = compute_ice_probability(window['elevation'], window['slope'], window['shadows'],
+                                                    out=layers_data['ice'][yoff:yoff + ysize], ice_model=ice_model)
+        for layer_name, data in window.items():
+            accumulator.update(layer_name, data, yoff)
+
+    for data in layers_data.values():
+        if data is not None:
+            data.flush()
+
+    layers_stats = {
+        name: (accumulator.stats[name] if data is not None else None)
+        for name, data in layers_data.items()
+    }
+    return layers_data, layers_stats
+
 # --- Функции сохранения PNG изображений --- 
 
-def save_layer_png(data, filename_base, prefix, cmap, normalize=True):
-    """Общая функция для сохранения слоя в PNG"""
+# Цветовая карта и подписи для каждого слоя
+LAYER_RENDER_SETTINGS = {
+    'elevation': {
+        'cmap': 'terrain',
+        'title': 'Карта высот рельефа',
+        'label': 'Высота (м)',
+    },
+    'slope': {
+        'cmap': 'viridis',
+        'title': 'Карта уклонов поверхности',
+        'label': 'Уклон (градусы)',
+    },
+    'shadows': {
+        'cmap': 'binary',
+        'title': 'Карта теней',
+        'label': 'Затенение (0-1)',
+    },
+    'illumination': {
+        'cmap': 'hot',
+        'title': 'Карта освещенности',
+        'label': 'Освещенность (%)',
+    },
+    'ice': {
+        'cmap': 'Blues',
+        'title': 'Карта вероятности наличия льда',
+        'label': 'Вероятность наличия льда (0-1)',
+    },
+}
+
+# Размер таблицы цветов (как у стандартных карт matplotlib) и индекс цвета для NaN
+LUT_SIZE = 256
+# Число пикселей источника, раскрашиваемых за один шаг (ограничивает временные массивы)
+RENDER_CHUNK_PIXELS = 4 * 1024 * 1024
+# Оценка байт на пиксель шага раскраски: полоса источника, маска NaN, индексы LUT,
+# RGBA, отфильтрованные строки PNG и буфер zlib
+RENDER_BYTES_PER_PIXEL = 32
+# Максимальная сторона изображения, передаваемого в matplotlib для версии с легендой
+LEGEND_MAX_SIZE = 2048
+PNG_COMPRESS_LEVEL = 3
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Размер тайла пирамиды XYZ в пикселях
+PYRAMID_TILE_SIZE = 256
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(cmap_name):
+    """Таблица цветов RGBA uint8: LUT_SIZE цветов карты + цвет для NaN в конце"""
+    cmap = matplotlib.colormaps[cmap_name]
+    lut = np.empty((LUT_SIZE + 1, 4), dtype=np.uint8)
+    lut[:LUT_SIZE] = cmap(np.linspace(0, 1, LUT_SIZE), bytes=True)
+    lut[LUT_SIZE] = cmap(np.nan, bytes=True)
+    return lut
+
+def data_range(data):
+    """Диапазон значений без NaN (как автомасштаб imshow), None если данных нет"""
+    vmin = float(np.fmin.reduce(data, axis=None))
+    vmax = float(np.fmax.reduce(data, axis=None))
+    if np.isnan(vmin) or np.isnan(vmax):
+        return None, None
+    return vmin, vmax
+
+def block_mean(data, factor):
+    """Уменьшение в factor раз усреднением блоков factor x factor без учета NaN"""
+    height, width = data.shape
+    x_edges = np.append(np.arange(0, width, factor), width)
+    y_edges = np.append(np.arange(0, height, factor), height)
+    stats = reduce_tile_stats(data, x_edges, y_edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (stats['sum'] / stats['count']).astype(np.float32)
+
+def lut_indices(values, vmin, vmax):
+    """Индексы таблицы цветов по той же схеме, что Normalize + Colormap в matplotlib"""
+    nan_mask = np.isnan(values)
+    if vmax > vmin:
+        scaled = (values - np.float32(vmin)) * np.float32(LUT_SIZE / (vmax - vmin))
+    else:
+        scaled = np.zeros(values.shape, dtype=np.float32)
+    np.clip(scaled, 0, LUT_SIZE - 1, out=scaled)
+    scaled[nan_mask] = LUT_SIZE
+    return scaled.astype(np.intp)
+
+def render_chunk_for_budget(memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, workers=1):
+    """Пикселей на шаг раскраски, при котором временные массивы всех потоков помещаются в бюджет"""
+    budget = memory_budget_mb * 1024 * 1024 // (max(1, workers) * RENDER_BYTES_PER_PIXEL)
+    return int(max(1, min(RENDER_CHUNK_PIXELS, budget)))
+
+def iter_downsampled(data, factor, chunk_pixels=RENDER_CHUNK_PIXELS):
+    """Полосы слоя, уменьшенного в factor раз: пары (первая строка результата, блок).
+
+    Исходный массив (в том числе memmap) читается полосами примерно по
+    chunk_pixels пикселей (не меньше одной строки результата), поэтому
+    временные массивы не зависят от размера слоя.
+    """
+    height, width = data.shape
+    out_height = -(-height // factor)
+    chunk_rows = max(1, chunk_pixels // (width * factor))
+    for out_row in range(0, out_height, chunk_rows):
+        source = np.asarray(data[out_row * factor:(out_row + chunk_rows) * factor])
+        if factor > 1:
+            source = block_mean(source, factor)
+        yield out_row, source
+
+def downsample_mean(data, factor, out=None):
+    """Слой, уменьшенный в factor раз усреднением блоков (NaN не учитываются).
+
+    out - готовый массив результата (например, memmap), иначе создается в памяти.
+    """
+    height, width = data.shape
+    shape = (-(-height // factor), -(-width // factor))
+    result = np.empty(shape, dtype=np.float32) if out is None else out
+    for out_row, block in iter_downsampled(data, factor):
+        result[out_row:out_row + block.shape[0]] = block
+    return result
+
+def render_layer_rgba(data, cmap_name, vmin, vmax, downsample=1):
+    """Раскраска слоя через таблицу цветов: RGBA uint8 в исходном разрешении (или уменьшенном)"""
+    lut = colormap_lut(cmap_name)
+    height, width = data.shape
+    rgba = np.empty((-(-height // downsample), -(-width // downsample), 4), dtype=np.uint8)
+    for out_row, block in iter_downsampled(data, downsample):
+        rgba[out_row:out_row + block.shape[0]] = lut[lut_indices(block, vmin, vmax)]
+    return rgba
+
+def _write_png_chunk(f, kind, payload):
+    f.write(struct.pack('>I', len(payload)))
+    f.write(kind)
+    f.write(payload)
+    f.write(struct.pack('>I', zlib.crc32(payload, zlib.crc32(kind))))
+
+def write_png_rows(path, width, height, blocks):
+    """Запись PNG (RGBA, 8 бит) из полос uint8 формы (строки, width, 4) по мере их поступления.
+
+    Все изображение в памяти не собирается: каждая полоса фильтруется
+    (Sub - разность с пикселем слева) и сразу сжимается zlib в чанки IDAT.
+    """
+    compressor = zlib.compressobj(PNG_COMPRESS_LEVEL)
+    rows = 0
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        # Ширина, высота, 8 бит на канал, цветовой тип 6 (RGBA), сжатие, фильтрация, без чересстрочности
+        _write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        for block in blocks:
+            pixels = block.reshape(block.shape[0], width * 4)
+            filtered = np.empty((block.shape[0], width * 4 + 1), dtype=np.uint8)
+            filtered[:, 0] = 1  # Тип фильтра строки: Sub
+            filtered[:, 1:5] = pixels[:, :4]
+            np.subtract(pixels[:, 4:], pixels[:, :-4], out=filtered[:, 5:])
+            compressed = compressor.compress(filtered)
+            if compressed:
+                _write_png_chunk(f, b'IDAT', compressed)
+            rows += block.shape[0]
+        if rows != height:
+            raise ValueError(f"PNG {path}: получено {rows} строк вместо {height}")
+        _write_png_chunk(f, b'IDAT', compressor.flush())
+        _write_png_chunk(f, b'IEND', b'')
+
+def save_layer_png(data, filename_base, prefix, cmap, downsample=1, bare=True, legend=True,
+                   chunk_pixels=RENDER_CHUNK_PIXELS):
+    """Общая функция для сохранения слоя в PNG.
+
+    Изображение без легенды (IMAGES_DIR) раскрашивается напрямую через таблицу
+    цветов в исходном разрешении и пишется в PNG полосами по chunk_pixels
+    пикселей; через matplotlib строится только версия с заголовком и шкалой
+    (LAYERS_DIR) по прореженной копии. bare/legend выбирают, какие версии писать.
+    """
     filename = f"{prefix}_{filename_base}.png"
     if data is None:
         print(f"Данные для {filename} отсутствуют (None), изображение не будет создано.")
@@ -347,96 +1302,722 @@ def save_layer_png(data, filename_base, prefix, cmap, normalize=True):
 
     print(f"Создание изображения: {filename}...")
     try:
-        # Нормализация данных для корректного отображения cmap (если требуется)
-        if normalize and not np.all(np.isnan(data)):
-            vmin = np.nanmin(data)
-            vmax = np.nanmax(data)
-            # Проверка на случай, если все значения одинаковые (кроме NaN)
-            if vmin == vmax:
-                 plot_data = data # Не нормализуем, если все значения одинаковые
-            else:
-                 plot_data = data
-        else:
-            plot_data = data
-            vmin = None
-            vmax = None
-
-        # Сохраняем версию с заголовком и легендой в public/images/layers
-        plt.figure(figsize=(12, 10))
-        title = {
-            'elevation': 'Карта высот рельефа',
-            'slope': 'Карта уклонов поверхности',
-            'shadows': 'Карта теней',
-            'illumination': 'Карта освещенности',
-            'ice': 'Карта вероятности наличия льда'
-        }.get(filename_base, filename_base.capitalize())
-        
-        plt.title(f"{title} - {prefix}", pad=20, fontsize=14)
-        im = plt.imshow(plot_data, cmap=cmap, vmin=vmin, vmax=vmax)
-        cbar = plt.colorbar(im)
-        label = {
-            'elevation': 'Высота (м)',
-            'slope': 'Уклон (градусы)',
-            'shadows': 'Затенение (0-1)',
-            'illumination': 'Освещенность (%)',
-            'ice': 'Вероятность наличия льда (0-1)'
-        }.get(filename_base, '')
-        cbar.set_label(label)
-        plt.axis('off')
+        vmin, vmax = data_range(data)
+        if vmin is None:
+            # Все значения NaN - изображение полностью прозрачное
+            vmin, vmax = 0.0, 1.0
+        lut = colormap_lut(cmap)
+        height, width = data.shape
+        out_height, out_width = -(-height // downsample), -(-width // downsample)
+        # Версия с легендой: каждая step-я строка и столбец (не больше LEGEND_MAX_SIZE по стороне)
+        step = max(1, -(-max(out_height, out_width) // LEGEND_MAX_SIZE))
+        preview = []
+
+        def rendered_blocks():
+            for out_row, block in iter_downsampled(data, downsample, chunk_pixels):
+                rgba = lut[lut_indices(block, vmin, vmax)]
+                if legend:
+                    preview.append(rgba[-out_row % step::step, ::step])
+                yield rgba
+
+        # Сохраняем версию без заголовка и легенды
+        if bare:
+            output_path = IMAGES_DIR / filename
+            write_png_rows(output_path, out_width, out_height, rendered_blocks())
+            print(f"Изображение без легенды сохранено в {output_path} ({out_width}x{out_height})")
+        if not legend:
+            return
+        if not bare:
+            for _ in rendered_blocks():
+                pass
+
+        # Сохраняем версию с заголовком и легендой (объектный API matplotlib - без глобального состояния pyplot)
+        settings = LAYER_RENDER_SETTINGS.get(filename_base, {})
+        title = settings.get('title', filename_base.capitalize())
+        fig = Figure(figsize=(12, 10))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.set_title(f"{title} - {prefix}", pad=20, fontsize=14)
+        ax.imshow(np.concatenate(preview))
+        mappable = ScalarMappable(norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap)
+        cbar = fig.colorbar(mappable, ax=ax)
+        cbar.set_label(settings.get('label', ''))
+        ax.axis('off')
         output_path = LAYERS_DIR / filename
-        plt.savefig(output_path, bbox_inches='tight', pad_inches=0.5, dpi=150)
-        plt.close()
+        fig.savefig(output_path, bbox_inches='tight', pad_inches=0.5, dpi=150)
         print(f"Изображение с легендой сохранено в {output_path}")
 
-        # Сохраняем версию без заголовка и легенды в scripts/output/images
-        plt.figure(figsize=(10, 10))
-        plt.imshow(plot_data, cmap=cmap, vmin=vmin, vmax=vmax)
-        plt.axis('off')
-        output_path = IMAGES_DIR / filename
-        plt.savefig(output_path, bbox_inches='tight', pad_inches=0, dpi=150)
-        plt.close()
-        print(f"Изображение без легенды сохранено в {output_path}")
-
     except Exception as e:
         print(f"Ошибка при создании изображения {filename}: {e}")
 
-def save_elevation_png(data, prefix):
-    save_layer_png(data, "elevation", prefix, cmap='terrain', normalize=False) # DEM обычно имеет свой диапазон
+def save_layers_png(layers_data, prefix, downsample=1, workers=None, bare_layers=None, legend_layers=None,
+                    chunk_pixels=RENDER_CHUNK_PIXELS):
+    """Параллельное сохранение PNG для всех слоев (numpy, zlib и Agg отпускают GIL).
+
+    bare_layers/legend_layers ограничивают набор слоев для каждой версии
+    изображения (None - все слои); chunk_pixels - пикселей на шаг раскраски
+    в каждом потоке.
+    """
+    layers = [
+        (name, data, bare_layers is None or name in bare_layers, legend_layers is None or name in legend_layers)
+        for name, data in layers_data.items()
+    ]
+    layers = [layer for layer in layers if layer[2] or layer[3]]
+    if not layers:
+        return
+    if workers is None:
+        workers = min(len(layers), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(save_layer_png, data, name, prefix,
+                            LAYER_RENDER_SETTINGS[name]['cmap'], downsample, bare, legend, chunk_pixels)
+            for name, data, bare, legend in layers
+        ]
+        for future in futures:
+            future.result()
+
+# --- Пирамида тайлов XYZ ---
+
+def _write_pyramid_tile(level, lut, vmin, vmax, zoom_dir, x, y, tile_size):
+    """Раскраска и сохранение одного тайла пирамиды (краевые тайлы дополняются прозрачным)"""
+    block = level[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+    tile = np.empty((tile_size, tile_size, 4), dtype=np.uint8)
+    tile[:] = lut[LUT_SIZE]
+    tile[:block.shape[0], :block.shape[1]] = lut[lut_indices(block, vmin, vmax)]
+    tile_path = zoom_dir / str(x) / f"{y}.png"
+    tile_path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(tile, 'RGBA').save(tile_path, compress_level=PNG_COMPRESS_LEVEL)
+
+def pyramid_complete(layer_name, prefix, source_key):
+    """Построена ли пирамида слоя для данных с ключом source_key (без чтения данных)"""
+    metadata_path = TILES_DIR / prefix / layer_name / 'pyramid.json'
+    if source_key is None or not metadata_path.is_file():
+        return False
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    return metadata.get("complete", False) and metadata.get("source_key") == source_key
+
+def build_tile_pyramid(data, layer_name, prefix, workers=None, tile_size=PYRAMID_TILE_SIZE, source_key=None):
+    """Пирамида тайлов {z}/{x}/{y}.png для слоя в TILES_DIR/<prefix>/<layer>.
+
+    Максимальный уровень - исходное разрешение, каждый следующий получается
+    уменьшением предыдущего в 2 раза (без повторного чтения источника), на
+    уровне 0 слой помещается в один тайл. Уменьшенные уровни больше
+    RENDER_CHUNK_PIXELS пишутся полосами в memory-mapped файлы во временном
+    каталоге, поэтому память не зависит от размера слоя. Существующая пирамида
+    с теми же параметрами только дополняется недостающими тайлами.
+    """
+    if data is None or data.size == 0:
+        print(f"Данные слоя {layer_name} отсутствуют, пирамида тайлов не строится.")
+        return None
+
+    pyramid_dir = TILES_DIR / prefix / layer_name
+    metadata_path = pyramid_dir / 'pyramid.json'
+    cmap = LAYER_RENDER_SETTINGS[layer_name]['cmap']
+    vmin, vmax = data_range(data)
+    if vmin is None:
+        vmin, vmax = 0.0, 1.0
+    height, width = data.shape
+    max_zoom = max(0, math.ceil(math.log2(max(height, width) / tile_size)))
+    metadata = {
+        "layer": layer_name,
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "min_zoom": 0,
+        "max_zoom": max_zoom,
+        "cmap": cmap,
+        "vmin": vmin,
+        "vmax": vmax,
+        "source_key": source_key,
+    }
+
+    existing = None
+    if metadata_path.is_file():
+        with open(metadata_path) as f:
+            existing = json.load(f)
+        complete = existing.pop("complete", False)
+        if existing != metadata:
+            print(f"Параметры пирамиды {prefix}/{layer_name} изменились, пирамида перестраивается.")
+            shutil.rmtree(pyramid_dir, ignore_errors=True)
+            existing = None
+        elif complete:
+            print(f"Пирамида {prefix}/{layer_name} уже построена.")
+            return pyramid_dir
+    pyramid_dir.mkdir(parents=True, exist_ok=True)
+    with open(metadata_path, 'w') as f:
+        json.dump({**metadata, "complete": False}, f, indent=2)
 
-def save_slope_png(data, prefix):
-    save_layer_png(data, "slope", prefix, cmap='viridis')
+    print(f"Построение пирамиды тайлов {prefix}/{layer_name}: уровни 0-{max_zoom}...")
+    lut = colormap_lut(cmap)
+    written = 0
+    level = data
+    if workers is None:
+        workers = os.cpu_count() or 1
+    work_dir = Path(tempfile.mkdtemp(prefix=f"pyramid_{layer_name}_"))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            written = _write_pyramid_levels(executor, level, lut, vmin, vmax, pyramid_dir, max_zoom, tile_size,
+                                            existing is not None, work_dir)
+    finally:
+        level = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    metadata["complete"] = True
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(f"Пирамида {prefix}/{layer_name} готова, записано тайлов: {written}")
+    return pyramid_dir
+
+def _write_pyramid_levels(executor, level, lut, vmin, vmax, pyramid_dir, max_zoom, tile_size, resume, work_dir):
+    """Тайлы всех уровней пирамиды от max_zoom до 0; возвращает число записанных тайлов"""
+    written = 0
+    level_path = None
+    for zoom in range(max_zoom, -1, -1):
+        zoom_dir = pyramid_dir / str(zoom)
+        tiles_y = -(-level.shape[0] // tile_size)
+        tiles_x = -(-level.shape[1] // tile_size)
+        missing = [
+            (x, y) for x in range(tiles_x) for y in range(tiles_y)
+            if not resume or not (zoom_dir / str(x) / f"{y}.png").is_file()
+        ]
+        futures = [
+            executor.submit(_write_pyramid_tile, level, lut, vmin, vmax, zoom_dir, x, y, tile_size)
+            for x, y in missing
+        ]
+        for future in futures:
+            future.result()
+        written += len(missing)
+        if zoom > 0:
+            shape = (-(-level.shape[0] // 2), -(-level.shape[1] // 2))
+            out = None
+            previous_path, level_path = level_path, None
+            if shape[0] * shape[1] > RENDER_CHUNK_PIXELS:
+                level_path = work_dir / f"{zoom - 1}.npy"
+                out = np.lib.format.open_memmap(level_path, mode='w+', dtype=np.float32, shape=shape)
+            level = downsample_mean(level, 2, out=out)
+            # Предыдущий временный уровень больше не нужен
+            if previous_path is not None:
+                try:
+                    previous_path.unlink()
+                except OSError:
+                    pass  # Удалится вместе с временным каталогом
+    return written
+
+def build_layer_pyramids(layers_data, prefix, workers=None, source_keys=None):
+    """Пирамиды тайлов для всех слоев (тайлы внутри слоя строятся параллельно)"""
+    for layer_name, data in layers_data.items():
+        try:
+            build_tile_pyramid(data, layer_name, prefix, workers=workers,
+                               source_key=(source_keys or {}).get(layer_name))
+        except Exception as e:
+            print(f"Ошибка при построении пирамиды тайлов {layer_name}: {e}")
+
+def save_elevation_png(data, prefix, downsample=1):
+    save_layer_png(data, "elevation", prefix, cmap='terrain', downsample=downsample) # DEM обычно имеет свой диапазон
+
+def save_slope_png(data, prefix, downsample=1):
+    save_layer_png(data, "slope", prefix, cmap='viridis', downsample=downsample)
 
-def save_shadows_png(data, prefix):
-    # Тени (0 или 1), нормализация не нужна, используем бинарную карту
-    save_layer_png(data, "shadows", prefix, cmap='binary', normalize=False) 
+def save_shadows_png(data, prefix, downsample=1):
+    # Тени (0 или 1), используем бинарную карту
+    save_layer_png(data, "shadows", prefix, cmap='binary', downsample=downsample)
 
-def save_illumination_png(data, prefix):
-    save_layer_png(data, "illumination", prefix, cmap='hot')
+def save_illumination_png(data, prefix, downsample=1):
+    save_layer_png(data, "illumination", prefix, cmap='hot', downsample=downsample)
 
-def save_ice_png(data, prefix):
-    save_layer_png(data, "ice", prefix, cmap='Blues', normalize=False)
+def save_ice_png(data, prefix, downsample=1):
+    save_layer_png(data, "ice", prefix, cmap='Blues', downsample=downsample)
+
+# --- Задания обработки и резидентный сервер ---
+
+def run_job(job, progress=None, instrumentation=None):
+    """Выполнение задания обработки.
+
+    Задание - словарь {'id', 'input_file', 'output_prefix', 'options'}, где
+    options - именованные параметры process_image (JOB_OPTIONS). Возвращает
+    событие 'done' с результатом; progress получает события этапов,
+    instrumentation (Instrumentation) включает метрики и профилирование задания.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.metrics(), instrumentation.tracing(), progress_handler(progress):
+        return _run_job(job, instrumentation.profile_dir)
+
+def _run_job(job, profile_dir):
+    job_id = job.get('id')
+    start = time.perf_counter()
+    profiler = cProfile.Profile() if profile_dir is not None else None
+    error = None
+    success = False
+    with job_metrics(job_id, job.get('output_prefix')) as outcome:
+        try:
+            if profiler is not None:
+                profiler.enable()
+            input_file = job.get('input_file')
+            output_prefix = job.get('output_prefix')
+            options = job.get('options') or {}
+            unknown = sorted(set(options) - set(JOB_OPTIONS))
+            if not input_file or not output_prefix:
+                error = "Задание должно содержать input_file и output_prefix"
+            elif unknown:
+                error = f"Неизвестные параметры задания: {', '.join(unknown)}"
+            elif not Path(input_file).is_file():
+                error = f"Входной файл не найден или не является файлом: {input_file}"
+            else:
+                success = process_image(Path(input_file), output_prefix, **options)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profile_dir.mkdir(parents=True, exist_ok=True)
+                profile_name = f"{job.get('output_prefix') or 'job'}_{os.getpid()}_{int(time.time())}.prof"
+                profile_path = profile_dir / profile_name
+                profiler.dump_stats(profile_path)
+                write_metrics({"event": "profile", "path": str(profile_path)})
+            outcome.update(success=bool(success), error=error)
+
+    result = {
+        "event": "done",
+        "id": job_id,
+        "success": bool(success),
+        "output_prefix": job.get('output_prefix'),
+        "elapsed": round(time.perf_counter() - start, 3),
+    }
+    if error:
+        result["error"] = error
+    return result
+
+def warm_up():
+    """Прогрев резидентного процесса: драйверы GDAL, таблицы цветов, шрифты matplotlib"""
+    gdal.UseExceptions()
+    gdal.AllRegister()
+    for settings in LAYER_RENDER_SETTINGS.values():
+        colormap_lut(settings['cmap'])
+    fig = Figure(figsize=(1, 1))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_title("warm-up")
+    fig.colorbar(ScalarMappable(norm=Normalize(0, 1), cmap='viridis'), ax=ax)
+    canvas.draw()
+
+class JobServer:
+    """Резидентный сервер заданий с протоколом JSON-lines.
+
+    Входящие сообщения: {"command": "process", "id", "input_file",
+    "output_prefix", "options"}, {"command": "points", "id", "output_prefix"
+    или "cube", "lonlat" или "pixels"}, {"command": "ping"}, {"command": "shutdown"}.
+    Ответы: accepted, busy, stage/progress (по мере выполнения), done, points, pong, error.
+    Задания выполняются общим пулом потоков; если в очереди уже max_pending
+    заданий, новое отклоняется ответом busy (клиент повторяет его позже), а
+    чтение сообщений не блокируется. Точечные запросы выполняются сразу по
+    открытым кубам слоев.
+    """
+    def __init__(self, max_workers=DEFAULT_SERVER_WORKERS, max_pending=None, instrumentation=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.instrumentation = instrumentation
+        self.max_pending = max_pending or max_workers * 2
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.cubes = {}
+        self.cubes_lock = threading.Lock()
+
+    def handle_line(self, line, emit):
+        """Обработка одной строки протокола; возвращает (продолжать?, future задания или None)"""
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError as e:
+            emit({"event": "error", "error": f"Invalid JSON: {e}"})
+            return True, None
+        if not isinstance(message, dict):
+            emit({"event": "error", "error": "Message must be a JSON object"})
+            return True, None
+
+        command = message.get('command', 'process')
+        if command == 'ping':
+            emit({"event": "pong", "pid": os.getpid()})
+            return True, None
+        if command == 'shutdown':
+            emit({"event": "shutdown"})
+            return False, None
+        if command == 'points':
+            emit(self.points(message))
+            return True, None
+        if command != 'process':
+            emit({"event": "error", "id": message.get('id'), "error": f"Unknown command: {command}"})
+            return True, None
+        return True, self.submit(message, emit)
+
+    def cube(self, path):
+        """Открытый куб слоев (переоткрывается, если файл перезаписан)"""
+        path = Path(path)
+        mtime = path.stat().st_mtime_ns
+        with self.cubes_lock:
+            cached = self.cubes.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, LayerCube(path))
+                self.cubes[path] = cached
+            return cached[1]
+
+    def points(self, message):
+        """Значения всех слоев в точках: lonlat [[lon, lat], ...] или pixels [[x, y], ...]"""
+        request_id = message.get('id')
+        try:
+            path = message.get('cube') or JSON_DIR / f"{message['output_prefix']}_cube.bin"
+            cube = self.cube(path)
+            if 'lonlat' in message:
+                points = np.asarray(message['lonlat'], dtype=np.float64).reshape(-1, 2)
+                values = cube.query_lonlat(points[:, 0], points[:, 1])
+            else:
+                points = np.asarray(message['pixels'], dtype=np.float64).reshape(-1, 2)
+                values = cube.query_pixels(points[:, 0], points[:, 1])
+        except (KeyError, OSError, ValueError) as e:
+            return {"event": "error", "id": request_id, "error": f"{type(e).__name__}: {e}"}
+        # NaN (нет данных или точка вне растра) передается как null
+        rows = [[None if np.isnan(v) else float(v) for v in row] for row in values.tolist()]
+        return {"event": "points", "id": request_id, "layers": cube.layers, "values": rows}
+
+    def submit(self, job, emit):
+        """Постановка задания в пул; при заполненной очереди - ответ busy без ожидания.
+
+        Ожидание свободного места заблокировало бы поток чтения соединения,
+        и ping/points на нем не получали бы ответа до завершения задания.
+        """
+        job_id = job.get('id')
+        if not self.slots.acquire(blocking=False):
+            emit({"event": "busy", "id": job_id, "max_pending": self.max_pending})
+            return None
+        emit({"event": "accepted", "id": job_id})
+
+        def progress(event):
+            emit({**event, "id": job_id})
+
+        def work():
+            try:
+                emit(run_job(job, progress, self.instrumentation))
+            finally:
+                self.slots.release()
+
+        return self.executor.submit(work)
+
+    def serve_stdio(self):
+        """Протокол через stdin/stdout; логи print() перенаправляются в stderr"""
+        out = sys.stdout
+        sys.stdout = sys.stderr
+        lock = threading.Lock()
+
+        def emit(event):
+            with lock:
+                out.write(json.dumps(event, ensure_ascii=False) + "\n")
+                out.flush()
+
+        emit({"event": "ready", "pid": os.getpid(), "transport": "stdio"})
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            keep_running, _ = self.handle_line(line, emit)
+            if not keep_running:
+                break
+        self.executor.shutdown(wait=True)
+
+    def serve_unix(self, socket_path):
+        """Протокол через Unix-сокет: каждое соединение - отдельный поток сообщений"""
+        if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            raise RuntimeError("Unix sockets are not supported on this platform")
+        job_server = self
+        socket_path = Path(socket_path)
+        if socket_path.exists():
+            socket_path.unlink()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lock = threading.Lock()
+
+                def emit(event):
+                    with lock:
+                        try:
+                            self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode('utf-8'))
+                            self.wfile.flush()
+                        except OSError:
+                            pass  # Клиент отключился, задание продолжает выполняться
+
+                futures = []
+                for raw in self.rfile:
+                    line = raw.decode('utf-8')
+                    if not line.strip():
+                        continue
+                    keep_running, future = job_server.handle_line(line, emit)
+                    if future is not None:
+                        futures.append(future)
+                    if not keep_running:
+                        threading.Thread(target=self.server.shutdown, daemon=True).start()
+                        break
+                # Соединение держим открытым, пока не завершатся его задания
+                wait(futures)
+
+        with socketserver.ThreadingUnixStreamServer(str(socket_path), Handler) as server:
+            server.daemon_threads = True
+            print(f"Job server listening on {socket_path} (pid {os.getpid()})")
+            try:
+                server.serve_forever()
+            finally:
+                self.executor.shutdown(wait=True)
+                if socket_path.exists():
+                    socket_path.unlink()
+
+def serve(socket_path=None, max_workers=DEFAULT_SERVER_WORKERS, instrumentation=None):
+    """Запуск резидентного сервера (stdin/stdout или Unix-сокет)"""
+    print("Прогрев сервера заданий...", file=sys.stderr)
+    warm_up()
+    instrumentation = instrumentation or Instrumentation()
+    server = JobServer(max_workers=max_workers, instrumentation=instrumentation)
+    # Трассировка памяти общая на процесс: на время работы сервера, а не отдельных заданий
+    with instrumentation.tracing():
+        if socket_path:
+            server.serve_unix(socket_path)
+        else:
+            server.serve_stdio()
+
+# --- Пакетный режим ---
+
+def default_batch_memory_mb():
+    """Бюджет памяти пакета по умолчанию: 75% физической памяти (4 ГБ, если узнать не удалось)"""
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 4096
+    return max(1024, int(total * 0.75 / 1024 / 1024))
+
+def load_batch_jobs(source, options=None):
+    """Список заданий пакета из каталога или манифеста.
+
+    Каталог: все GeoTIFF, префикс - имя файла без расширения.
+    Манифест .json/.jsonl: объекты {"input_file", "output_prefix", "options"}
+    (список или по одному на строку); иначе текст "путь [префикс]" по строкам,
+    # - комментарий. Относительные пути считаются от каталога манифеста.
+    Параметры options манифеста дополняют общие параметры пакета.
+    """
+    source = Path(source)
+    options = options or {}
+    if source.is_dir():
+        files = sorted({path for pattern in BATCH_INPUT_PATTERNS for path in source.glob(pattern)})
+        entries = [{"input_file": str(path), "output_prefix": path.stem} for path in files]
+    elif source.suffix.lower() in ('.json', '.jsonl'):
+        with open(source, encoding='utf-8') as f:
+            if source.suffix.lower() == '.json':
+                entries = json.load(f)
+            else:
+                entries = [json.loads(line) for line in f if line.strip()]
+    else:
+        entries = []
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                entries.append({"input_file": parts[0],
+                                "output_prefix": parts[1] if len(parts) > 1 else Path(parts[0]).stem})
+
+    base_dir = source if source.is_dir() else source.parent
+    jobs = []
+    for index, entry in enumerate(entries):
+        input_file = Path(entry["input_file"])
+        if not input_file.is_absolute():
+            input_file = base_dir / input_file
+        jobs.append({
+            "id": entry.get("id", index),
+            "input_file": str(input_file),
+            "output_prefix": entry.get("output_prefix") or input_file.stem,
+            "options": {**options, **(entry.get("options") or {})},
+        })
+    return jobs
+
+def estimate_job_memory_mb(ds, options):
+    """Оценка пиковой памяти задания по размеру растра и числу каналов"""
+    if options.get('streaming'):
+        return options.get('memory_budget_mb', DEFAULT_MEMORY_BUDGET_MB) + BATCH_BASE_MEMORY_MB
+    pixels = ds.RasterXSize * ds.RasterYSize
+    if options.get('roi') is not None or options.get('roi_lonlat') is not None:
+        try:
+            x0, y0, x1, y1 = resolve_roi(ds, options.get('roi'), options.get('roi_lonlat'))
+            pixels = (x1 - x0) * (y1 - y0)
+        except (TypeError, ValueError):
+            pass  # Ошибку области сообщит само задание
+    per_pixel = ds.RasterCount * 4 + IN_MEMORY_BYTES_PER_PIXEL
+    return math.ceil(pixels * per_pixel / 1024 / 1024) + BATCH_BASE_MEMORY_MB
+
+def _batch_fingerprint(job):
+    """Отпечаток задания для возобновления: вход (путь, размер, время изменения), префикс, параметры"""
+    stat = Path(job["input_file"]).stat()
+    return cache_digest(str(Path(job["input_file"]).resolve()), stat.st_size, stat.st_mtime_ns,
+                         job["output_prefix"], json.dumps(job["options"], sort_keys=True))
+
+def _load_batch_journal(journal_path):
+    """Успешно завершенные задания из журнала пакета: отпечаток -> запись"""
+    done = {}
+    if not journal_path.is_file():
+        return done
+    with open(journal_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Недописанная строка прерванного пакета
+            if record.get("success") and record.get("fingerprint"):
+                done[record["fingerprint"]] = record
+    return done
+
+def run_batch(jobs, workers=None, memory_budget_mb=None, report_path=None, resume=False, instrumentation=None):
+    """Обработка пакета файлов пулом процессов с допуском заданий по оценке памяти.
+
+    Задание запускается, только если его оценка помещается в остаток бюджета;
+    крупные растры при этом не выполняются одновременно, а мелкие могут
+    обгонять их в очереди. Задание больше всего бюджета выполняется в одиночку.
+    Каждое завершение дописывается в журнал (<отчет>.journal.jsonl); с resume
+    успешно обработанные и не изменившиеся файлы пропускаются. Итоговый отчет
+    с пропускной способностью по файлам пишется в report_path.
+    """
+    workers = workers or os.cpu_count() or 1
+    memory_budget_mb = memory_budget_mb or default_batch_memory_mb()
+    report_path = Path(report_path or JSON_DIR / 'batch_report.json')
+    journal_path = report_path.with_suffix('.journal.jsonl')
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    if not resume and journal_path.exists():
+        journal_path.unlink()
+    completed = _load_batch_journal(journal_path) if resume else {}
+
+    results = []
+    pending = []
+    for job in jobs:
+        record = {"id": job["id"], "input_file": job["input_file"], "output_prefix": job["output_prefix"]}
+        try:
+            ds = gdal.Open(job["input_file"])
+            if ds is None:
+                raise RuntimeError("gdal.Open returned None")
+            record.update(width=ds.RasterXSize, height=ds.RasterYSize, bands=ds.RasterCount,
+                          input_mb=round(Path(job["input_file"]).stat().st_size / 1024 / 1024, 3),
+                          memory_mb=estimate_job_memory_mb(ds, job["options"]),
+                          fingerprint=_batch_fingerprint(job))
+            ds = None
+        except (RuntimeError, OSError) as e:
+            record.update(success=False, error=f"{type(e).__name__}: {e}")
+            print(f"Пакет: не удалось открыть {job['input_file']}: {e}")
+            results.append(record)
+            continue
+        if record["fingerprint"] in completed:
+            results.append({**completed[record["fingerprint"]], "id": job["id"], "resumed": True})
+            continue
+        if "render_workers" not in job["options"]:
+            # Потоки отрисовки делят процессоры между процессами пакета
+            job["options"]["render_workers"] = max(1, (os.cpu_count() or 1) // workers)
+        pending.append((job, record))
+
+    print(f"Пакет: заданий {len(jobs)}, к обработке {len(pending)}, "
+          f"процессов {workers}, бюджет памяти {memory_budget_mb} МБ")
+    for job, record in pending:
+        if record["memory_mb"] > memory_budget_mb:
+            print(f"Внимание: {job['input_file']} (~{record['memory_mb']} МБ) больше бюджета пакета, "
+                  f"будет обработан в одиночку")
+
+    batch_start = time.perf_counter()
+    running = {}
+    used_mb = 0
+    executor = ProcessPoolExecutor(max_workers=workers)
+    with open(journal_path, 'a', encoding='utf-8') as journal:
+        def finish(record, result):
+            record.update(success=result["success"], elapsed=result["elapsed"])
+            if result.get("error"):
+                record["error"] = result["error"]
+            if result["elapsed"] > 0:
+                record["megapixels_per_sec"] = round(record["width"] * record["height"] / 1e6 / result["elapsed"], 3)
+                record["input_mb_per_sec"] = round(record["input_mb"] / result["elapsed"], 3)
+            results.append(record)
+            journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+            journal.flush()
+            status = "OK" if record["success"] else f"ОШИБКА ({record.get('error', 'см. лог')})"
+            print(f"Пакет [{len(results)}/{len(jobs)}] {record['output_prefix']}: {status}, {record['elapsed']:.1f} c")
+
+        try:
+            while pending or running:
+                # Допуск заданий: первое по очереди, помещающееся в остаток бюджета
+                while pending and len(running) < workers:
+                    index = next((i for i, (_, record) in enumerate(pending)
+                                  if used_mb + record["memory_mb"] <= memory_budget_mb), None)
+                    if index is None:
+                        if running:
+                            break
+                        index = 0
+                    job, record = pending.pop(index)
+                    used_mb += record["memory_mb"]
+                    running[executor.submit(run_job, job, None, instrumentation)] = (job, record)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job, record = running.pop(future)
+                    used_mb -= record["memory_mb"]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # Процесс аварийно завершился (например, убит при нехватке памяти)
+                        broken = True
+                        result = {"success": False, "elapsed": 0.0,
+                                  "error": "Worker process terminated abruptly"}
+                    finish(record, result)
+                if broken:
+                    # Пул после аварии непригоден: его задания тоже потеряны, очередь идет в новый
+                    for future, (job, record) in running.items():
+                        finish(record, {"success": False, "elapsed": 0.0,
+                                        "error": "Worker process terminated abruptly"})
+                    running = {}
+                    used_mb = 0
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+        finally:
+            executor.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - batch_start
+    order = {job["id"]: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda record: order.get(record["id"], len(order)))
+    processed = [r for r in results if r.get("success") and not r.get("resumed")]
+    megapixels = sum(r["width"] * r["height"] for r in processed) / 1e6
+    summary = {
+        "jobs": len(jobs),
+        "succeeded": sum(1 for r in results if r.get("success")),
+        "failed": sum(1 for r in results if not r.get("success")),
+        "resumed": sum(1 for r in results if r.get("resumed")),
+        "workers": workers,
+        "memory_budget_mb": memory_budget_mb,
+        "elapsed": round(elapsed, 3),
+        "megapixels_per_sec": round(megapixels / elapsed, 3) if elapsed > 0 else None,
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"summary": summary, "files": results}, f, indent=2, ensure_ascii=False)
+
+    print(f"\nПакет завершен за {elapsed:.1f} c: успешно {summary['succeeded']}, "
+          f"с ошибками {summary['failed']}, пропущено (возобновление) {summary['resumed']}")
+    print(f"Отчет пакета: {report_path}")
+    return summary["failed"] == 0
 
 # --- Основной блок --- 
 
-def main(input_file_arg: str, output_prefix_arg: str):
-    """Основной скрипт"""
+def main(input_file_arg: str, output_prefix_arg: str, instrumentation=None, **options):
+    """Основной скрипт (клиент run_job для одного файла)"""
     print("Запуск основного скрипта...")
-    input_file_path = Path(input_file_arg)
-    
-    if not input_file_path.is_file():
-        print(f"Ошибка: Входной файл не найден или не является файлом: {input_file_path}")
-        return False
-        
-    print(f"Получен файл: {input_file_path}")
+    print(f"Получен файл: {Path(input_file_arg)}")
     print(f"Получен префикс: {output_prefix_arg}")
 
     # Запускаем обработку для одного файла
-    success = process_image(input_file_path, output_prefix_arg)
+    result = run_job({"input_file": input_file_arg, "output_prefix": output_prefix_arg, "options": options},
+                     instrumentation=instrumentation)
+    success = result["success"]
 
     if success:
         print("\nОбработка файла завершена успешно!")
         print(f"Результаты сохранены в: {JSON_DIR} и {LAYERS_DIR}")
     else:
+        if result.get("error"):
+            print(f"Ошибка: {result['error']}")
         print("\nОбработка файла завершена с ошибками.")
 
     return success
@@ -444,17 +2025,137 @@ def main(input_file_arg: str, output_prefix_arg: str):
 if __name__ == '__main__':
     # --- ИЗМЕНЕНО: Парсинг аргументов командной строки --- 
     parser = argparse.ArgumentParser(description='Обработка TIFF файла для создания слоев и JSON тайлов.')
-    parser.add_argument('input_file', type=str, help='Путь к входному TIFF файлу.')
-    parser.add_argument('output_prefix', type=str, help='Префикс для имен выходных файлов.')
+    parser.add_argument('input_file', type=str, nargs='?', help='Путь к входному TIFF файлу.')
+    parser.add_argument('output_prefix', type=str, nargs='?', help='Префикс для имен выходных файлов.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Запустить резидентный сервер заданий (JSON-lines через stdin/stdout или --socket).')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Путь к Unix-сокету сервера заданий (вместо stdin/stdout).')
+    parser.add_argument('--workers', type=int, default=DEFAULT_SERVER_WORKERS,
+                        help=f'Число одновременно выполняемых заданий сервера (по умолчанию {DEFAULT_SERVER_WORKERS}).')
+    parser.add_argument('--batch', type=str, default=None,
+                        help='Пакетная обработка: каталог с GeoTIFF или манифест (.json, .jsonl или текст "путь [префикс]").')
+    parser.add_argument('--batch-workers', type=int, default=None,
+                        help='Число процессов пакетной обработки (по умолчанию число процессоров).')
+    parser.add_argument('--batch-memory', type=int, default=None,
+                        help='Бюджет памяти пакета в МБ для допуска заданий (по умолчанию 75%% физической памяти).')
+    parser.add_argument('--batch-report', type=str, default=None,
+                        help='Путь к отчету пакета (по умолчанию output/json/batch_report.json).')
+    parser.add_argument('--resume', action='store_true',
+                        help='Продолжить прерванный пакет, пропуская уже обработанные файлы.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Потоковая обработка полосами для растров, не помещающихся в память.')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help=f'Бюджет памяти потокового режима в МБ (по умолчанию {DEFAULT_MEMORY_BUDGET_MB}).')
+    parser.add_argument('--tiles', type=int, default=DEFAULT_NUM_TILES,
+                        help=f'Число тайлов по каждой оси (по умолчанию {DEFAULT_NUM_TILES}).')
+    parser.add_argument('--include-edges', action='store_true',
+                        help='Присоединять остаток строк/столбцов к последним тайлам вместо отбрасывания.')
+    parser.add_argument('--tile-std', action='store_true',
+                        help='Добавить стандартное отклонение в статистику тайлов.')
+    parser.add_argument('--png-downsample', type=int, default=1,
+                        help='Уменьшение PNG без легенды в N раз (по умолчанию исходное разрешение).')
+    parser.add_argument('--render-workers', type=int, default=None,
+                        help='Число потоков для параллельной отрисовки слоев.')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='Построить пирамиды тайлов XYZ (256x256) для слоев в output/tiles.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Использовать кэш результатов (слои и выходные файлы по ключу содержимого).')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help=f'Каталог кэша результатов (по умолчанию {CACHE_DIR}).')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'Максимальный размер кэша в МБ (по умолчанию {DEFAULT_CACHE_SIZE_MB}).')
+    parser.add_argument('--area-index', action='store_true',
+                        help='Построить индекс площадных запросов (интегральные изображения, пирамиды min/max).')
+    parser.add_argument('--area-layers', type=str, default=None,
+                        help='Слои индекса площадных запросов через запятую (по умолчанию - все слои).')
+    parser.add_argument('--layer-cube', action='store_true',
+                        help='Записать куб слоев для точечных запросов (<prefix>_cube.bin).')
+    parser.add_argument('--sites', type=int, default=0,
+                        help='Найти N лучших непересекающихся площадок (<prefix>_sites.json).')
+    parser.add_argument('--site-footprint', type=int, default=DEFAULT_SITE_FOOTPRINT,
+                        help=f'Сторона окна площадки в пикселях (по умолчанию {DEFAULT_SITE_FOOTPRINT}).')
+    parser.add_argument('--site-model', type=str, default=None,
+                        help='Параметры модели площадки через запятую, например slope_max=10,ice_weight=0.6 '
+                             f'(доступны: {", ".join(SITE_MODEL)}).')
+    parser.add_argument('--roi', type=str, default=None,
+                        help='Обработать только область интереса в пикселях исходного растра: x0,y0,x1,y1.')
+    parser.add_argument('--roi-lonlat', type=str, default=None,
+                        help='Область интереса в географических координатах: lon_min,lat_min,lon_max,lat_max.')
+    parser.add_argument('--cog', action='store_true',
+                        help='Экспорт слоев в Cloud-Optimized GeoTIFF (layers/<prefix>_layers_f32.tif и _u8.tif).')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Файл для метрик этапов в формате JSON-lines (- для stderr).')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Каталог для профилей cProfile каждого задания (.prof).')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Трассировка памяти Python (tracemalloc): пик выделений по этапам.')
+    parser.add_argument('--tile-percentiles', type=str, default=None,
+                        help='Перцентили для статистики тайлов через запятую, например 10,50,90.')
+    parser.add_argument('--ice-model', type=str, default=None,
+                        help='Параметры модели льда через запятую, например slope_max=7,elevation_weight=0.2 '
+                             f'(доступны: {", ".join(ICE_MODEL)}).')
     
     args = parser.parse_args()
+    if args.tiles < 1:
+        parser.error(f'--tiles должно быть не меньше 1: {args.tiles}')
     # --- КОНЕЦ ИЗМЕНЕНИЯ --- 
-    
-    print(f"Запуск скрипта с аргументами: input_file='{args.input_file}', output_prefix='{args.output_prefix}'")
+
+    instrumentation = Instrumentation(args.metrics, args.profile, args.trace_memory)
+
+    if args.serve:
+        try:
+            serve(socket_path=args.socket, max_workers=args.workers, instrumentation=instrumentation)
+            sys.exit(0)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if not args.batch and (not args.input_file or not args.output_prefix):
+        parser.error('input_file и output_prefix обязательны (или используйте --serve / --batch)')
+
+    print_directories()
 
     try:
         # Передаем аргументы в main
-        success = main(args.input_file, args.output_prefix)
+        tile_percentiles = None
+        if args.tile_percentiles:
+            tile_percentiles = [float(q) for q in args.tile_percentiles.split(',') if q.strip()]
+        ice_model = None
+        if args.ice_model:
+            ice_model = {}
+            for item in args.ice_model.split(','):
+                if item.strip():
+                    name, _, value = item.partition('=')
+                    ice_model[name.strip()] = float(value)
+        site_model = None
+        if args.site_model:
+            site_model = {}
+            for item in args.site_model.split(','):
+                if item.strip():
+                    name, _, value = item.partition('=')
+                    site_model[name.strip()] = float(value)
+        area_layers = [name.strip() for name in args.area_layers.split(',') if name.strip()] if args.area_layers else None
+        roi = [int(value) for value in args.roi.split(',')] if args.roi else None
+        roi_lonlat = [float(value) for value in args.roi_lonlat.split(',')] if args.roi_lonlat else None
+        options = dict(streaming=args.streaming,
+                       memory_budget_mb=args.memory_budget, num_tiles=args.tiles,
+                       include_edges=args.include_edges, tile_std=args.tile_std,
+                       tile_percentiles=tile_percentiles, png_downsample=args.png_downsample,
+                       render_workers=args.render_workers, pyramid=args.pyramid,
+                       use_cache=args.cache, cache_dir=args.cache_dir, cache_size_mb=args.cache_size,
+                       ice_model=ice_model, area_index=args.area_index, layer_cube=args.layer_cube,
+                       sites=args.sites, site_footprint=args.site_footprint, site_model=site_model,
+                       roi=roi, roi_lonlat=roi_lonlat, cog=args.cog, area_layers=area_layers)
+        if args.batch:
+            print(f"Запуск пакетной обработки: {args.batch}")
+            if options['render_workers'] is None:
+                del options['render_workers']
+            success = run_batch(load_batch_jobs(args.batch, options), workers=args.batch_workers,
+                                memory_budget_mb=args.batch_memory, report_path=args.batch_report,
+                                resume=args.resume, instrumentation=instrumentation)
+        else:
+            print(f"Запуск скрипта с аргументами: input_file='{args.input_file}', output_prefix='{args.output_prefix}'")
+            success = main(args.input_file, args.output_prefix, instrumentation=instrumentation, **options)
         print(f"--- Python Script End (Success: {success}) ---")
         sys.exit(0 if success else 1)
     except Exception as e:
@@ -0,0 +1,239 @@
+"""Этапы обработки, прогресс и метрики заданий.
+
+События прогресса передаются обработчику текущего задания, метрики этапов -
+в поток JSON-lines, открытый на время задания. Обработчик и поток задаются
+в контекстных переменных, поэтому задания сервера в разных потоках не
+смешиваются.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from tqdm import tqdm
+
+try:
+    import resource  # Пиковый RSS (только Unix)
+except ImportError:
+    resource = None
+
+# Обработчик событий прогресса текущего задания (задается сервером для каждого потока)
+_progress_callback = contextvars.ContextVar('progress_callback', default=None)
+# Задание, к которому относятся метрики этапов текущего потока
+_job_info = contextvars.ContextVar('job_info', default=None)
+# Пики tracemalloc вложенных этапов (сброс пика во вложенном этапе не теряет пик внешнего)
+_tracemalloc_peaks = contextvars.ContextVar('tracemalloc_peaks', default=())
+# Поток метрик текущего задания (задается Instrumentation.metrics() на время задания)
+_metrics_writer = contextvars.ContextVar('metrics_writer', default=None)
+
+@contextlib.contextmanager
+def progress_handler(callback):
+    """Обработчик событий прогресса (None - консоль) на время блока в текущем контексте"""
+    token = _progress_callback.set(callback)
+    try:
+        yield
+    finally:
+        _progress_callback.reset(token)
+
+def emit_progress(event):
+    """Передача события прогресса обработчику текущего задания, если он задан"""
+    callback = _progress_callback.get()
+    if callback is not None:
+        callback(event)
+
+def progress_iter(items, stage, desc=None):
+    """Итерация с индикатором: tqdm в консоли, события progress для заданий сервера"""
+    if _progress_callback.get() is None:
+        yield from tqdm(items, desc=desc)
+        return
+    total = max(1, len(items))
+    for index, item in enumerate(items):
+        yield item
+        emit_progress({"event": "progress", "stage": stage, "percent": round(100 * (index + 1) / total, 1)})
+
+# Инструментирование: файл метрик JSON-lines ('-' - stderr), каталог профилей cProfile,
+# трассировка памяти Python. Настройки (Instrumentation) передаются заданиям явно.
+class MetricsWriter:
+    """Запись событий метрик в JSON-lines (файл в режиме дозаписи или stderr); контекстный менеджер"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path == '-':
+            self.stream = sys.stderr
+        else:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.stream = open(path, 'a', buffering=1, encoding='utf-8')
+
+    def write(self, event):
+        line = json.dumps({"ts": round(time.time(), 3), "pid": os.getpid(), **event}, ensure_ascii=False)
+        with self.lock:
+            if self.stream is None:
+                return
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def close(self):
+        """Закрытие файла метрик (stderr остается открытым)"""
+        with self.lock:
+            if self.stream is not None and self.stream is not sys.stderr:
+                self.stream.close()
+            self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Instrumentation:
+    """Настройки инструментирования: метрики этапов, профили cProfile, трассировка памяти.
+
+    Передаются явно в run_job, сервер и процессы пакета (объект сериализуется);
+    файл метрик открывается на время задания и закрывается по его завершении.
+    """
+    def __init__(self, metrics_path=None, profile_dir=None, trace_memory=False):
+        self.metrics_path = str(metrics_path) if metrics_path else None
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.trace_memory = bool(trace_memory)
+
+    @contextlib.contextmanager
+    def metrics(self):
+        """Поток метрик задания на время блока в текущем контексте (None, если метрики не включены)"""
+        if self.metrics_path is None:
+            yield None
+            return
+        with MetricsWriter(self.metrics_path) as writer:
+            token = _metrics_writer.set(writer)
+            try:
+                yield writer
+            finally:
+                _metrics_writer.reset(token)
+
+    @contextlib.contextmanager
+    def tracing(self):
+        """Трассировка памяти на время блока (не останавливает уже идущую трассировку)"""
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if started:
+                tracemalloc.stop()
+
+_gdal_bytes_read = 0
+_gdal_bytes_lock = threading.Lock()
+
+def write_metrics(event):
+    """Событие метрик в поток метрик (если он настроен) с привязкой к текущему заданию"""
+    writer = _metrics_writer.get()
+    if writer is None:
+        return
+    job = _job_info.get()
+    if job:
+        event = {**job, **event}
+    writer.write(event)
+
+def count_gdal_read(nbytes):
+    """Учет байт, прочитанных из GDAL (счетчик на процесс)"""
+    global _gdal_bytes_read
+    with _gdal_bytes_lock:
+        _gdal_bytes_read += nbytes
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - КБ, macOS - байты
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _io_read_bytes():
+    """Байты, фактически прочитанные процессом с диска (Linux)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def resource_sample():
+    """Замер ресурсов процесса: время, процессорное время, пиковый RSS, прочитанные байты"""
+    return {
+        "wall": time.perf_counter(),
+        "cpu": time.process_time(),
+        "peak_rss": _peak_rss_bytes(),
+        "gdal_bytes": _gdal_bytes_read,
+        "io_bytes": _io_read_bytes(),
+    }
+
+def resource_delta(start):
+    """Метрики между двумя замерами ресурсов; счетчики процесса общие для параллельных заданий"""
+    end = resource_sample()
+    metrics = {
+        "elapsed": round(end["wall"] - start["wall"], 3),
+        "cpu": round(end["cpu"] - start["cpu"], 3),
+        "gdal_bytes_read": end["gdal_bytes"] - start["gdal_bytes"],
+    }
+    if end["peak_rss"] is not None:
+        metrics["peak_rss_mb"] = round(end["peak_rss"] / 1024 / 1024, 1)
+        metrics["peak_rss_delta_mb"] = round((end["peak_rss"] - start["peak_rss"]) / 1024 / 1024, 1)
+    if end["io_bytes"] is not None and start["io_bytes"] is not None:
+        metrics["io_read_bytes"] = end["io_bytes"] - start["io_bytes"]
+    return metrics
+
+@contextlib.contextmanager
+def pipeline_stage(name):
+    """Этап конвейера: события start/end с метриками этапа.
+
+    Событие end содержит время (elapsed), процессорное время (cpu), пиковый
+    RSS и его прирост за этап, байты, прочитанные из GDAL и с диска, а при
+    трассировке памяти - пик выделений Python; оно же пишется в поток метрик.
+    """
+    emit_progress({"event": "stage", "stage": name, "status": "start"})
+    tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')  # reset_peak: Python 3.9+
+    peaks_token = None
+    if tracing:
+        # Пик внешнего этапа до сброса сохраняем в стеке
+        peaks = _tracemalloc_peaks.get()
+        if peaks:
+            peaks = peaks[:-1] + (max(peaks[-1], tracemalloc.get_traced_memory()[1]),)
+        peaks_token = _tracemalloc_peaks.set(peaks + (0,))
+        tracemalloc.reset_peak()
+    start = resource_sample()
+    try:
+        yield
+    finally:
+        metrics = resource_delta(start)
+        if tracing:
+            stack = _tracemalloc_peaks.get()
+            peak = max(stack[-1], tracemalloc.get_traced_memory()[1])
+            # Пик внешнего этапа до сброса есть только в текущем стеке, reset() вернет прежний
+            _tracemalloc_peaks.reset(peaks_token)
+            outer = stack[:-1]
+            if outer:
+                _tracemalloc_peaks.set(outer[:-1] + (max(outer[-1], peak),))
+            metrics["python_peak_mb"] = round(peak / 1024 / 1024, 1)
+        emit_progress({"event": "stage", "stage": name, "status": "end", **metrics})
+        write_metrics({"event": "stage", "stage": name, **metrics})
+
+@contextlib.contextmanager
+def job_metrics(job_id, output_prefix):
+    """Метрики задания: события этапов блока относятся к заданию, в конце - событие job.
+
+    Блок получает словарь итога {"success", "error"} и заполняет его.
+    """
+    token = _job_info.set({"id": job_id, "output_prefix": output_prefix})
+    sample = resource_sample()
+    outcome = {"success": False, "error": None}
+    try:
+        yield outcome
+    finally:
+        write_metrics({"event": "job", **outcome, **resource_delta(sample)})
+        _job_info.reset(token)
@@ -0,0 +1,240 @@
+"""Кэш результатов image_processor по содержимому (слои .npy и выходные файлы)."""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from instrumentation import emit_progress
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+
+# Кэш результатов (слои и выходные файлы по ключу содержимого)
+CACHE_DIR = Path(os.environ.get('IMAGE_PROCESSOR_CACHE_DIR', SCRIPT_DIR / 'cache'))
+DEFAULT_CACHE_SIZE_MB = 4096
+# Запись больше этой доли размера кэша не сохраняется: она вытеснила бы все остальные
+CACHE_MAX_ENTRY_SHARE = 0.25
+# Меняется при изменении формата или алгоритмов, чтобы не использовать устаревшие записи
+CACHE_VERSION = 1
+
+def cache_digest(*parts):
+    """Ключ кэша: sha256 от канонического JSON частей ключа"""
+    payload = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """Кэш результатов по содержимому: ключ = хэш входного растра + параметры обработки.
+
+    Каждый слой (.npy) и каждый выходной файл хранится отдельной записью.
+    Размер ограничен max_size_mb: при превышении удаляются записи, к которым
+    дольше всего не обращались (время доступа - mtime файла записи). Записи
+    больше CACHE_MAX_ENTRY_SHARE от max_size_mb не сохраняются. Выходные файлы
+    сохраняются и восстанавливаются копиями: записи кэша не разделяют данные
+    с файлами пользователя.
+    """
+    def __init__(self, root=CACHE_DIR, max_size_mb=DEFAULT_CACHE_SIZE_MB):
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key, suffix):
+        return self.objects_dir / key[:2] / f"{key}{suffix}"
+
+    def accepts(self, nbytes, name):
+        """Помещается ли запись размером nbytes в кэш (иначе сообщение и False)"""
+        limit = self.max_size * CACHE_MAX_ENTRY_SHARE
+        if nbytes <= limit:
+            return True
+        print(f"Кэш: {name} ({nbytes / 1024 / 1024:.1f} МБ) больше {limit / 1024 / 1024:.1f} МБ, не сохраняется")
+        return False
+
+    @staticmethod
+    def _copy(src_path, dest_path):
+        """Копия файла (атомарно через временное имя)"""
+        tmp_path = Path(dest_path).with_name(f"{Path(dest_path).name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            shutil.copyfile(src_path, tmp_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        os.replace(tmp_path, dest_path)
+
+    def _record(self, kind, key, hit):
+        """Учет решения кэша: счетчики, сообщение в лог и событие прогресса"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        print(f"Кэш {'HIT ' if hit else 'MISS'} {kind} {key[:12]}")
+        emit_progress({"event": "cache", "kind": kind, "key": key, "hit": hit})
+
+    def input_digest(self, path):
+        """sha256 содержимого входного файла (запоминается по пути, размеру и времени изменения)"""
+        path = Path(path).resolve()
+        memo_key = self._digest_memo_key(path)
+        memo_path = self.root / 'digests.json'
+        memo = self._load_digests()
+        if memo_key in memo:
+            return memo[memo_key]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                digest.update(chunk)
+        memo[memo_key] = digest.hexdigest()
+        self._write_json(memo_path, memo)
+        return memo[memo_key]
+
+    @staticmethod
+    def _digest_memo_key(path):
+        stat = os.stat(path)
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _load_digests(self):
+        memo_path = self.root / 'digests.json'
+        if memo_path.is_file():
+            try:
+                with open(memo_path) as f:
+                    return json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass
+        return {}
+
+    def _prune_digests(self):
+        """Удаление из digests.json хэшей файлов, которых больше нет или которые изменились"""
+        memo = self._load_digests()
+        current = {}
+        for memo_key, digest in memo.items():
+            path = memo_key.rsplit(':', 2)[0]
+            try:
+                if self._digest_memo_key(path) == memo_key:
+                    current[memo_key] = digest
+            except OSError:
+                pass
+        if len(current) < len(memo):
+            self._write_json(self.root / 'digests.json', current)
+
+    def load_array(self, key, mmap=False):
+        """Слой из кэша (np.ndarray или memmap только для чтения) или None"""
+        path = self._path(key, '.npy')
+        if not path.is_file():
+            self._record('layer', key, False)
+            return None
+        os.utime(path)
+        self._record('layer', key, True)
+        if mmap:
+            return np.load(path, mmap_mode='r')
+        return np.load(path)
+
+    def store_array(self, key, data):
+        """Сохранение слоя (атомарно через временный файл)"""
+        if not self.accepts(data.nbytes, f"слой {key[:12]}"):
+            return
+        path = self._path(key, '.npy')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+
+    def adopt_array(self, key, data):
+        """Перенос memmap-слоя (.npy) в кэш без копирования данных; возвращает memmap из кэша.
+
+        Слишком большой для кэша слой остается на месте (возвращается data).
+        """
+        if not self.accepts(data.nbytes, f"слой {key[:12]}"):
+            return data
+        path = self._path(key, '.npy')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data.flush()
+        try:
+            os.replace(data.filename, path)
+        except OSError:
+            # Другая файловая система - копируем
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            shutil.copyfile(data.filename, tmp_path)
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def restore(self, key, dest_path, kind='file'):
+        """Выходной файл из кэша в dest_path (копия); False, если записи нет"""
+        path = self._path(key, Path(dest_path).suffix)
+        Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # Время доступа обновляется только у записи кэша, не у файла пользователя
+            os.utime(path)
+            self._copy(path, dest_path)
+        except FileNotFoundError:
+            # Записи нет или ее только что вытеснил другой процесс
+            self._record(kind, key, False)
+            return False
+        self._record(kind, key, True)
+        return True
+
+    def store_file(self, key, src_path):
+        """Сохранение копии выходного файла в кэш"""
+        if not self.accepts(Path(src_path).stat().st_size, Path(src_path).name):
+            return
+        path = self._path(key, Path(src_path).suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._copy(src_path, path)
+
+    def evict(self):
+        """Удаление давно не использовавшихся записей сверх max_size и устаревших хэшей входных файлов"""
+        entries = []
+        for path in self.objects_dir.glob('*/*'):
+            if path.suffix == '.tmp':
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            print(f"Кэш: удалено записей: {evicted}, размер {total / 1024 / 1024:.1f} МБ")
+        self._prune_digests()
+
+    def report(self):
+        """Итог по кэшу для текущей обработки и накопительная статистика попаданий"""
+        lookups = self.hits + self.misses
+        stats_path = self.root / 'stats.json'
+        totals = {"hits": 0, "misses": 0}
+        if stats_path.is_file():
+            try:
+                with open(stats_path) as f:
+                    totals.update(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                pass
+        totals["hits"] += self.hits
+        totals["misses"] += self.misses
+        self._write_json(stats_path, totals)
+
+        rate = self.hits / lookups if lookups else 0.0
+        total_lookups = totals["hits"] + totals["misses"]
+        total_rate = totals["hits"] / total_lookups if total_lookups else 0.0
+        print(f"Кэш: попаданий {self.hits} из {lookups} ({rate:.0%}), всего {total_rate:.0%}")
+        emit_progress({"event": "cache_summary", "hits": self.hits, "misses": self.misses,
+                       "hit_rate": round(rate, 3), "total_hit_rate": round(total_rate, 3)})
+
+    def _write_json(self, path, data):
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
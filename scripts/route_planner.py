@@ -0,0 +1,960 @@
+"""Маршруты по производным слоям image_processor (куб слоев, --layer-cube).
+
+Стоимость прохода ячейки считается по уклону, постоянной тени и
+освещенности; ячейки круче max_slope непроходимы. Поиск - Дейкстра/A*
+на куче по 8-связной сетке, в том числе от нескольких источников сразу.
+Для больших мозаик маршрут сначала ищется на грубом уровне пирамиды
+стоимостей, затем на каждом более детальном уровне уточняется только
+внутри коридора вокруг найденного пути. Узлы грубых уровней - связные
+компоненты проходимых пикселей блока, а ребра между ними есть только
+там, где через границу блоков переходят соседние проходимые пиксели:
+грубые уровни не теряют тонких препятствий и не придумывают проходов.
+Графы больше бюджета памяти не строятся. Пирамида стоимостей и поля
+стоимости-расстояния от постоянных объектов (баз, посадочных площадок)
+хранятся в кэше результатов image_processor.
+"""
+import os
+import sys
+import math
+import json
+import heapq
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from containers import DEFAULT_MEMORY_BUDGET_MB, LayerCube, iter_shape_windows
+from georef import lonlat_from_projected_transform, lonlat_to_pixels, pixels_to_lonlat, projected_from_lonlat_transform
+from instrumentation import pipeline_stage
+from result_cache import CACHE_DIR, DEFAULT_CACHE_SIZE_MB, ResultCache, cache_digest
+
+# Модель стоимости прохода: 1 + штрафы (все штрафы неотрицательны, поэтому стоимость >= 1)
+ROUTE_COST_MODEL = {
+    'max_slope': 25.0,          # градусы; круче - непроходимо
+    'slope_weight': 4.0,        # штраф slope_weight * (slope / max_slope)^2
+    'shadow_weight': 2.0,       # штраф за пиксель в постоянной тени
+    'darkness_weight': 1.0,     # штраф darkness_weight * (1 - освещенность / illumination_max)
+    'illumination_max': 0.0,    # 0 - максимум слоя освещенности
+}
+# Меняется при изменении формулы стоимости или построения пирамиды
+ROUTE_COST_VERSION = 2
+# Поиск начинается с уровня пирамиды, у которого большая сторона не больше этого размера
+ROUTE_COARSE_SIZE = 256
+# Полуширина коридора уточнения в ячейках уточняемого уровня
+ROUTE_CORRIDOR_RADIUS = 2
+# Надбавка к весу ребра грубого уровня за узкий проход:
+# вес * (1 + ROUTE_CROSSING_WEIGHT * (1 - доля проходимых пар пикселей на границе ячеек))
+ROUTE_CROSSING_WEIGHT = 0.5
+# Оценка памяти графа поиска на узел (массивы построения, списки соседей, расстояния, куча);
+# граф больше бюджета памяти не строится
+ROUTE_BYTES_PER_NODE = 2048
+
+SQRT2 = math.sqrt(2.0)
+# 8-связность: (dy, dx, длина шага в ячейках)
+NEIGHBORS = tuple((dy, dx, SQRT2 if dy and dx else 1.0)
+                  for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx)
+# Уровень 1: массив пар пикселей для перехода (dy, dx) и сдвиг ячейки, в которой хранится число пар
+CROSSING_ANCHORS = {
+    (0, 1): ('e', 0, 0), (0, -1): ('e', 0, -1),
+    (1, 0): ('s', 0, 0), (-1, 0): ('s', -1, 0),
+    (1, 1): ('se', 0, 0), (-1, -1): ('se', -1, -1),
+    (1, -1): ('sw', 0, 0), (-1, 1): ('sw', -1, 1),
+}
+# Уровень 2: связи четырех дочерних ячеек блока (0 - левая верхняя, 1 - правая верхняя,
+# 2 - левая нижняя, 3 - правая нижняя) - (i, j, массив пар уровня 1, дочерняя ячейка с числом пар)
+CHILD_LINKS = ((0, 1, 'e1', 0), (2, 3, 'e1', 2), (0, 2, 's1', 0), (1, 3, 's1', 1),
+               (0, 3, 'se1', 0), (1, 2, 'sw1', 1))
+
+def resolve_cost_model(cost_model=None):
+    """Полная модель стоимости: значения по умолчанию ROUTE_COST_MODEL с переопределениями"""
+    cost_model = dict(cost_model or {})
+    unknown = sorted(set(cost_model) - set(ROUTE_COST_MODEL))
+    if unknown:
+        raise ValueError(f"Неизвестные параметры модели стоимости: {', '.join(unknown)}")
+    return {name: float(cost_model.get(name, default)) for name, default in ROUTE_COST_MODEL.items()}
+
+# --- Пирамида стоимостей ---
+
+class _NpyAppender:
+    """Массив заранее неизвестной длины: куски дописываются в файл, finish() дает memmap .npy"""
+    def __init__(self, work_dir, name, dtype):
+        self.path = Path(work_dir) / f"{name}.npy"
+        self.raw_path = Path(work_dir) / f"{name}.raw"
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.file = open(self.raw_path, 'wb')
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.size += values.size
+
+    def finish(self):
+        self.file.close()
+        out = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype, shape=(self.size,))
+        if self.size:
+            out[:] = np.memmap(self.raw_path, dtype=self.dtype, mode='r', shape=(self.size,))
+        self.raw_path.unlink()
+        return out
+
+def _index_dtype(count):
+    """Тип индексов узлов: int32, пока их меньше 2^31"""
+    return np.int32 if count < 2 ** 31 else np.int64
+
+def _connected_labels(size, a, b):
+    """Метки связных компонент графа на size узлах с ребрами (a, b): наименьший узел компоненты.
+
+    Корень большей метки подвешивается к меньшей, затем метки сжимаются
+    удвоением указателей; повторяется, пока концы всех ребер не совпадут.
+    """
+    labels = np.arange(size)
+    while a.size:
+        la, lb = labels[a], labels[b]
+        differ = la != lb
+        if not differ.any():
+            break
+        la, lb = la[differ], lb[differ]
+        np.minimum.at(labels, np.maximum(la, lb), np.minimum(la, lb))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return labels
+
+def _fill_level1(cost, arrays, memory_budget_mb):
+    """Уровень 1 (блоки 2x2) полосами: средняя стоимость и пары проходимых пикселей через границы.
+
+    Любые два пикселя блока 2x2 - соседи, поэтому проходимые пиксели
+    ячейки уровня 1 всегда связны. e1/s1 - число пар соседних проходимых
+    пикселей через правую/нижнюю границу ячейки, se1/sw1 - через угол к
+    соседу справа снизу/слева снизу.
+    """
+    height, width = cost.shape
+    h1, w1 = arrays['cost1'].shape
+    for yoff, ysize in iter_shape_windows(cost.shape, memory_budget_mb, block_height=2):
+        r0 = yoff // 2
+        h = min((ysize + 1) // 2, h1 - r0)
+        # Пиксели ячеек полосы и первая строка следующих; за краем растра - непроходимо
+        block = np.full((2 * h + 1, 2 * w1 + 1), np.inf, dtype=np.float32)
+        data = np.asarray(cost[yoff:min(height, yoff + 2 * h + 1)])
+        block[:data.shape[0], :width] = data
+        passable = np.isfinite(block)
+        values = np.where(passable, block, 0).astype(np.float64)
+        count = np.zeros((h, w1), dtype=np.int32)
+        total = np.zeros((h, w1))
+        for dy in (0, 1):
+            for dx in (0, 1):
+                count += passable[dy:2 * h:2, dx:2 * w1:2]
+                total += values[dy:2 * h:2, dx:2 * w1:2]
+        top, bottom, below = passable[0:2 * h:2], passable[1:2 * h:2], passable[2::2]
+        left, right, next_left = slice(0, 2 * w1, 2), slice(1, 2 * w1, 2), slice(2, None, 2)
+        rows = slice(r0, r0 + h)
+        # bool + bool в numpy - "или", поэтому сначала приводим к uint8
+        arrays['e1'][rows] = ((top[:, right].astype(np.uint8) + bottom[:, right])
+                              * (top[:, next_left].astype(np.uint8) + bottom[:, next_left]))
+        arrays['s1'][rows] = ((bottom[:, left].astype(np.uint8) + bottom[:, right])
+                              * (below[:, left].astype(np.uint8) + below[:, right]))
+        arrays['se1'][rows] = bottom[:, right] & below[:, next_left]
+        sw = np.zeros((h, w1), dtype=np.uint8)
+        sw[:, 1:] = bottom[:, left][:, 1:] & below[:, 1:2 * w1 - 1:2]
+        arrays['sw1'][rows] = sw
+        arrays['sum1'][rows] = total
+        arrays['count1'][rows] = count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            arrays['cost1'][rows] = np.where(count > 0, total / count, np.inf)
+
+def _build_level2(arrays, shape, create, work_dir, memory_budget_mb):
+    """Компоненты уровня 2: проходимые ячейки уровня 1 блока 2x2, связанные парами пикселей.
+
+    Узлы нумеруются по ячейкам построчно, внутри ячейки - по меньшей
+    дочерней ячейке компоненты. parent1 - узел уровня 2 ячейки уровня 1
+    (-1 для непроходимых), cell2 - ячейка узла, ptr2 - начало узлов ячейки.
+    """
+    h1, w1 = arrays['cost1'].shape
+    h2, w2 = shape
+    ptr = create('ptr2', (h2 * w2 + 1,), np.int64)
+    ptr[0] = 0
+    # Узлов уровня 2 не больше ячеек уровня 1
+    dtype = _index_dtype(h1 * w1)
+    parent1 = create('parent1', (h1, w1), dtype)
+    writers = {'cell2': _NpyAppender(work_dir, 'cell2', _index_dtype(h2 * w2)),
+               'sum2': _NpyAppender(work_dir, 'sum2', np.float64),
+               'count2': _NpyAppender(work_dir, 'count2', np.int64),
+               'cost2': _NpyAppender(work_dir, 'cost2', np.float32)}
+    offset = 0
+    # На ячейку уровня 1 уходит около 150 байт - втрое больше оценки iter_shape_windows
+    budget = max(1, memory_budget_mb // 4)
+    for yoff, ysize in iter_shape_windows((h1, w1), budget, block_height=2):
+        r0 = yoff // 2
+        h = (ysize + 1) // 2
+
+        def children(name):
+            # (h, w2, 4): дочерние ячейки каждой ячейки уровня 2 в порядке 0..3
+            block = np.zeros((2 * h, 2 * w2), dtype=arrays[name].dtype)
+            block[:ysize, :w1] = arrays[name][yoff:yoff + ysize]
+            return block.reshape(h, 2, w2, 2).transpose(0, 2, 1, 3).reshape(h, w2, 4)
+
+        count = children('count1')
+        passable = count > 0
+        crossings = {name: children(name) for name in ('e1', 's1', 'se1', 'sw1')}
+        labels = np.where(passable, np.arange(4), 4)
+        # На четырех узлах метки сходятся за три прохода по связям
+        for _ in range(3):
+            for i, j, name, anchor in CHILD_LINKS:
+                linked = crossings[name][..., anchor] > 0
+                low = np.minimum(labels[..., i], labels[..., j])
+                labels[..., i] = np.where(linked, low, labels[..., i])
+                labels[..., j] = np.where(linked, low, labels[..., j])
+        roots = passable & (labels == np.arange(4))
+        ids = offset + np.cumsum(roots.ravel()) - 1
+        first = np.arange(h * w2).reshape(h, w2, 1) * 4
+        node = ids[first + np.minimum(labels, 3)]
+        parent = np.where(passable, node, -1)
+        parent = parent.reshape(h, w2, 2, 2).transpose(0, 2, 1, 3).reshape(2 * h, 2 * w2)
+        parent1[yoff:yoff + ysize] = parent[:ysize, :w1]
+
+        rows, cols, _ = np.nonzero(roots)
+        size = rows.size
+        local = node[passable] - offset
+        sums = np.bincount(local, weights=children('sum1')[passable], minlength=size)
+        counts = np.bincount(local, weights=count[passable], minlength=size)
+        writers['cell2'].append((r0 + rows) * w2 + cols)
+        writers['sum2'].append(sums)
+        writers['count2'].append(counts)
+        writers['cost2'].append(sums / np.maximum(counts, 1))
+        ptr[r0 * w2 + 1:(r0 + h) * w2 + 1] = offset + np.cumsum(roots.sum(axis=2).ravel())
+        offset += size
+    arrays['ptr2'], arrays['parent1'] = ptr, parent1
+    for name, writer in writers.items():
+        arrays[name] = writer.finish()
+
+class CostPyramid:
+    """Пирамида стоимостей прохода по кубу слоев.
+
+    Уровень 0 - пиксели полного разрешения, уровень 1 - блоки 2x2 (их
+    проходимые пиксели всегда связны), узлы уровней 2 и выше - связные
+    компоненты проходимых пикселей блока 2^k x 2^k. Ребра соединяют только
+    ячейки и компоненты, между которыми есть пара соседних проходимых
+    пикселей, поэтому путь есть на грубом уровне тогда и только тогда,
+    когда он есть на полном разрешении. Стоимость узла - средняя стоимость
+    его пикселей; вес ребра растет, если проход между узлами узкий.
+    Последний уровень (coarse_level) не больше ROUTE_COARSE_SIZE по большей
+    стороне. Массивы - memmap из кэша (или из временного каталога без кэша).
+    """
+    def __init__(self, cube, cost_model=None, cache=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        if not isinstance(cube, LayerCube):
+            cube = LayerCube(cube)
+        if 'slope' not in cube.layers:
+            raise ValueError(f"В кубе слоев {cube.path} нет слоя уклона")
+        self.cube = cube
+        self.cost_model = resolve_cost_model(cost_model)
+        self.height, self.width = cube.height, cube.width
+        self.memory_budget_mb = memory_budget_mb
+        # Граф поиска больше этого числа узлов не строится
+        self.max_nodes = memory_budget_mb * 1024 * 1024 // ROUTE_BYTES_PER_NODE
+        gt = cube.geotransform
+        # Размер ячейки в единицах проекции (для квадратных пикселей - их сторона)
+        self.pixel_size = math.sqrt(abs(gt[1] * gt[5] - gt[2] * gt[4])) if gt else 1.0
+        stat = cube.path.stat()
+        self.key = cache_digest('route_cost', str(cube.path.resolve()), stat.st_size, stat.st_mtime_ns,
+                                    self.cost_model, ROUTE_COARSE_SIZE, ROUTE_CROSSING_WEIGHT, ROUTE_COST_VERSION)
+
+        self.shapes = [(self.height, self.width)]
+        while max(self.shapes[-1]) > ROUTE_COARSE_SIZE:
+            self.shapes.append(((self.shapes[-1][0] + 1) // 2, (self.shapes[-1][1] + 1) // 2))
+        self.coarse_level = len(self.shapes) - 1
+        self._work_dir = None
+        with pipeline_stage('route_pyramid'):
+            self.arrays = self._build_arrays(cache, memory_budget_mb)
+        self._graphs = {}
+        self._to_pixels = None
+        self._to_lonlat = None
+
+    def _array_names(self):
+        """Имена хранимых массивов пирамиды"""
+        top = self.coarse_level
+        names = ['cost0']
+        if top >= 1:
+            names += ['cost1', 'e1', 's1', 'se1', 'sw1']
+        if top >= 2:
+            names.append('parent1')
+            for level in range(2, top + 1):
+                names += [f'cell{level}', f'ptr{level}', f'cost{level}']
+                if level < top:
+                    names.append(f'parent{level}')
+            names += [f'src{top}', f'dst{top}', f'cross{top}']
+        return names
+
+    def _build_arrays(self, cache, memory_budget_mb):
+        """Массивы из кэша; если какого-то нет, пирамида строится заново через memmap во временном каталоге"""
+        names = self._array_names()
+        keys = {name: cache_digest('route_cost_array', self.key, name) for name in names}
+        if cache is not None:
+            arrays = {}
+            for name in names:
+                data = cache.load_array(keys[name], mmap=True)
+                if data is None:
+                    break
+                arrays[name] = data
+            else:
+                return arrays
+            work_dir = Path(tempfile.mkdtemp(prefix='route_', dir=cache.root))
+        else:
+            # Без кэша массивы живут, пока жив объект пирамиды
+            self._work_dir = tempfile.TemporaryDirectory(prefix='route_')
+            work_dir = Path(self._work_dir.name)
+
+        def create(name, shape, dtype):
+            return np.lib.format.open_memmap(work_dir / f"{name}.npy", mode='w+', dtype=dtype, shape=shape)
+
+        # Массивы нужны построению следующих уровней и ребер через self.arrays
+        self.arrays = arrays = {}
+        try:
+            self._build_levels(arrays, create, work_dir, memory_budget_mb)
+            # Суммы и числа пикселей нужны только для построения
+            for name in [name for name in arrays if name not in keys]:
+                del arrays[name]
+                (work_dir / f"{name}.npy").unlink()
+            if cache is not None:
+                arrays = {name: cache.adopt_array(keys[name], arrays[name]) for name in names}
+        finally:
+            if cache is not None:
+                for path in work_dir.glob('*'):
+                    path.unlink()
+                work_dir.rmdir()
+        return arrays
+
+    def _build_levels(self, arrays, create, work_dir, memory_budget_mb):
+        """Стоимость, пары пикселей через границы и компоненты всех уровней"""
+        top = self.coarse_level
+        arrays['cost0'] = create('cost0', self.shapes[0], np.float32)
+        self._fill_base_cost(arrays['cost0'], memory_budget_mb)
+        if top == 0:
+            return
+        for name, dtype in (('cost1', np.float32), ('e1', np.uint8), ('s1', np.uint8), ('se1', np.uint8),
+                            ('sw1', np.uint8), ('sum1', np.float64), ('count1', np.int32)):
+            arrays[name] = create(name, self.shapes[1], dtype)
+        _fill_level1(arrays['cost0'], arrays, memory_budget_mb)
+        if top == 1:
+            return
+        _build_level2(arrays, self.shapes[2], create, work_dir, memory_budget_mb)
+        for level in range(2, top):
+            self._build_next_level(level, create, work_dir, memory_budget_mb)
+        # Ребра грубого уровня нужны каждому поиску - считаем их один раз
+        for name, values in zip(('src', 'dst', 'cross'), self._component_edges(top)):
+            arrays[f'{name}{top}'] = create(f'{name}{top}', values.shape, values.dtype)
+            arrays[f'{name}{top}'][:] = values
+
+    def _build_next_level(self, level, create, work_dir, memory_budget_mb):
+        """Компоненты уровня level + 1 из компонент уровня level, связанных парами пикселей внутри блока"""
+        arrays = self.arrays
+        hk, wk = self.shapes[level]
+        hn, wn = self.shapes[level + 1]
+        cells, ptr_k = arrays[f'cell{level}'], arrays[f'ptr{level}']
+        ptr = create(f'ptr{level + 1}', (hn * wn + 1,), np.int64)
+        ptr[0] = 0
+        parent = create(f'parent{level}', (cells.size,), _index_dtype(cells.size))
+        writers = {name: _NpyAppender(work_dir, f'{name}{level + 1}', dtype)
+                   for name, dtype in (('cell', _index_dtype(hn * wn)), ('sum', np.float64),
+                                       ('count', np.int64), ('cost', np.float32))}
+        s = 1 << (level - 1)
+        offset = 0
+        # Кандидатов в пары на ячейку уровня level - около 6 * s, по ~100 байт на кандидата
+        budget = max(1, memory_budget_mb // (16 * s))
+        for yoff, ysize in iter_shape_windows((hk, wk), budget, block_height=2):
+            n0, n1 = int(ptr_k[yoff * wk]), int(ptr_k[(yoff + ysize) * wk])
+            cy, cx = np.divmod(np.arange(yoff * wk, (yoff + ysize) * wk), wk)
+            uy, ux, vy, vx, _ = self._border_crossings(level, cy, cx)
+            inside = (uy // (2 * s) == vy // (2 * s)) & (ux // (2 * s) == vx // (2 * s))
+            a = self._ancestors(level, uy[inside], ux[inside]) - n0
+            b = self._ancestors(level, vy[inside], vx[inside]) - n0
+            labels = _connected_labels(n1 - n0, a, b)
+            roots = np.flatnonzero(labels == np.arange(n1 - n0))
+            root_cells = np.asarray(cells[n0 + roots], dtype=np.int64)
+            parent_cells = (root_cells // wk // 2) * wn + (root_cells % wk) // 2
+            order = np.lexsort((roots, parent_cells))
+            ids = np.empty(n1 - n0, dtype=np.int64)
+            ids[roots[order]] = offset + np.arange(roots.size)
+            node_parent = ids[labels]
+            parent[n0:n1] = node_parent
+            local = node_parent - offset
+            sums = np.bincount(local, weights=arrays[f'sum{level}'][n0:n1], minlength=roots.size)
+            counts = np.bincount(local, weights=arrays[f'count{level}'][n0:n1], minlength=roots.size)
+            writers['cell'].append(parent_cells[order])
+            writers['sum'].append(sums)
+            writers['count'].append(counts)
+            writers['cost'].append(sums / np.maximum(counts, 1))
+            r0, rows = yoff // 2, (ysize + 1) // 2
+            per_cell = np.bincount(parent_cells - r0 * wn, minlength=rows * wn)
+            ptr[r0 * wn + 1:(r0 + rows) * wn + 1] = offset + np.cumsum(per_cell)
+            offset += roots.size
+        arrays[f'ptr{level + 1}'], arrays[f'parent{level}'] = ptr, parent
+        for name, writer in writers.items():
+            arrays[f'{name}{level + 1}'] = writer.finish()
+
+    def _ancestors(self, level, ys, xs):
+        """Узлы уровня level >= 2, в которые входят ячейки (ys, xs) уровня 1"""
+        nodes = np.asarray(self.arrays['parent1'][ys, xs], dtype=np.int64)
+        for current in range(2, level):
+            nodes = np.asarray(self.arrays[f'parent{current}'][nodes], dtype=np.int64)
+        return nodes
+
+    def _border_crossings(self, level, cy, cx):
+        """Пары пикселей из ячеек (cy, cx) уровня level >= 2 в соседние справа, снизу и по диагоналям вниз.
+
+        Каждая пара соседних ячеек учитывается один раз - от верхней (в
+        строке - от левой). Возвращает (uy, ux, vy, vx, count): ячейки
+        уровня 1 по обе стороны границы и число пар пикселей между ними.
+        """
+        h1, w1 = self.shapes[1]
+        s = 1 << (level - 1)
+        k = np.arange(s)
+        cy = np.asarray(cy, dtype=np.int64)[:, None] * s
+        cx = np.asarray(cx, dtype=np.int64)[:, None] * s
+        # Ячейки уровня 1 на границах: последний столбец, последняя строка, первый столбец
+        last_col = np.broadcast_arrays(cy + k, cx + s - 1)
+        last_row = np.broadcast_arrays(cy + s - 1, cx + k)
+        first_col = np.broadcast_arrays(cy + k, cx)
+        sources = (
+            ('e1', 0, 1, [last_col]),
+            ('s1', 1, 0, [last_row]),
+            # Угловая ячейка последней строки уже есть в столбце
+            ('se1', 1, 1, [last_col, [a[:, :-1] for a in last_row]]),
+            ('sw1', 1, -1, [first_col, [a[:, 1:] for a in last_row]]),
+        )
+        parts = []
+        for name, dy, dx, groups in sources:
+            ys = np.concatenate([group[0].ravel() for group in groups])
+            xs = np.concatenate([group[1].ravel() for group in groups])
+            valid = (ys < h1) & (xs < w1) & (ys + dy < h1) & (xs + dx >= 0) & (xs + dx < w1)
+            ys, xs = ys[valid], xs[valid]
+            count = np.asarray(self.arrays[name][ys, xs])
+            linked = count > 0
+            ys, xs = ys[linked], xs[linked]
+            parts.append((ys, xs, ys + dy, xs + dx, count[linked].astype(np.int64)))
+        return tuple(np.concatenate(values) for values in zip(*parts))
+
+    def _component_edges(self, level, cells=None):
+        """Ребра (u, v, число пар пикселей) между компонентами уровня level >= 2 в ячейках cells.
+
+        cells - отсортированные плоские индексы ячеек (None - весь уровень);
+        каждая пара компонент встречается один раз.
+        """
+        hk, wk = self.shapes[level]
+        s = 1 << (level - 1)
+        size = int(self.arrays[f'cell{level}'].size)
+        all_cells = np.arange(hk * wk) if cells is None else cells
+        # Ячеек за проход: около 6 * s кандидатов на ячейку, по ~100 байт на кандидата
+        chunk = max(1, self.memory_budget_mb * 1024 * 1024 // (1024 * s))
+        parts = []
+        for start in range(0, all_cells.size, chunk):
+            cy, cx = np.divmod(all_cells[start:start + chunk], wk)
+            uy, ux, vy, vx, count = self._border_crossings(level, cy, cx)
+            if cells is not None:
+                target = (vy // s) * wk + vx // s
+                position = np.minimum(np.searchsorted(cells, target), cells.size - 1)
+                keep = cells[position] == target
+                uy, ux, vy, vx, count = uy[keep], ux[keep], vy[keep], vx[keep], count[keep]
+            # Пары пикселей одной пары компонент складываются
+            pair = self._ancestors(level, uy, ux) * size + self._ancestors(level, vy, vx)
+            pair, inverse = np.unique(pair, return_inverse=True)
+            parts.append((pair // size, pair % size, np.bincount(inverse, weights=count, minlength=pair.size)))
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return tuple(np.concatenate(values) for values in zip(*parts))
+
+    def _fill_base_cost(self, out, memory_budget_mb):
+        """Стоимость прохода полного разрешения полосами куба"""
+        model = self.cost_model
+        index = {name: i for i, name in enumerate(self.cube.layers)}
+        values = self.cube.values
+        windows = list(iter_shape_windows(out.shape, memory_budget_mb))
+
+        illumination_max = model['illumination_max']
+        if 'illumination' in index and illumination_max <= 0:
+            illumination_max = 0.0
+            for yoff, ysize in windows:
+                strip = np.asarray(values[yoff:yoff + ysize, :, index['illumination']])
+                if np.isfinite(strip).any():
+                    illumination_max = max(illumination_max, float(np.nanmax(strip)))
+
+        for yoff, ysize in windows:
+            strip = np.asarray(values[yoff:yoff + ysize])
+            slope = strip[..., index['slope']]
+            ratio = slope / model['max_slope']
+            cost = 1 + model['slope_weight'] * ratio * ratio
+            if 'shadows' in index:
+                cost += model['shadow_weight'] * (strip[..., index['shadows']] == 1)
+            if 'illumination' in index and illumination_max > 0:
+                # Без данных об освещенности считаем ячейку темной
+                lit = np.nan_to_num(np.clip(strip[..., index['illumination']] / illumination_max, 0, 1), nan=0.0)
+                cost += model['darkness_weight'] * (1 - lit)
+            # NaN в уклоне тоже непроходим
+            cost[~(slope <= model['max_slope'])] = np.inf
+            out[yoff:yoff + ysize] = cost
+
+    def level_size(self, level):
+        """Число узлов уровня: ячейки на уровнях 0 и 1, компоненты выше"""
+        if level <= 1:
+            return self.shapes[level][0] * self.shapes[level][1]
+        return int(self.arrays[f'cell{level}'].size)
+
+    def node(self, point, level):
+        """Узел уровня level, в который входит пиксель (x, y) полного разрешения (-1 у непроходимого)"""
+        x, y = int(math.floor(point[0])), int(math.floor(point[1]))
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise ValueError(f"Точка ({point[0]}, {point[1]}) вне растра {self.width}x{self.height}")
+        if level <= 1:
+            return (y >> level) * self.shapes[level][1] + (x >> level)
+        if not self.passable(point):
+            return -1
+        return int(self._ancestors(level, np.array([y >> 1]), np.array([x >> 1]))[0])
+
+    def node_cells(self, nodes, level):
+        """Плоские индексы ячеек уровня level для узлов nodes"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if level <= 1:
+            return nodes
+        return np.asarray(self.arrays[f'cell{level}'][nodes], dtype=np.int64)
+
+    def passable(self, point):
+        """Проходим ли пиксель (x, y) полного разрешения"""
+        return math.isfinite(self.arrays['cost0'].reshape(-1)[self.node(point, 0)])
+
+    def _check_budget(self, level, size):
+        """Граф поиска на size узлов должен помещаться в бюджет памяти"""
+        if size > self.max_nodes:
+            raise ValueError(f"Граф поиска уровня {level}: {size} узлов больше бюджета {self.max_nodes} "
+                             f"(--memory-budget {self.memory_budget_mb} МБ)")
+
+    def graph(self, level, cells=None):
+        """Граф поиска уровня level: весь уровень (cells=None, строится один раз) или ячейки cells"""
+        if cells is None and level in self._graphs:
+            return self._graphs[level]
+        if level <= 1:
+            graph = self._grid_graph(level, cells)
+        else:
+            graph = self._component_graph(level, cells)
+        if cells is None:
+            self._graphs[level] = graph
+        return graph
+
+    def _grid_graph(self, level, cells):
+        """Граф уровней 0 и 1: проходимые ячейки, на уровне 1 - только переходы с парами пикселей"""
+        cost = self.arrays[f'cost{level}']
+        height, width = cost.shape
+        flat = np.arange(cost.size, dtype=np.int64) if cells is None else np.asarray(cells, dtype=np.int64)
+        self._check_budget(level, flat.size)
+        cell_size = self.pixel_size * (1 << level)
+        # Из memmap читаются только страницы нужных ячеек
+        node_cost = cost.reshape(-1)[flat].astype(np.float64)
+        passable = np.isfinite(node_cost)
+        flat, node_cost = flat[passable], node_cost[passable]
+        ys, xs = np.divmod(flat, width)
+        src, dst, weights = [], [], []
+        for dy, dx, step in NEIGHBORS:
+            if not flat.size:
+                break
+            vy, vx = ys + dy, xs + dx
+            target = vy * width + vx
+            position = np.minimum(np.searchsorted(flat, target), flat.size - 1)
+            found = (vx >= 0) & (vx < width) & (vy >= 0) & (vy < height) & (flat[position] == target)
+            factor = 1.0
+            if level == 1:
+                name, ay, ax = CROSSING_ANCHORS[(dy, dx)]
+                count = np.zeros(flat.size)
+                count[found] = self.arrays[f'{name}1'][ys[found] + ay, xs[found] + ax]
+                found &= count > 0
+                capacity = 1 if dy and dx else 4
+                factor = 1 + ROUTE_CROSSING_WEIGHT * (1 - np.minimum(1, count / capacity))
+            weight = (node_cost + node_cost[position]) * (0.5 * step * cell_size) * factor
+            src.append(np.flatnonzero(found))
+            dst.append(position[found])
+            weights.append(weight[found])
+        return SearchGraph(flat, xs, ys, node_cost, src, dst, weights, cell_size)
+
+    def _component_graph(self, level, cells):
+        """Граф уровня level >= 2: компоненты ячеек cells (None - весь уровень) и ребра между ними"""
+        ptr = self.arrays[f'ptr{level}']
+        if cells is None:
+            ids = np.arange(self.level_size(level), dtype=np.int64)
+        else:
+            starts = np.asarray(ptr[cells], dtype=np.int64)
+            lengths = np.asarray(ptr[cells + 1], dtype=np.int64) - starts
+            ids = (np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths))
+        self._check_budget(level, ids.size)
+        cell_size = self.pixel_size * (1 << level)
+        ys, xs = np.divmod(self.node_cells(ids, level), self.shapes[level][1])
+        node_cost = np.asarray(self.arrays[f'cost{level}'][ids], dtype=np.float64)
+        if cells is None and level == self.coarse_level:
+            u, v, count = (np.asarray(self.arrays[f'{name}{level}']) for name in ('src', 'dst', 'cross'))
+        else:
+            u, v, count = self._component_edges(level, cells)
+        a, b = np.searchsorted(ids, u), np.searchsorted(ids, v)
+        diagonal = (ys[a] != ys[b]) & (xs[a] != xs[b])
+        step = np.where(diagonal, SQRT2, 1.0)
+        # Пар пикселей через сторону ячейки 2^k - не больше 3 * 2^k - 2, через угол - одна
+        capacity = np.where(diagonal, 1, 3 * (1 << level) - 2)
+        factor = 1 + ROUTE_CROSSING_WEIGHT * (1 - np.minimum(1, count / capacity))
+        weight = (node_cost[a] + node_cost[b]) * (0.5 * cell_size) * step * factor
+        return SearchGraph(ids, xs, ys, node_cost, [a, b], [b, a], [weight, weight], cell_size)
+
+    def pixels_from_lonlat(self, lon, lat):
+        """Пиксельные координаты (x, y) для lon/lat через геопривязку куба"""
+        if self._to_pixels is None:
+            self._to_pixels = projected_from_lonlat_transform(self.cube.projection)
+        if self._to_pixels is None or not self.cube.geotransform:
+            raise ValueError(f"{self.cube.path} has no georeferencing")
+        px, py = lonlat_to_pixels(np.atleast_1d(lon), np.atleast_1d(lat), self.cube.geotransform, self._to_pixels)
+        return float(px[0]), float(py[0])
+
+    def lonlat(self, xs, ys):
+        """lon/lat центров пикселей или None без геопривязки"""
+        if self._to_lonlat is None:
+            self._to_lonlat = lonlat_from_projected_transform(self.cube.projection)
+        if self._to_lonlat is None or not self.cube.geotransform:
+            return None
+        return pixels_to_lonlat(np.asarray(xs) + 0.5, np.asarray(ys) + 0.5,
+                                   self.cube.geotransform, self._to_lonlat)
+
+# --- Поиск на куче ---
+
+class SearchGraph:
+    """Граф поиска на подмножестве узлов уровня пирамиды.
+
+    Узлы - отсортированные идентификаторы ids уровня (плоские индексы
+    ячеек или номера компонент), вершины графа - позиции в ids; xs, ys -
+    ячейки узлов для эвристики. Ребра (src, dst, weights - списки кусков
+    массивов позиций и весов) раскладываются по узлам и хранятся плоскими
+    списками: цикл поиска не тратит время на индексацию numpy.
+    """
+    def __init__(self, ids, xs, ys, cost, src, dst, weights, cell_size):
+        self.ids = ids
+        self.size = ids.size
+        self.xs, self.ys = xs, ys
+        self.cell_size = cell_size
+        finite = np.isfinite(cost)
+        self.min_cost = float(cost[finite].min()) if finite.any() else 1.0
+        src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+        dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate(weights) if weights else np.zeros(0)
+        order = np.argsort(src, kind='stable')
+        self.ptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=self.size))]).tolist()
+        self.neighbors = dst[order].tolist()
+        self.weights = weights[order].tolist()
+
+    def position(self, node):
+        """Позиция узла node в графе или None"""
+        position = int(np.searchsorted(self.ids, node))
+        if position < self.size and self.ids[position] == node:
+            return position
+        return None
+
+    def heuristic(self, position):
+        """Допустимая эвристика A* до позиции position: октильное расстояние при минимальной стоимости графа"""
+        ady = np.abs(self.ys - self.ys[position])
+        adx = np.abs(self.xs - self.xs[position])
+        octile = np.maximum(ady, adx) + (SQRT2 - 1) * np.minimum(ady, adx)
+        return (octile * (self.min_cost * self.cell_size)).tolist()
+
+    def search(self, sources, target=None):
+        """Дейкстра от нескольких источников (target=None) или A* до target (узлы уровня).
+
+        Возвращает (dist, prev, reached, expanded): расстояния и позиции
+        предшественников по позициям графа, позицию достигнутой цели (или
+        None) и число раскрытых узлов.
+        """
+        inf = math.inf
+        dist = [inf] * self.size
+        prev = [-1] * self.size
+        goal = self.position(target) if target is not None else None
+        if target is not None and goal is None:
+            return dist, prev, None, 0
+        h = self.heuristic(goal) if goal is not None else [0.0] * self.size
+        heap = []
+        for node in sources:
+            source = self.position(node)
+            if source is None or dist[source] == 0:
+                continue
+            dist[source] = 0.0
+            heap.append((h[source], 0.0, source))
+        heapq.heapify(heap)
+
+        ptr = self.ptr
+        neighbors = self.neighbors
+        weights = self.weights
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        expanded = 0
+        while heap:
+            _, d, u = heappop(heap)
+            if d > dist[u]:
+                continue
+            expanded += 1
+            if u == goal:
+                return dist, prev, u, expanded
+            begin, end = ptr[u], ptr[u + 1]
+            for v, w in zip(neighbors[begin:end], weights[begin:end]):
+                nd = d + w
+                if nd < dist[v]:
+                    dist[v] = nd
+                    prev[v] = u
+                    heappush(heap, (nd + h[v], nd, v))
+        return dist, prev, None, expanded
+
+    def trace(self, prev, position):
+        """Путь (узлы уровня) от источника до позиции position"""
+        path = [position]
+        while prev[path[-1]] >= 0:
+            path.append(prev[path[-1]])
+        path.reverse()
+        return self.ids[path]
+
+def _corridor_cells(path, coarse_width, shape, radius):
+    """Плоские индексы ячеек уровня shape в коридоре вокруг ячеек пути уровня вдвое грубее"""
+    height, width = shape
+    path = np.asarray(path, dtype=np.int64)
+    ys = 2 * (path // coarse_width)
+    xs = 2 * (path % coarse_width)
+    offsets = np.arange(-radius, 2 + radius)
+    rows = ys[:, None, None] + offsets[None, :, None]
+    cols = xs[:, None, None] + offsets[None, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return np.unique(rows[inside] * width + cols[inside])
+
+def _search_level(pyramid, level, start_node, goal_node, cells=None):
+    """A* на уровне пирамиды целиком (cells=None) или в ячейках cells: (путь, стоимость, статистика)"""
+    started = time.perf_counter()
+    graph = pyramid.graph(level, cells)
+    dist, prev, reached, expanded = graph.search([start_node], goal_node)
+    stats = {"level": level, "cells": graph.size, "expanded": expanded}
+    if reached is None:
+        path, total = None, None
+    else:
+        path, total = graph.trace(prev, reached), dist[reached]
+    stats["seconds"] = time.perf_counter() - started
+    return path, total, stats
+
+def _refine(pyramid, path, level, start, goal, stats):
+    """Уточнение пути уровня level (узлы) до полного разрешения поиском в коридорах.
+
+    Узел уровня связен внутри своей ячейки, а ребра есть только там, где
+    соседние проходимые пиксели действительно есть, поэтому узлы ячеек пути
+    уже содержат путь на более детальном уровне; коридор лишь дает место
+    для более дешевого пути и не расширяется.
+    """
+    total = None
+    for current in range(level - 1, -1, -1):
+        cells = _corridor_cells(pyramid.node_cells(path, current + 1), pyramid.shapes[current + 1][1],
+                                pyramid.shapes[current], ROUTE_CORRIDOR_RADIUS)
+        path, total, level_stats = _search_level(pyramid, current, pyramid.node(start, current),
+                                                 pyramid.node(goal, current), cells)
+        stats.append({**level_stats, "radius": ROUTE_CORRIDOR_RADIUS})
+        if path is None:
+            raise RuntimeError(f"Нет пути в коридоре уровня {current}: пирамида стоимостей {pyramid.key} "
+                               f"несогласована")
+    return path, total
+
+def _route_result(pyramid, path, total, stats, **extra):
+    """Описание маршрута: пиксели полного разрешения, стоимость, длина, lon/lat"""
+    ys, xs = np.divmod(np.asarray(path, dtype=np.int64), pyramid.width)
+    steps = np.hypot(np.diff(xs), np.diff(ys))
+    result = {
+        "pixels": np.column_stack((xs, ys)).tolist(),
+        "cost": float(total),
+        "length": float(steps.sum() * pyramid.pixel_size),
+        # Пиксели - в окне куба; окно - в пикселях исходного растра
+        "window": pyramid.cube.window,
+        "search": stats,
+        **extra,
+    }
+    lonlat = pyramid.lonlat(xs, ys)
+    if lonlat is not None:
+        lon, lat = lonlat
+        result["lonlat"] = [[None if np.isnan(a) else float(a), None if np.isnan(b) else float(b)]
+                            for a, b in zip(lon, lat)]
+    return result
+
+def find_route(pyramid, start, goal):
+    """Маршрут минимальной стоимости между пикселями start и goal (x, y); None, если пути нет.
+
+    Поиск идет от грубого уровня к полному разрешению; стоимость в
+    результате - стоимость найденного пути на полном разрешении.
+    Графы больше бюджета памяти пирамиды не строятся (ValueError).
+    """
+    for name, point in (('start', start), ('goal', goal)):
+        if not pyramid.passable(point):
+            raise ValueError(f"Точка {name} ({point[0]}, {point[1]}) непроходима")
+    level = pyramid.coarse_level
+    path, total, level_stats = _search_level(pyramid, level, pyramid.node(start, level), pyramid.node(goal, level))
+    stats = [{**level_stats, "radius": None}]
+    if path is None:
+        # Связность грубого уровня совпадает с полным разрешением - пути нет
+        return None
+    if level > 0:
+        path, total = _refine(pyramid, path, level, start, goal, stats)
+    return _route_result(pyramid, path, total, stats)
+
+# --- Поля стоимости-расстояния для постоянных объектов ---
+
+class CostField:
+    """Стоимость-расстояние до ближайшего из объектов sources на уровне level пирамиды.
+
+    dist - накопленная стоимость по узлам уровня (inf - недостижимо), prev -
+    узел-предшественник на пути к объекту (-1 у самих объектов).
+    """
+    def __init__(self, pyramid, level, sources, dist, prev):
+        self.pyramid = pyramid
+        self.level = level
+        self.sources = sources
+        self.dist = dist
+        self.prev = prev
+
+    def cost_at(self, point):
+        """Стоимость пути от пикселя (x, y) до ближайшего объекта (на уровне поля)"""
+        node = self.pyramid.node(point, self.level)
+        return float(self.dist[node]) if node >= 0 else math.inf
+
+def cost_distance_field(pyramid, sources, level=None, cache=None):
+    """Поле стоимости-расстояния от нескольких объектов (Дейкстра по уровню целиком).
+
+    Поле зависит только от пирамиды, уровня и объектов, поэтому для
+    постоянных объектов считается один раз и берется из кэша.
+    """
+    level = pyramid.coarse_level if level is None else level
+    sources = [(int(math.floor(x)), int(math.floor(y))) for x, y in sources]
+    nodes = [pyramid.node(point, level) for point in sources]
+    key = cache_digest('route_field', pyramid.key, level, sources)
+    dist_key = cache_digest('route_field_dist', key)
+    prev_key = cache_digest('route_field_prev', key)
+    if cache is not None:
+        dist = cache.load_array(dist_key, mmap=True)
+        prev = cache.load_array(prev_key, mmap=True) if dist is not None else None
+        if prev is not None:
+            return CostField(pyramid, level, sources, dist, prev)
+
+    height, width = pyramid.shapes[level]
+    with pipeline_stage('route_field'):
+        graph = pyramid.graph(level)
+        positions, previous, _, expanded = graph.search(nodes)
+    print(f"Поле стоимости: уровень {level} ({width}x{height}), объектов {len(sources)}, раскрыто {expanded}")
+    # Позиции графа переводятся в узлы уровня; непроходимых узлов в графе нет
+    size = pyramid.level_size(level)
+    dist = np.full(size, np.inf)
+    dist[graph.ids] = positions
+    previous = np.asarray(previous, dtype=np.int64)
+    prev = np.full(size, -1, dtype=np.int64)
+    linked = previous >= 0
+    prev[graph.ids[linked]] = graph.ids[previous[linked]]
+    if cache is not None:
+        cache.store_array(dist_key, dist)
+        cache.store_array(prev_key, prev)
+    return CostField(pyramid, level, sources, dist, prev)
+
+def route_to_nearest(field, start):
+    """Маршрут от пикселя start до ближайшего объекта поля; None, если он недостижим"""
+    pyramid = field.pyramid
+    if not pyramid.passable(start):
+        raise ValueError(f"Точка ({start[0]}, {start[1]}) непроходима")
+    node = pyramid.node(start, field.level)
+    if not math.isfinite(field.dist[node]):
+        return None
+    # Путь по предшественникам поля ведет от start к объекту
+    path = [node]
+    while field.prev[path[-1]] >= 0:
+        path.append(int(field.prev[path[-1]]))
+    facility = next(i for i, point in enumerate(field.sources) if pyramid.node(point, field.level) == path[-1])
+    goal = field.sources[facility]
+    stats = [{"level": field.level, "cells": 0, "expanded": 0, "seconds": 0.0, "radius": None}]
+    total = field.dist[node]
+    if field.level > 0:
+        path, total = _refine(pyramid, path, field.level, start, goal, stats)
+    return _route_result(pyramid, path, total, stats, facility=facility)
+
+def _parse_point(text):
+    """Точка 'x,y' (пиксели или lon,lat)"""
+    x, _, y = text.partition(',')
+    return float(x), float(y)
+
+def main():
+    parser = argparse.ArgumentParser(description='Маршруты минимальной стоимости по кубу слоев image_processor.')
+    parser.add_argument('cube', type=str, help='Куб слоев (<префикс>_cube.bin, см. image_processor --layer-cube).')
+    parser.add_argument('--start', type=str, default=None, help='Начальная точка x,y.')
+    parser.add_argument('--goal', type=str, default=None, help='Конечная точка x,y.')
+    parser.add_argument('--facilities', type=str, default=None,
+                        help='Постоянные объекты через ";" (x,y;x,y) или JSON-файл со списком точек: '
+                             'строится (или берется из кэша) поле стоимости, маршрут от --start '
+                             'ведет к ближайшему объекту.')
+    parser.add_argument('--field-level', type=int, default=None,
+                        help='Уровень пирамиды для поля объектов (по умолчанию самый грубый).')
+    parser.add_argument('--lonlat', action='store_true', help='Точки заданы как lon,lat.')
+    parser.add_argument('--cost-model', type=str, default=None,
+                        help='Параметры стоимости через запятую, например max_slope=20,shadow_weight=5 '
+                             f'(доступны: {", ".join(ROUTE_COST_MODEL)}).')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help='Бюджет памяти (МБ) на построение пирамиды и графы поиска.')
+    parser.add_argument('--cache', action='store_true', help='Хранить пирамиду и поля в кэше результатов.')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Каталог кэша (как у image_processor).')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, help='Лимит кэша в МБ.')
+    parser.add_argument('--output', type=str, default=None, help='JSON-файл для маршрута (иначе stdout).')
+    args = parser.parse_args()
+    if not args.facilities and not (args.start and args.goal):
+        parser.error('нужны --start и --goal либо --facilities')
+
+    try:
+        result = plan(args)
+    except (ValueError, OSError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.start:
+        if result is None:
+            print("Маршрут не найден: точки не связаны проходимыми ячейками")
+            sys.exit(1)
+        print(f"Маршрут: {len(result['pixels'])} пикселей, стоимость {result['cost']:.1f}, "
+              f"длина {result['length']:.1f}, {result['seconds'] * 1000:.0f} мс")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f)
+        else:
+            print(json.dumps(result))
+
+def plan(args):
+    """Маршрут (или только поле объектов) по аргументам командной строки"""
+    cost_model = None
+    if args.cost_model:
+        cost_model = {}
+        for item in args.cost_model.split(','):
+            if item.strip():
+                name, _, value = item.partition('=')
+                cost_model[name.strip()] = float(value)
+    cache = ResultCache(args.cache_dir or CACHE_DIR, args.cache_size) if args.cache else None
+
+    pyramid = CostPyramid(args.cube, cost_model=cost_model, cache=cache, memory_budget_mb=args.memory_budget)
+    to_pixels = (lambda point: pyramid.pixels_from_lonlat(*point)) if args.lonlat else (lambda point: point)
+
+    started = time.perf_counter()
+    result = None
+    if args.facilities:
+        if os.path.isfile(args.facilities):
+            with open(args.facilities) as f:
+                facilities = [tuple(point) for point in json.load(f)]
+        else:
+            facilities = [_parse_point(item) for item in args.facilities.split(';') if item.strip()]
+        field = cost_distance_field(pyramid, [to_pixels(point) for point in facilities],
+                                    level=args.field_level, cache=cache)
+        if args.start:
+            result = route_to_nearest(field, to_pixels(_parse_point(args.start)))
+    else:
+        result = find_route(pyramid, to_pixels(_parse_point(args.start)), to_pixels(_parse_point(args.goal)))
+    if cache is not None:
+        cache.evict()
+    if result is not None:
+        result["seconds"] = time.perf_counter() - started
+    return result
+
+if __name__ == '__main__':
+    main()
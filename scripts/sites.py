@@ -0,0 +1,261 @@
+"""Поиск площадок (<prefix>_sites.json): лучшие непересекающиеся окна по карте оценок всех положений окна."""
+import heapq
+import json
+import math
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from containers import DEFAULT_MEMORY_BUDGET_MB, iter_shape_windows
+
+# Версия формата <prefix>_sites.json; версия 3 - source_pixel_coords только с областью интереса
+SITES_VERSION = 3
+# Модель пригодности площадки: веса средней вероятности льда, доли освещенности
+# (средняя освещенность / illumination_max, 0 - максимум слоя), покрытия постоянной
+# тенью (тень == shadow_value, по умолчанию штраф) и запаса по уклону
+# (1 - максимальный уклон / slope_max). Окна с уклоном выше slope_max или долей
+# валидных пикселей ниже min_valid исключаются.
+SITE_MODEL = {
+    'ice_weight': 0.4,
+    'illumination_weight': 0.3,
+    'illumination_max': 0.0,
+    'shadow_weight': -0.1,
+    'shadow_value': 1.0,
+    'slope_weight': 0.2,
+    'slope_max': 15.0,
+    'min_valid': 0.9,
+}
+# Сторона квадратного окна площадки в пикселях
+DEFAULT_SITE_FOOTPRINT = 64
+# Сторона блока карты оценок для кучи выбора лучших окон
+SITE_BLOCK_SIZE = 256
+
+def resolve_site_model(site_model=None):
+    """Полная модель площадки: значения по умолчанию SITE_MODEL с переопределениями"""
+    site_model = dict(site_model or {})
+    unknown = sorted(set(site_model) - set(SITE_MODEL))
+    if unknown:
+        raise ValueError(f"Неизвестные параметры модели площадки: {', '.join(unknown)}")
+    model = {name: float(site_model.get(name, default)) for name, default in SITE_MODEL.items()}
+    if model['slope_max'] <= 0:
+        raise ValueError("slope_max модели площадки должен быть положительным")
+    return model
+
+def _box_sums(values, size):
+    """Суммы по всем окнам size x size (float64); форма уменьшается на size - 1.
+
+    Фильтр разделимый: накопленные суммы и разность со сдвигом size сначала
+    по строкам, затем по столбцам - то же, что интегральное изображение.
+    """
+    height, width = values.shape
+    sums = np.zeros((height, width + 1))
+    np.cumsum(values, axis=1, dtype=np.float64, out=sums[:, 1:])
+    rows = np.zeros((height + 1, width - size + 1))
+    np.subtract(sums[:, size:], sums[:, :-size], out=rows[1:])
+    np.cumsum(rows[1:], axis=0, out=rows[1:])
+    return rows[size:] - rows[:-size]
+
+def _sliding_max(values, size, axis):
+    """Максимум по окнам длины size вдоль оси 0 или 1: окно удваивается за log2(size) проходов"""
+    length = values.shape[axis]
+
+    def part(start, stop):
+        return (slice(start, stop),) if axis == 0 else (slice(None), slice(start, stop))
+
+    result = values.copy()
+    scratch = np.empty_like(result)
+    window = 1
+    while window * 2 <= size:
+        np.maximum(result[part(0, length - window)], result[part(window, length)],
+                   out=scratch[part(0, length - window)])
+        result, scratch = scratch, result
+        window *= 2
+    # Окно size - объединение двух перекрывающихся окон длины window
+    return np.maximum(result[part(0, length - size + 1)], result[part(size - window, length - window + 1)])
+
+def _layer_nanmax(data, memory_budget_mb):
+    """Максимум слоя без NaN полосами (None, если валидных значений нет)"""
+    result = -np.inf
+    for yoff, ysize in iter_shape_windows(data.shape, memory_budget_mb):
+        block = np.asarray(data[yoff:yoff + ysize])
+        if not np.all(np.isnan(block)):
+            result = max(result, float(np.nanmax(block)))
+    return result if np.isfinite(result) else None
+
+def site_score_map(layers_data, scores, footprint, model, illumination_max,
+                   memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Оценки всех положений окна footprint x footprint (по левому верхнему углу) в scores.
+
+    Полосы карты читают слои с перекрытием footprint - 1 строк. Суммы по окну
+    считаются по интегральным изображениям полосы, максимум уклона - скользящим
+    максимумом по строкам и столбцам. Исключенные окна получают -inf.
+    Возвращает максимумы блоков SITE_BLOCK_SIZE x SITE_BLOCK_SIZE карты.
+    """
+    size = footprint
+    area = size * size
+    out_height, out_width = scores.shape
+    block_edges_x = np.arange(0, out_width, SITE_BLOCK_SIZE)
+    block_maxima = np.empty((-(-out_height // SITE_BLOCK_SIZE), len(block_edges_x)), dtype=np.float32)
+    # Полоса не короче окна (перекрытие не больше половины чтения) и кратна блоку
+    strip_rows = -(-size // SITE_BLOCK_SIZE) * SITE_BLOCK_SIZE
+    # Временных массивов float64 на пиксель полосы примерно вдвое больше, чем в потоковом режиме
+    for yoff, ysize in iter_shape_windows(scores.shape, memory_budget_mb // 2, strip_rows):
+        rows = slice(yoff, yoff + ysize + size - 1)
+        ice, slope, shadows, illumination = (
+            np.asarray(layers_data[name][rows]) for name in ('ice', 'slope', 'shadows', 'illumination'))
+        invalid = np.isnan(ice)
+        for values in (slope, shadows, illumination):
+            invalid |= np.isnan(values)
+        # Средние по окну линейны, поэтому взвешенная сумма слоев сворачивается одним фильтром
+        weighted = ice * np.float32(model['ice_weight'])
+        weighted += illumination * np.float32(model['illumination_weight'] / illumination_max)
+        weighted += (shadows == model['shadow_value']) * np.float32(model['shadow_weight'])
+        weighted[invalid] = 0
+        count = _box_sums(~invalid, size)
+        # NaN уклона не участвует в максимуме
+        max_slope = _sliding_max(_sliding_max(np.where(np.isnan(slope), -np.inf, slope), size, 1), size, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score = _box_sums(weighted, size)
+            score /= count
+            score += model['slope_weight'] * (1 - max_slope / model['slope_max'])
+        excluded = (count < max(1.0, model['min_valid'] * area)) | ~(max_slope <= model['slope_max'])
+        score[excluded] = -np.inf
+        score = score.astype(np.float32)
+        scores[yoff:yoff + ysize] = score
+        block_rows = np.maximum.reduceat(score, np.arange(0, ysize, SITE_BLOCK_SIZE), axis=0)
+        block_maxima[yoff // SITE_BLOCK_SIZE:(yoff + ysize - 1) // SITE_BLOCK_SIZE + 1] = (
+            np.maximum.reduceat(block_rows, block_edges_x, axis=1))
+    return block_maxima
+
+def select_sites(scores, block_maxima, footprint, top_k):
+    """Жадный выбор top_k непересекающихся окон по убыванию оценки: список (y, x, оценка).
+
+    Максимум блока в куче - верхняя граница его оценок. Блок с вершины кучи
+    пересчитывается с учетом уже выбранных окон; если граница устарела, он
+    возвращается в кучу с новым значением, иначе его максимум - лучшее окно.
+    """
+    size = footprint
+    rows, cols = np.nonzero(block_maxima > -np.inf)
+    heap = [(-float(block_maxima[by, bx]), int(by), int(bx)) for by, bx in zip(rows, cols)]
+    heapq.heapify(heap)
+    selected = []
+    while heap and len(selected) < top_k:
+        bound, by, bx = heapq.heappop(heap)
+        y0 = by * SITE_BLOCK_SIZE
+        x0 = bx * SITE_BLOCK_SIZE
+        block = np.array(scores[y0:y0 + SITE_BLOCK_SIZE, x0:x0 + SITE_BLOCK_SIZE])
+        # Окна, пересекающие выбранные: |dy| < size и |dx| < size
+        for y, x, _ in selected:
+            ys, ye = max(0, y - size + 1 - y0), max(0, y + size - y0)
+            xs, xe = max(0, x - size + 1 - x0), max(0, x + size - x0)
+            block[ys:ye, xs:xe] = -np.inf
+        index = int(np.argmax(block))
+        value = float(block.flat[index])
+        if value == -np.inf:
+            continue
+        heapq.heappush(heap, (-value, by, bx))
+        if value < -bound:
+            continue
+        y, x = divmod(index, block.shape[1])
+        selected.append((y0 + y, x0 + x, value))
+    return selected
+
+def find_sites(layers_data, footprint=DEFAULT_SITE_FOOTPRINT, top_k=10, site_model=None,
+               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Лучшие top_k непересекающихся площадок footprint x footprint по модели площадки.
+
+    Карта оценок всех положений окна строится полосами в memory-mapped файле
+    во временном каталоге, выбор - кучей по блокам карты. Для каждой площадки
+    возвращаются пиксельное окно, оценка и составляющие критерия.
+    """
+    model = resolve_site_model(site_model)
+    missing = [name for name in ('ice', 'slope', 'shadows', 'illumination') if layers_data.get(name) is None]
+    if missing:
+        print(f"Нет слоев для поиска площадок: {', '.join(missing)}")
+        return None
+    height, width = layers_data['ice'].shape
+    if footprint > min(height, width):
+        print(f"Окно площадки {footprint} больше растра {width}x{height}.")
+        return []
+    illumination_max = model['illumination_max']
+    if illumination_max <= 0:
+        illumination_max = _layer_nanmax(layers_data['illumination'], memory_budget_mb) or 1.0
+
+    work_dir = Path(tempfile.mkdtemp(prefix='sites_'))
+    try:
+        scores = np.lib.format.open_memmap(work_dir / 'scores.npy', mode='w+', dtype=np.float32,
+                                           shape=(height - footprint + 1, width - footprint + 1))
+        block_maxima = site_score_map(layers_data, scores, footprint, model, illumination_max, memory_budget_mb)
+        selected = select_sites(scores, block_maxima, footprint, top_k)
+        scores = None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    sites = []
+    for y, x, score in selected:
+        window = {name: np.asarray(layers_data[name][y:y + footprint, x:x + footprint], dtype=np.float64)
+                  for name in ('ice', 'slope', 'shadows', 'illumination')}
+        valid = ~np.any([np.isnan(values) for values in window.values()], axis=0)
+        sites.append({
+            "x": x,
+            "y": y,
+            "score": score,
+            "ice_mean": float(window['ice'][valid].mean()),
+            "illumination_fraction": float(window['illumination'][valid].mean() / illumination_max),
+            "shadow_coverage": float(np.mean(window['shadows'][valid] == model['shadow_value'])),
+            "slope_max": float(np.nanmax(window['slope'])),
+            "valid_fraction": float(valid.mean()),
+        })
+    return sites
+
+def write_sites_json(path, sites, tile_processor, footprint, site_model=None):
+    """Сохранение площадок в JSON с географическими координатами углов и центра окна"""
+    geo = [None] * len(sites)
+    if sites:
+        px = np.array([[site["x"], site["x"] + footprint, site["x"] + footprint / 2] for site in sites])
+        py = np.array([[site["y"], site["y"] + footprint, site["y"] + footprint / 2] for site in sites])
+        lon, lat = tile_processor.pixels_to_lonlat(px, py)
+        if lon is not None:
+            geo = list(zip(lon.tolist(), lat.tolist()))
+    x0, y0 = tile_processor.window[:2]
+    entries = []
+    for rank, (site, coords) in enumerate(zip(sites, geo), start=1):
+        entry = {
+            "rank": rank,
+            "score": round(site["score"], 6),
+            "pixel_coords": {
+                "x_min": site["x"],
+                "y_min": site["y"],
+                "x_max": site["x"] + footprint,
+                "y_max": site["y"] + footprint,
+            },
+            "geo_coords": None,
+            "center": None,
+        }
+        if tile_processor.roi:
+            # Те же границы в пикселях исходного растра (только при области интереса)
+            entry["source_pixel_coords"] = {
+                "x_min": site["x"] + x0,
+                "y_min": site["y"] + y0,
+                "x_max": site["x"] + footprint + x0,
+                "y_max": site["y"] + footprint + y0,
+            }
+        # Если координаты не удалось получить, пропускаем гео-блок
+        if coords is not None and not any(map(math.isnan, coords[0] + coords[1])):
+            (lon_min, lon_max, lon_center), (lat_min, lat_max, lat_center) = coords
+            entry["geo_coords"] = {
+                "lon_min": round(lon_min, 6),
+                "lat_min": round(lat_min, 6),
+                "lon_max": round(lon_max, 6),
+                "lat_max": round(lat_max, 6),
+            }
+            entry["center"] = {"lon": round(lon_center, 6), "lat": round(lat_center, 6)}
+        for key in ("ice_mean", "illumination_fraction", "shadow_coverage", "slope_max", "valid_fraction"):
+            entry[key] = round(site[key], 6)
+        entries.append(entry)
+    with open(path, 'w') as f:
+        json.dump({"footprint": footprint, "window": tile_processor.window, "model": resolve_site_model(site_model),
+                   "sites": entries}, f, indent=2)
+    print(f"Площадки сохранены: {path} ({len(entries)})")
@@ -0,0 +1,59 @@
+"""Общее для тестов: скрипты каталогом выше (модули верхнего уровня) и растр в памяти вместо файла GDAL"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+class ArrayBand:
+    """Канал в памяти с интерфейсом чтения канала GDAL"""
+    def __init__(self, values):
+        self.values = values
+        self.YSize, self.XSize = values.shape
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None, buf_type=None, **kwargs):
+        xsize = self.XSize - xoff if xsize is None else xsize
+        ysize = self.YSize - yoff if ysize is None else ysize
+        return self.values[yoff:yoff + ysize, xoff:xoff + xsize].astype(np.float32)
+
+    def GetBlockSize(self):
+        return [self.XSize, 1]
+
+    def GetNoDataValue(self):
+        return None
+
+class ArrayDataset:
+    """Датасет в памяти (каналы, геопривязка) вместо файла GDAL"""
+    def __init__(self, bands, geotransform=(1000.0, 20.0, 0.0, 5000.0, 0.0, -20.0), projection=''):
+        self.bands = np.asarray(bands, dtype=np.float32)
+        self.RasterCount, self.RasterYSize, self.RasterXSize = self.bands.shape
+        self.geotransform = geotransform
+        self.projection = projection
+
+    def GetRasterBand(self, index):
+        return ArrayBand(self.bands[index - 1]) if 1 <= index <= self.RasterCount else None
+
+    def GetGeoTransform(self):
+        return self.geotransform
+
+    def GetProjection(self):
+        return self.projection
+
+@pytest.fixture
+def make_dataset():
+    """Конструктор растра в памяти: make_dataset(каналы, geotransform=..., projection=...)"""
+    return ArrayDataset
+
+@pytest.fixture
+def lunar_dataset():
+    """Случайный 6-канальный растр с раскладкой каналов image_processor"""
+    rng = np.random.default_rng(7)
+    bands = np.empty((6, 60, 80), dtype=np.float32)
+    bands[1] = rng.uniform(0, 10, (60, 80))  # освещенность
+    bands[3] = rng.integers(0, 2, (60, 80))  # тени
+    bands[4] = rng.uniform(-1, 30, (60, 80))  # уклон (отрицательный - нет данных)
+    bands[5] = rng.uniform(-2, 2, (60, 80))  # высоты, км
+    bands[[0, 2]] = 0  # каналы 1 и 3 конвейер не читает
+    return ArrayDataset(bands)
@@ -0,0 +1,118 @@
+"""area_index: прямоугольные запросы по интегральным изображениям и пирамидам min/max против прямого счета,
+ссылка на куб слоев"""
+import numpy as np
+import pytest
+
+import area_index
+import containers
+
+CUBE_MAGIC = b'TESTCUBE'
+
+def make_layers(seed=0):
+    rng = np.random.default_rng(seed)
+    # Большое смещение проверяет точность сумм относительно сдвига слоя
+    elevation = rng.normal(-1500, 40, (70, 90)).astype(np.float32)
+    elevation[rng.random(elevation.shape) < 0.1] = np.nan
+    slope = rng.uniform(0, 30, (70, 90)).astype(np.float32)
+    slope[20:30, 40:60] = np.nan
+    return {'elevation': elevation, 'slope': slope, 'ice': None}
+
+def write_cube(path, layers, cube_id='a'):
+    """Куб (H, W, слои) в контейнере, как у куба слоев; возвращает ссылку на него"""
+    present = {name: values for name, values in layers.items() if values is not None}
+    values = np.stack(list(present.values()), axis=-1).astype('<f4')
+    header = {"id": cube_id, "layers": list(present), "arrays": []}
+    encoded = containers.container_layout(CUBE_MAGIC, header, [(values.dtype, values.shape)])
+    with open(path, 'wb') as f:
+        f.write(CUBE_MAGIC)
+        f.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+        f.write(encoded)
+        f.write(b'\0' * (header["arrays"][0]["offset"] - f.tell()))
+        f.write(values.tobytes())
+    return containers.container_reference(path, CUBE_MAGIC, 'layer cube')
+
+def random_rects(rng, height, width, count):
+    x = np.sort(rng.integers(0, width + 1, (count, 2)), axis=1)
+    y = np.sort(rng.integers(0, height + 1, (count, 2)), axis=1)
+    keep = (x[:, 1] > x[:, 0]) & (y[:, 1] > y[:, 0])
+    return x[keep, 0], y[keep, 0], x[keep, 1], y[keep, 1]
+
+def expected_stats(values, x0, y0, x1, y1):
+    window = values[y0:y1, x0:x1].astype(np.float64)
+    valid = window[~np.isnan(window)]
+    if not valid.size:
+        return {"count": 0, "valid_fraction": 0.0}
+    return {"count": valid.size, "valid_fraction": valid.size / window.size, "mean": valid.mean(),
+            "std": valid.std(), "min": valid.min(), "max": valid.max()}
+
+@pytest.fixture(params=[False, True], ids=['values', 'cube'])
+def index(request, tmp_path):
+    layers = make_layers()
+    cube = write_cube(tmp_path / 'cube.bin', layers) if request.param else None
+    # Малый бюджет: интегральные изображения и уровни заполняются несколькими полосами
+    assert area_index.build_area_index(tmp_path / 'area.bin', layers, memory_budget_mb=1, cube=cube)
+    return area_index.AreaIndexReader(tmp_path / 'area.bin'), layers
+
+@pytest.mark.parametrize('direct_pixels', [0, area_index.AREA_QUERY_DIRECT_PIXELS])
+def test_rect_queries_match_brute_force(index, monkeypatch, direct_pixels):
+    # 0 - все прямоугольники через суммы и пирамиды, иначе - прямой счет малых прямоугольников
+    monkeypatch.setattr(area_index, 'AREA_QUERY_DIRECT_PIXELS', direct_pixels)
+    reader, layers = index
+    assert reader.layers == ['elevation', 'slope', 'ice'] and reader.window == [0, 0, 90, 70]
+    rng = np.random.default_rng(1)
+    for x0, y0, x1, y1 in zip(*random_rects(rng, 70, 90, 60)):
+        result = reader.query_pixel_rect(x0, y0, x1, y1)
+        assert result["layers"]["ice"] is None
+        for name in ('elevation', 'slope'):
+            stats = result["layers"][name]
+            expected = expected_stats(layers[name], x0, y0, x1, y1)
+            assert stats["count"] == expected["count"]
+            assert stats["valid_fraction"] == pytest.approx(expected["valid_fraction"])
+            if not expected["count"]:
+                assert stats["mean"] is None and stats["min"] is None
+                continue
+            assert stats["mean"] == pytest.approx(expected["mean"], abs=1e-3)
+            assert stats["std"] == pytest.approx(expected["std"], abs=1e-2)
+            assert stats["min"] == expected["min"] and stats["max"] == expected["max"]
+
+def test_rect_query_is_clipped_to_raster(index):
+    reader, layers = index
+    result = reader.query_pixel_rect(-10.5, 60.2, 25, 500)
+    assert (result["x_min"], result["y_min"], result["x_max"], result["y_max"]) == (0, 60, 25, 70)
+    assert result["layers"]["slope"]["max"] == np.nanmax(layers["slope"][60:70, 0:25])
+    empty = reader.query_pixel_rect(100, 0, 120, 10)
+    assert all(stats is None for stats in empty["layers"].values())
+
+def test_vectorized_rect_stats(index):
+    reader, layers = index
+    x0, y0, x1, y1 = random_rects(np.random.default_rng(2), 70, 90, 200)
+    stats = reader.rect_stats('slope', x0, y0, x1, y1)
+    for i in range(len(x0)):
+        expected = expected_stats(layers['slope'], x0[i], y0[i], x1[i], y1[i])
+        assert stats["count"][i] == expected["count"]
+        if expected["count"]:
+            assert stats["mean"][i] == pytest.approx(expected["mean"], abs=1e-4)
+
+@pytest.mark.parametrize('shape', [(1, 1), (5, 3), (33, 64), (64, 17)])
+def test_pyramid_extreme_matches_brute_force(shape):
+    rng = np.random.default_rng(shape[0] * shape[1])
+    values = rng.normal(size=shape).astype(np.float32)
+    values[rng.random(shape) < 0.2] = np.nan
+    levels = [values]
+    for level_shape in area_index._pyramid_shapes(shape)[1:]:
+        levels.append(np.empty(level_shape, dtype=np.float32))
+        area_index._reduce_blocks_2x2(levels[-2], levels[-1], np.fmin, 1)
+    for x0, y0, x1, y1 in zip(*random_rects(rng, shape[0], shape[1], 100)):
+        window = values[y0:y1, x0:x1]
+        expected = np.nan if np.all(np.isnan(window)) else np.nanmin(window)
+        np.testing.assert_equal(area_index._pyramid_extreme(levels, np.fmin, x0, y0, x1, y1), expected)
+
+def test_replaced_cube_is_rejected(tmp_path):
+    layers = make_layers()
+    cube = write_cube(tmp_path / 'cube.bin', layers)
+    assert area_index.build_area_index(tmp_path / 'area.bin', layers, cube=cube)
+    assert area_index.AreaIndexReader(tmp_path / 'area.bin').query_pixel_rect(0, 0, 5, 5)["layers"]["slope"]
+    # Куб того же размера, но записанный заново (другой заголовок), индексу не подходит
+    write_cube(tmp_path / 'cube.bin', make_layers(seed=1), cube_id='b')
+    with pytest.raises(ValueError, match='replaced'):
+        area_index.AreaIndexReader(tmp_path / 'area.bin').query_pixel_rect(0, 0, 5, 5)
@@ -0,0 +1,79 @@
+"""Пакетный режим: задания из каталога и манифестов, журнал, оценка памяти, возобновление"""
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import image_processor as ip
+
+def test_jobs_from_directory_and_manifests(tmp_path):
+    for name in ('b.tif', 'a.TIF', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'')
+    jobs = ip.load_batch_jobs(tmp_path, {'tile_std': True})
+    assert [job['output_prefix'] for job in jobs] == ['a', 'b']
+    assert all(job['options'] == {'tile_std': True} for job in jobs)
+
+    text = tmp_path / 'nightly.txt'
+    text.write_text('# ночной пакет\n\na.TIF\nsub/c.tif crater_c\n', encoding='utf-8')
+    jobs = ip.load_batch_jobs(text)
+    assert [(job['id'], job['output_prefix']) for job in jobs] == [(0, 'a'), (1, 'crater_c')]
+    assert jobs[1]['input_file'] == str(tmp_path / 'sub' / 'c.tif')
+
+    manifest = tmp_path / 'nightly.jsonl'
+    manifest.write_text(json.dumps({'input_file': '/data/m.tif', 'options': {'tile_std': False, 'sites': 3}})
+                        + '\n', encoding='utf-8')
+    jobs = ip.load_batch_jobs(manifest, {'tile_std': True, 'streaming': True})
+    assert jobs[0]['input_file'] == '/data/m.tif' and jobs[0]['output_prefix'] == 'm'
+    # Параметры манифеста дополняют и переопределяют общие
+    assert jobs[0]['options'] == {'tile_std': False, 'streaming': True, 'sites': 3}
+
+def test_journal_keeps_successful_complete_records(tmp_path):
+    journal = tmp_path / 'report.journal.jsonl'
+    assert ip._load_batch_journal(journal) == {}
+    journal.write_text('\n'.join([
+        json.dumps({'fingerprint': 'ok', 'success': True, 'elapsed': 1.0}),
+        json.dumps({'fingerprint': 'failed', 'success': False}),
+        '{"fingerprint": "torn", "succ',  # прерванная запись
+    ]), encoding='utf-8')
+    assert list(ip._load_batch_journal(journal)) == ['ok']
+
+def test_memory_estimate_follows_mode_and_roi(make_dataset):
+    ds = make_dataset(np.zeros((6, 1000, 1000), dtype=np.float32))
+    per_pixel = ds.RasterCount * 4 + ip.IN_MEMORY_BYTES_PER_PIXEL
+    in_memory = ip.estimate_job_memory_mb(ds, {})
+    assert in_memory == math.ceil(1000 * 1000 * per_pixel / 1024 / 1024) + ip.BATCH_BASE_MEMORY_MB
+    assert ip.estimate_job_memory_mb(ds, {'streaming': True, 'memory_budget_mb': 300}) == \
+        300 + ip.BATCH_BASE_MEMORY_MB
+    assert ip.estimate_job_memory_mb(ds, {'roi': [0, 0, 100, 100]}) == \
+        math.ceil(100 * 100 * per_pixel / 1024 / 1024) + ip.BATCH_BASE_MEMORY_MB
+    # Ошибочная область не мешает оценке: ее сообщит само задание
+    assert ip.estimate_job_memory_mb(ds, {'roi': [500, 500, 10, 10]}) == in_memory
+
+def test_resume_skips_finished_jobs(tmp_path, monkeypatch, lunar_dataset):
+    inputs = [tmp_path / f"{name}.tif" for name in ('done', 'also_done')]
+    for path in inputs:
+        path.write_bytes(path.name.encode())
+
+    def fake_open(path):
+        if not Path(path).exists():
+            raise RuntimeError(f"{path}: No such file or directory")
+        return lunar_dataset
+
+    monkeypatch.setattr(ip.gdal, 'Open', fake_open)
+    jobs = [{'id': i, 'input_file': str(path), 'output_prefix': path.stem, 'options': {}}
+            for i, path in enumerate(inputs + [tmp_path / 'missing.tif'])]
+    report = tmp_path / 'report.json'
+    with open(report.with_suffix('.journal.jsonl'), 'w', encoding='utf-8') as f:
+        for job in jobs[:2]:
+            f.write(json.dumps({'id': job['id'], 'output_prefix': job['output_prefix'], 'success': True,
+                                'fingerprint': ip._batch_fingerprint(job)}) + '\n')
+
+    assert not ip.run_batch(jobs, workers=1, memory_budget_mb=1024, report_path=report, resume=True)
+    with open(report, encoding='utf-8') as f:
+        result = json.load(f)
+    assert result['summary']['resumed'] == 2 and result['summary']['failed'] == 1
+    assert [record['id'] for record in result['files']] == [0, 1, 2]
+    assert 'RuntimeError' in result['files'][2]['error']
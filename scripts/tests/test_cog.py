@@ -0,0 +1,44 @@
+"""Экспорт COG: кодирование полос uint8 по масштабу и nodata, запись каналов и окна с GDAL"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import image_processor as ip
+
+def test_float_blocks_are_kept():
+    block = np.array([[1.5, np.nan], [-3.0, 1e6]])
+    encoded = ip._encode_cog_block('elevation', block, 'float32')
+    assert encoded.dtype == np.float32
+    np.testing.assert_array_equal(encoded, block.astype(np.float32))
+
+def test_byte_blocks_are_scaled_and_clipped():
+    block = np.array([[0.0, 0.5, 1.0, np.nan], [0.0021, -0.2, 1.5, 0.999]], dtype=np.float32)
+    encoded = ip._encode_cog_block('ice', block, 'uint8')
+    assert encoded.dtype == np.uint8
+    # Вероятность 1 - 250, выход за диапазон обрезается, не совпадая с nodata
+    np.testing.assert_array_equal(encoded, [[0, 125, 250, ip.COG_BYTE_NODATA], [1, 0, 254, 250]])
+    shadows = ip._encode_cog_block('shadows', np.array([0.0, 1.0, np.nan]), 'uint8')
+    np.testing.assert_array_equal(shadows, [0, 1, ip.COG_BYTE_NODATA])
+    # Значение восстанавливается масштабом канала с точностью до половины шага
+    valid = ~np.isnan(block) & (block >= 0) & (block <= 1)
+    np.testing.assert_allclose(encoded[valid] * ip.COG_BYTE_SCALES['ice'], block[valid],
+                               atol=ip.COG_BYTE_SCALES['ice'] / 2)
+
+def test_layers_cog_round_trip(tmp_path):
+    if ip.gdal.GetDriverByName('COG') is None:
+        pytest.skip('GDAL без драйвера COG')
+    rng = np.random.default_rng(5)
+    ice = rng.random((70, 90)).astype(np.float32)
+    ice[3, 4] = np.nan
+    shadows = rng.integers(0, 2, (70, 90)).astype(np.float32)
+    path = tmp_path / 'layers.tif'
+    assert ip.write_layers_cog(path, {'shadows': shadows, 'slope': None, 'ice': ice}, dtype='uint8',
+                               resampling='NEAREST', geotransform=(0.0, 20.0, 0.0, 0.0, 0.0, -20.0),
+                               memory_budget_mb=1, window=[10, 20, 100, 90])
+    ds = ip.gdal.Open(str(path))
+    assert ds.RasterCount == 2 and ds.GetMetadataItem('SOURCE_WINDOW') == '10,20,100,90'
+    band = ds.GetRasterBand(2)
+    assert band.GetDescription() == 'ice' and band.GetNoDataValue() == ip.COG_BYTE_NODATA
+    assert band.GetScale() == pytest.approx(ip.COG_BYTE_SCALES['ice'])
+    np.testing.assert_array_equal(band.ReadAsArray(), ip._encode_cog_block('ice', ice, 'uint8'))
+    np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), shadows.astype(np.uint8))
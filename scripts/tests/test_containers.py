@@ -0,0 +1,105 @@
+"""containers: полосы в пределах бюджета, раскладка массивов, выравнивание, ссылки на контейнеры и куб слоев"""
+import numpy as np
+import pytest
+
+import containers
+
+MAGIC = b'TESTCONT'
+
+@pytest.mark.parametrize('shape, budget, block_height', [((1000, 300), 1, 1), ((1000, 300), 1, 64),
+                                                         ((7, 5), 512, 1), ((10, 100000), 1, 1)])
+def test_shape_windows_cover_rows_within_budget(shape, budget, block_height):
+    windows = list(containers.iter_shape_windows(shape, budget, block_height))
+    starts = [yoff for yoff, _ in windows]
+    assert starts[0] == 0 and sum(ysize for _, ysize in windows) == shape[0]
+    assert all(yoff + ysize == next_yoff for (yoff, ysize), next_yoff in zip(windows, starts[1:]))
+    # Полосы кратны блоку; бюджет превышается только полосой в один блок
+    for _, ysize in windows[:-1]:
+        assert ysize % block_height == 0
+        assert (ysize == block_height or
+                ysize * shape[1] * containers.STREAMING_BYTES_PER_PIXEL <= budget * 1024 * 1024)
+
+def write_container(path, header, arrays):
+    encoded = containers.container_layout(MAGIC, header, [(values.dtype, values.shape) for values in arrays])
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+        f.write(encoded)
+        for entry, values in zip(header["arrays"], arrays):
+            f.write(b'\0' * (entry["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(values).tobytes())
+
+def test_arrays_round_trip_aligned(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = [rng.random((3, 5)).astype('<f4'), np.arange(7, dtype='<u4'), rng.random((2, 2, 3)).astype('<f8')]
+    write_container(tmp_path / 'c.bin', {"name": "x" * 200, "arrays": []}, arrays)
+    header, mmap = containers.open_container(tmp_path / 'c.bin', MAGIC, 'test container')
+    assert header["name"] == "x" * 200 and len(header["arrays"]) == 3
+    for entry, values in zip(header["arrays"], arrays):
+        assert entry["offset"] % containers.CONTAINER_ALIGNMENT == 0
+        read = containers.container_array(mmap, entry)
+        assert read.dtype == values.dtype
+        np.testing.assert_array_equal(read, values)
+    # Массивы не перекрываются
+    ends = [entry["offset"] + np.dtype(entry["dtype"]).itemsize * int(np.prod(entry["shape"]))
+            for entry in header["arrays"]]
+    assert all(end <= entry["offset"] for end, entry in zip(ends, header["arrays"][1:]))
+
+def test_container_rejects_foreign_file(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'NOTMAGIC' + bytes(64))
+    with pytest.raises(ValueError, match='test container'):
+        containers.open_container(path, MAGIC, 'test container')
+
+def test_reference_detects_replaced_container(tmp_path):
+    write_container(tmp_path / 'c.bin', {"id": 1, "arrays": []}, [np.zeros(4, dtype='<f4')])
+    reference = containers.container_reference(tmp_path / 'c.bin', MAGIC, 'test container')
+    assert reference["file"] == 'c.bin' and reference["magic"] == MAGIC.decode()
+    header, _ = containers.open_container_reference(tmp_path, reference, 'test container')
+    assert header["id"] == 1
+    write_container(tmp_path / 'c.bin', {"id": 2, "arrays": []}, [np.zeros(4, dtype='<f4')])
+    with pytest.raises(ValueError, match='replaced'):
+        containers.open_container_reference(tmp_path, reference, 'test container')
+
+def test_layer_cube_matches_layers(tmp_path):
+    rng = np.random.default_rng(3)
+    layers = {'elevation': rng.normal(size=(50, 40)), 'slope': None, 'ice': rng.random((50, 40))}
+    layers['ice'][5, 7] = np.nan
+    path = tmp_path / 'cube.bin'
+    assert containers.write_layer_cube(path, layers, window=[10, 20, 50, 70], memory_budget_mb=1)
+    cube = containers.LayerCube(path)
+    assert cube.layers == ['elevation', 'ice'] and (cube.width, cube.height) == (40, 50)
+    assert cube.window == [10, 20, 50, 70]
+    np.testing.assert_array_equal(cube.values[:, :, 0], layers['elevation'].astype(np.float32))
+    np.testing.assert_array_equal(cube.values[:, :, 1], layers['ice'].astype(np.float32))
+
+    px = rng.uniform(-5, 45, 300)
+    py = rng.uniform(-5, 55, 300)
+    values = cube.query_pixels(px, py)
+    for (x, y), row in zip(zip(px, py), values):
+        single = cube.query_pixel(x, y)
+        if not (0 <= x < 40 and 0 <= y < 50):
+            assert single is None and np.isnan(row).all()
+            continue
+        expected = [layers['elevation'][int(y), int(x)], layers['ice'][int(y), int(x)]]
+        np.testing.assert_array_equal(row, np.float32(expected))
+        np.testing.assert_array_equal(single, row)
+    # Без геопривязки запрос по lon/lat - ошибка, а не значения не того пикселя
+    with pytest.raises(ValueError, match='georeferencing'):
+        cube.query_lonlat([45.0], [-89.0])
+
+def test_layer_cube_rewrite_changes_reference(tmp_path):
+    layers = {'slope': np.ones((4, 6), dtype=np.float32)}
+    path = tmp_path / 'cube.bin'
+    containers.write_layer_cube(path, layers)
+    reference = containers.container_reference(path, containers.LAYER_CUBE_MAGIC, 'layer cube')
+    # Тот же куб, записанный повторно, не совпадает со ссылкой на прежний
+    containers.write_layer_cube(path, layers)
+    with pytest.raises(ValueError, match='replaced'):
+        containers.open_container_reference(tmp_path, reference, 'layer cube')
+
+def test_layer_cube_rejects_foreign_file(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'NOTACUBE' + bytes(64))
+    with pytest.raises(ValueError, match='layer cube'):
+        containers.LayerCube(path)
@@ -0,0 +1,87 @@
+"""georef: пакетный перевод пикселей в lon/lat и обратно против поточечного преобразования"""
+import numpy as np
+import pytest
+
+import georef
+
+GEOTRANSFORM = (1000.0, 20.0, 0.0, 5000.0, 0.0, -20.0)
+
+class ScaleTransform:
+    """Преобразование-заглушка с интерфейсом OSR: (x, y) -> (x / 100, y / 1000); x < 1100 - ошибка (inf)"""
+    def __init__(self, fail_calls=()):
+        self.calls = 0
+        self.fail_calls = set(fail_calls)
+
+    def TransformPoint(self, x, y):
+        if x < 1100:
+            return float('inf'), float('inf'), 0.0
+        return x / 100, y / 1000, 0.0
+
+    def TransformPoints(self, points):
+        self.calls += 1
+        if self.calls in self.fail_calls:
+            raise RuntimeError("transform failed")
+        return [self.TransformPoint(x, y) for x, y in points]
+
+def expected_lonlat(px, py):
+    x = GEOTRANSFORM[0] + px * GEOTRANSFORM[1]
+    y = GEOTRANSFORM[3] + py * GEOTRANSFORM[5]
+    valid = x >= 1100
+    return np.where(valid, x / 100, np.nan), np.where(valid, y / 1000, np.nan)
+
+def test_batches_match_single_points(monkeypatch):
+    monkeypatch.setattr(georef, 'TRANSFORM_CHUNK_SIZE', 7)
+    px, py = np.meshgrid(np.arange(0, 12, 1.5), np.arange(5))
+    transform = ScaleTransform()
+    lon, lat = georef.pixels_to_lonlat(px, py, GEOTRANSFORM, transform)
+    assert lon.shape == px.shape and transform.calls == -(-px.size // 7)
+    expected_lon, expected_lat = expected_lonlat(px, py)
+    np.testing.assert_allclose(lon, expected_lon)
+    np.testing.assert_allclose(lat, expected_lat)
+
+def test_failed_batch_gives_nan(monkeypatch):
+    monkeypatch.setattr(georef, 'TRANSFORM_CHUNK_SIZE', 4)
+    px = np.arange(10, 22, dtype=np.float64)
+    lon, lat = georef.pixels_to_lonlat(px, np.zeros_like(px), GEOTRANSFORM, ScaleTransform(fail_calls=[2]))
+    assert np.isnan(lon[4:8]).all() and np.isnan(lat[4:8]).all()
+    np.testing.assert_allclose(lon[[0, 8]], expected_lonlat(px[[0, 8]], 0)[0])
+
+class InverseScaleTransform(ScaleTransform):
+    """Обратное ScaleTransform: (lon, lat) -> (lon * 100, lat * 1000)"""
+    def TransformPoint(self, lon, lat):
+        return lon * 100, lat * 1000, 0.0
+
+def test_lonlat_to_pixels_inverts_pixels_to_lonlat(monkeypatch):
+    monkeypatch.setattr(georef, 'TRANSFORM_CHUNK_SIZE', 5)
+    px, py = np.meshgrid(np.arange(5, 17, 0.75), np.arange(0, 9, 1.5))
+    lon, lat = georef.pixels_to_lonlat(px, py, GEOTRANSFORM, ScaleTransform())
+    back_x, back_y = georef.lonlat_to_pixels(lon, lat, GEOTRANSFORM, InverseScaleTransform())
+    np.testing.assert_allclose(back_x, px)
+    np.testing.assert_allclose(back_y, py, atol=1e-9)
+
+def test_lonlat_rect_encloses_pixel_rect():
+    # Пиксели [6, 12) x [2, 5): lon = 10 + px / 5, lat = 5 - py / 50
+    rect = georef.lonlat_rect_to_pixels(11.2, 4.9, 12.4, 4.96, GEOTRANSFORM, InverseScaleTransform(), 61, 47)
+    assert rect == (6, 2, 12, 5)
+    # Прямоугольник, обрезанный по растру, и прямоугольник вне растра
+    assert georef.lonlat_rect_to_pixels(9.0, 4.9, 11.0, 5.5, GEOTRANSFORM, InverseScaleTransform(), 61, 47) == \
+        (0, 0, 5, 5)
+    assert georef.lonlat_rect_to_pixels(30.0, 4.0, 31.0, 4.5, GEOTRANSFORM, InverseScaleTransform(), 61, 47) is None
+
+def test_corner_lattice_matches_pixel_to_coords(make_dataset, monkeypatch):
+    pytest.importorskip('osgeo')
+    import image_processor as ip
+    monkeypatch.setattr(ip, '_CORNER_LATTICE_CACHE', {})
+    tile_processor = ip.TileProcessor(make_dataset(np.zeros((6, 47, 61)), GEOTRANSFORM), num_tiles=5)
+    tile_processor.coord_transform = ScaleTransform()
+    lon, lat = tile_processor.corner_lattice()
+    assert lon.shape == (6, 6) and tile_processor.coord_transform.calls == 1
+    for i, y in enumerate(tile_processor.y_edges):
+        for j, x in enumerate(tile_processor.x_edges):
+            point = tile_processor.pixel_to_coords(x, y)
+            if np.isfinite(point[0]):
+                assert (lon[i, j], lat[i, j]) == pytest.approx(point)
+            else:
+                assert np.isnan(lon[i, j]) and np.isnan(lat[i, j])
+    # Повторный запрос той же сетки берется из кэша
+    assert tile_processor.corner_lattice()[0] is lon and tile_processor.coord_transform.calls == 1
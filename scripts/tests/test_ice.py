@@ -0,0 +1,46 @@
+"""Вероятность льда: однопроходное ядро против прямой формулы по маскам, блоки, NaN и параметры модели"""
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import image_processor as ip
+
+def direct_ice_probability(dem, slope, shadows, model):
+    """Прямая формула: сумма весов выполненных условий, обрезка до [0, 1], NaN из входов"""
+    model = ip.resolve_ice_model(model)
+    prob = np.zeros(dem.shape)
+    prob += model['slope_weight'] * ((slope >= model['slope_min']) & (slope < model['slope_max']))
+    prob += model['shadow_weight'] * (shadows == model['shadow_value'])
+    prob += model['elevation_weight'] * ((dem > model['elevation_min']) & (dem < model['elevation_max']))
+    prob = np.clip(prob, 0, 1)
+    prob[np.isnan(dem) | np.isnan(slope) | np.isnan(shadows)] = np.nan
+    return prob
+
+@pytest.fixture
+def layers():
+    rng = np.random.default_rng(11)
+    dem = rng.uniform(-1000, 4000, (70, 90)).astype(np.float32)
+    slope = rng.uniform(0, 10, (70, 90)).astype(np.float32)
+    shadows = rng.integers(0, 2, (70, 90)).astype(np.float32)
+    for layer in (dem, slope, shadows):
+        layer[rng.random(layer.shape) < 0.02] = np.nan
+    return dem, slope, shadows
+
+@pytest.mark.parametrize('model', [None, {'slope_weight': 0.9, 'elevation_max': 500.0, 'shadow_value': 0.0}])
+def test_kernel_matches_direct_formula(layers, model):
+    result = ip.compute_ice_probability(*layers, ice_model=model)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, direct_ice_probability(*layers, model), rtol=1e-6, equal_nan=True)
+
+def test_chunks_and_out_match_single_pass(layers, monkeypatch):
+    whole = ip.compute_ice_probability(*layers)
+    monkeypatch.setattr(ip, 'ICE_CHUNK_PIXELS', 37)
+    out = np.full(layers[0].shape, -5, dtype=np.float32)
+    assert ip.compute_ice_probability(*layers, out=out) is out
+    np.testing.assert_array_equal(out, whole)
+    with pytest.raises(ValueError):
+        ip.compute_ice_probability(*layers, out=np.empty((90, 70), dtype=np.float32).T)
+
+def test_unknown_model_parameter_is_rejected(layers):
+    with pytest.raises(ValueError, match='slope_wieght'):
+        ip.compute_ice_probability(*layers, ice_model={'slope_wieght': 1.0})
@@ -0,0 +1,75 @@
+"""instrumentation: события прогресса обработчику текущего задания, метрики этапов и заданий"""
+import json
+import threading
+import tracemalloc
+
+import numpy as np
+
+import instrumentation
+
+def test_events_go_to_handler_of_current_context():
+    events = []
+    instrumentation.emit_progress({"event": "lost"})  # без обработчика событие никуда не передается
+    with instrumentation.progress_handler(events.append):
+        instrumentation.emit_progress({"event": "stage"})
+        assert list(instrumentation.progress_iter([1, 2, 3, 4], 'strips')) == [1, 2, 3, 4]
+    instrumentation.emit_progress({"event": "after"})
+    assert events[0] == {"event": "stage"}
+    assert [event["percent"] for event in events[1:]] == [25.0, 50.0, 75.0, 100.0]
+    assert all(event["stage"] == 'strips' for event in events[1:])
+
+def test_handlers_are_per_thread():
+    events = {name: [] for name in ('a', 'b')}
+    barrier = threading.Barrier(2)
+
+    def job(name):
+        with instrumentation.progress_handler(events[name].append):
+            barrier.wait()
+            instrumentation.emit_progress({"job": name})
+
+    threads = [threading.Thread(target=job, args=(name,)) for name in events]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events == {'a': [{"job": 'a'}], 'b': [{"job": 'b'}]}
+
+def test_console_progress_uses_tqdm(capsys):
+    assert list(instrumentation.progress_iter(range(3), 'strips', desc="Полосы")) == [0, 1, 2]
+    assert "Полосы" in capsys.readouterr().err
+
+def read_metrics(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def test_stage_metrics_belong_to_job(tmp_path):
+    settings = instrumentation.Instrumentation(metrics_path=tmp_path / 'metrics.jsonl')
+    with settings.metrics():
+        with instrumentation.job_metrics(7, 'site') as outcome:
+            with instrumentation.pipeline_stage('tiles'):
+                instrumentation.count_gdal_read(4096)
+            outcome["success"] = True
+        # Вне задания событие не привязывается к нему
+        instrumentation.write_metrics({"event": "note"})
+    instrumentation.write_metrics({"event": "lost"})  # поток метрик закрыт
+    stage, job, note = read_metrics(tmp_path / 'metrics.jsonl')
+    assert stage["event"] == 'stage' and stage["stage"] == 'tiles' and stage["gdal_bytes_read"] == 4096
+    assert (stage["id"], stage["output_prefix"]) == (7, 'site')
+    assert job["event"] == 'job' and job["success"] and job["error"] is None
+    assert job["gdal_bytes_read"] == 4096 and job["elapsed"] >= stage["elapsed"]
+    assert note == {"event": "note", "ts": note["ts"], "pid": note["pid"]}
+
+def test_nested_stage_keeps_outer_peak(tmp_path):
+    settings = instrumentation.Instrumentation(metrics_path=tmp_path / 'metrics.jsonl', trace_memory=True)
+    with settings.metrics(), settings.tracing():
+        with instrumentation.pipeline_stage('outer'):
+            buffer = np.ones(4 * 1024 * 1024 // 8)  # 4 МБ до вложенного этапа
+            del buffer
+            with instrumentation.pipeline_stage('inner'):
+                small = np.ones(1024)
+                del small
+    assert not tracemalloc.is_tracing()
+    inner, outer = read_metrics(tmp_path / 'metrics.jsonl')
+    assert (inner["stage"], outer["stage"]) == ('inner', 'outer')
+    # Сброс пика во вложенном этапе не теряет 4 МБ внешнего
+    assert inner["python_peak_mb"] < 1 and outer["python_peak_mb"] >= 4
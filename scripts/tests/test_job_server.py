@@ -0,0 +1,87 @@
+"""Резидентный сервер: протокол JSON-lines, события задания, отказ busy при полной очереди и точечные запросы"""
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import containers
+import image_processor as ip
+
+class Events:
+    """Сборщик ответов сервера (emit вызывается из потоков заданий)"""
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.items.append(event)
+
+    def of(self, name):
+        return [event for event in self.items if event["event"] == name]
+
+@pytest.fixture
+def server():
+    job_server = ip.JobServer(max_workers=1, max_pending=1)
+    yield job_server
+    job_server.executor.shutdown(wait=True)
+
+def test_protocol_messages(server):
+    events = Events()
+    assert server.handle_line('{"command": "ping"}', events) == (True, None)
+    assert server.handle_line('not json', events) == (True, None)
+    assert server.handle_line('[1, 2]', events) == (True, None)
+    assert server.handle_line('{"command": "resize", "id": 3}', events) == (True, None)
+    assert server.handle_line('{"command": "shutdown"}', events) == (False, None)
+    assert [event["event"] for event in events.items] == ['pong', 'error', 'error', 'error', 'shutdown']
+    assert events.items[3] == {"event": "error", "id": 3, "error": "Unknown command: resize"}
+
+def test_job_events_and_busy(server, monkeypatch):
+    release = threading.Event()
+
+    def run_job(job, progress, instrumentation=None):
+        progress({"event": "stage", "stage": "open", "status": "start"})
+        release.wait(5)
+        return {"event": "done", "id": job["id"], "success": True}
+
+    monkeypatch.setattr(ip, 'run_job', run_job)
+    events = Events()
+    _, future = server.handle_line(json.dumps({"id": 1, "input_file": "a.tif", "output_prefix": "a"}), events)
+    # Очередь на одно задание: второе отклоняется сразу, ping отвечает без ожидания
+    assert server.handle_line(json.dumps({"id": 2, "input_file": "b.tif", "output_prefix": "b"}), events) == (True, None)
+    server.handle_line('{"command": "ping"}', events)
+    assert events.of('busy') == [{"event": "busy", "id": 2, "max_pending": 1}] and events.of('pong')
+    release.set()
+    future.result(timeout=5)
+    assert events.of('accepted') == [{"event": "accepted", "id": 1}]
+    assert events.of('stage') == [{"event": "stage", "stage": "open", "status": "start", "id": 1}]
+    assert events.of('done') == [{"event": "done", "id": 1, "success": True}]
+    # После завершения задания место в очереди свободно
+    _, future = server.handle_line(json.dumps({"id": 3, "input_file": "c.tif", "output_prefix": "c"}), events)
+    future.result(timeout=5)
+    assert events.of('done')[-1]["id"] == 3
+
+def test_points_from_cube(server, tmp_path):
+    slope = np.arange(12, dtype=np.float32).reshape(3, 4)
+    slope[1, 2] = np.nan
+    path = tmp_path / 'a_cube.bin'
+    containers.write_layer_cube(path, {'slope': slope, 'ice': slope / 100})
+    reply = server.points({"id": 5, "cube": str(path), "pixels": [[0, 0], [2.5, 1.5], [3, 2], [9, 9]]})
+    assert reply == {"event": "points", "id": 5, "layers": ['slope', 'ice'],
+                     "values": [[0.0, 0.0], [None, None], [11.0, float(np.float32(0.11))], [None, None]]}
+    # Перезаписанный куб открывается заново
+    mtime = path.stat().st_mtime_ns
+    containers.write_layer_cube(path, {'slope': slope})
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+    assert server.points({"cube": str(path), "pixels": [[0, 0]]})["layers"] == ['slope']
+    assert server.points({"id": 6, "cube": str(tmp_path / 'none.bin'), "pixels": [[0, 0]]})["event"] == 'error'
+
+def test_run_job_rejects_bad_jobs(tmp_path):
+    assert ip.run_job({"id": 1})["error"] == "Задание должно содержать input_file и output_prefix"
+    result = ip.run_job({"id": 2, "input_file": str(tmp_path / 'a.tif'), "output_prefix": "a", "options": {"x": 1}})
+    assert not result["success"] and "x" in result["error"]
+    result = ip.run_job({"id": 3, "input_file": str(tmp_path / 'missing.tif'), "output_prefix": "a"})
+    assert not result["success"] and "missing.tif" in result["error"]
@@ -0,0 +1,71 @@
+"""Пирамида тайлов XYZ: число тайлов по уровням, пиксели тайлов и достройка недостающих"""
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('osgeo')
+import image_processor as ip
+
+TILE = 32
+
+@pytest.fixture
+def layer(tmp_path, monkeypatch):
+    monkeypatch.setattr(ip, 'TILES_DIR', tmp_path / 'tiles')
+    rng = np.random.default_rng(3)
+    data = rng.uniform(0, 30, (70, 100)).astype(np.float32)
+    data[5:9, 40:47] = np.nan
+    return data
+
+def read_tile(pyramid_dir, zoom, x, y):
+    with Image.open(pyramid_dir / str(zoom) / str(x) / f"{y}.png") as image:
+        return np.asarray(image)
+
+def padded(rgba, lut):
+    """Тайл с данными в левом верхнем углу и прозрачным дополнением"""
+    tile = np.empty((TILE, TILE, 4), dtype=np.uint8)
+    tile[:] = lut[ip.LUT_SIZE]
+    tile[:rgba.shape[0], :rgba.shape[1]] = rgba
+    return tile
+
+def test_levels_and_tile_pixels(layer):
+    pyramid_dir = ip.build_tile_pyramid(layer, 'slope', 'pyr', workers=2, tile_size=TILE, source_key='k1')
+    metadata = json.loads((pyramid_dir / 'pyramid.json').read_text())
+    assert metadata['max_zoom'] == 2 and metadata['complete']
+    # Уровни 100x70, 50x35, 25x18: тайлов 4x3, 2x2, 1x1
+    for zoom, (tiles_x, tiles_y) in {2: (4, 3), 1: (2, 2), 0: (1, 1)}.items():
+        columns = sorted(int(p.name) for p in (pyramid_dir / str(zoom)).iterdir())
+        assert columns == list(range(tiles_x))
+        assert all(len(list((pyramid_dir / str(zoom) / str(x)).iterdir())) == tiles_y for x in columns)
+
+    lut = ip.colormap_lut('viridis')
+    vmin, vmax = ip.data_range(layer)
+    # Краевой тайл исходного уровня: данные и прозрачное дополнение
+    np.testing.assert_array_equal(read_tile(pyramid_dir, 2, 3, 2),
+                                  padded(lut[ip.lut_indices(layer[64:70, 96:100], vmin, vmax)], lut))
+    # Уровень 1 - среднее блоков 2x2 исходного
+    level1 = ip.downsample_mean(layer, 2)
+    np.testing.assert_array_equal(read_tile(pyramid_dir, 1, 1, 0),
+                                  padded(lut[ip.lut_indices(level1[:32, 32:50], vmin, vmax)], lut))
+    assert ip.pyramid_complete('slope', 'pyr', 'k1') and not ip.pyramid_complete('slope', 'pyr', 'k2')
+
+def test_interrupted_pyramid_is_resumed(layer):
+    pyramid_dir = ip.build_tile_pyramid(layer, 'slope', 'pyr', tile_size=TILE, source_key='k1')
+    metadata_path = pyramid_dir / 'pyramid.json'
+    metadata = json.loads(metadata_path.read_text())
+    metadata_path.write_text(json.dumps({**metadata, "complete": False}))
+    missing = pyramid_dir / '2' / '1' / '2.png'
+    kept = pyramid_dir / '2' / '0' / '0.png'
+    missing.unlink()
+    kept_mtime = kept.stat().st_mtime_ns
+    ip.build_tile_pyramid(layer, 'slope', 'pyr', tile_size=TILE, source_key='k1')
+    assert missing.is_file() and kept.stat().st_mtime_ns == kept_mtime
+    assert json.loads(metadata_path.read_text())['complete']
+
+    # Другие данные - пирамида строится заново
+    kept.unlink()
+    ip.build_tile_pyramid(layer * 2, 'slope', 'pyr', tile_size=TILE, source_key='k2')
+    rebuilt = json.loads(metadata_path.read_text())
+    assert rebuilt['source_key'] == 'k2' and rebuilt['vmax'] == pytest.approx(2 * metadata['vmax'])
+    assert kept.is_file()
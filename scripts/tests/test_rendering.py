@@ -0,0 +1,45 @@
+"""Раскраска слоев через таблицу цветов против matplotlib и уменьшение блоками против nanmean"""
+import warnings
+
+import matplotlib
+import numpy as np
+import pytest
+from matplotlib.colors import Normalize
+
+pytest.importorskip('osgeo')
+import image_processor as ip
+
+@pytest.fixture
+def layer():
+    rng = np.random.default_rng(4)
+    data = rng.uniform(-3, 12, (53, 41)).astype(np.float32)
+    data[rng.random(data.shape) < 0.1] = np.nan
+    return data
+
+@pytest.mark.parametrize('cmap', ['terrain', 'viridis', 'binary', 'hot', 'Blues'])
+def test_lut_matches_matplotlib(layer, cmap):
+    vmin, vmax = ip.data_range(layer)
+    assert (vmin, vmax) == (np.nanmin(layer), np.nanmax(layer))
+    rgba = ip.render_layer_rgba(layer, cmap, vmin, vmax)
+    expected = matplotlib.colormaps[cmap](Normalize(vmin, vmax)(layer), bytes=True)
+    # Индексы LUT считаются во float32: на границах соседних цветов возможен сдвиг на один цвет
+    mismatch = np.any(rgba != expected, axis=-1)
+    assert mismatch.mean() < 0.01
+    assert (rgba[np.isnan(layer)] == ip.colormap_lut(cmap)[ip.LUT_SIZE]).all()
+
+def test_constant_and_empty_layers():
+    assert ip.data_range(np.full((4, 4), np.nan, dtype=np.float32)) == (None, None)
+    indices = ip.lut_indices(np.full((3, 3), 5, dtype=np.float32), 5.0, 5.0)
+    assert (indices == 0).all()
+
+@pytest.mark.parametrize('factor', [2, 3, 7])
+def test_downsample_mean_matches_nanmean(layer, factor):
+    result = ip.downsample_mean(layer, factor)
+    height, width = layer.shape
+    assert result.shape == (-(-height // factor), -(-width // factor))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for i in range(result.shape[0]):
+            for j in range(result.shape[1]):
+                block = layer[i * factor:(i + 1) * factor, j * factor:(j + 1) * factor]
+                np.testing.assert_allclose(result[i, j], np.nanmean(block), rtol=1e-5)
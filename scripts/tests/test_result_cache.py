@@ -0,0 +1,83 @@
+"""ResultCache: запись и восстановление слоев и файлов, предел записи, вытеснение, устаревшие хэши входов"""
+import json
+import os
+
+import numpy as np
+
+from result_cache import ResultCache, cache_digest
+
+def test_arrays_round_trip(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=16)
+    key = cache_digest('layer', 'slope', 1)
+    assert cache.load_array(key) is None
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    cache.store_array(key, data)
+    np.testing.assert_array_equal(cache.load_array(key), data)
+    loaded = cache.load_array(key, mmap=True)
+    assert isinstance(loaded, np.memmap) and not loaded.flags.writeable
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_adopt_moves_memmap_into_cache(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=16)
+    data = np.lib.format.open_memmap(tmp_path / 'layer.npy', mode='w+', dtype=np.float32, shape=(8, 8))
+    data[:] = 7
+    adopted = cache.adopt_array(cache_digest('ice'), data)
+    assert not (tmp_path / 'layer.npy').exists()
+    np.testing.assert_array_equal(adopted, np.full((8, 8), 7, dtype=np.float32))
+    np.testing.assert_array_equal(cache.load_array(cache_digest('ice')), adopted)
+
+def test_files_restore_as_copies(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=16)
+    source = tmp_path / 'out' / 'tiles.json'
+    source.parent.mkdir()
+    source.write_text('[]')
+    key = cache_digest('tiles_json', 1)
+    dest = tmp_path / 'restored' / 'tiles.json'
+    assert not cache.restore(key, dest)
+    cache.store_file(key, source)
+    assert cache.restore(key, dest)
+    assert dest.read_text() == '[]' and not os.path.samefile(source, dest)
+    # Изменение выходного файла не меняет запись кэша, а восстановление не трогает время файла
+    dest.write_text('changed')
+    os.utime(dest, (1000, 1000))
+    os.utime(cache._path(key, '.json'), (1000, 1000))
+    assert cache.restore(key, tmp_path / 'again.json')
+    assert (tmp_path / 'again.json').read_text() == '[]' and dest.stat().st_mtime == 1000
+    assert cache._path(key, '.json').stat().st_mtime > 1000
+    assert not list(tmp_path.rglob('*.tmp'))
+
+def test_entry_larger_than_share_is_not_stored(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=1)
+    key = cache_digest('big')
+    cache.store_array(key, np.zeros(100_000, dtype=np.float32))  # 400 КБ > 25% от 1 МБ
+    assert cache.load_array(key) is None
+    # Слишком большой memmap-слой остается на месте
+    big = np.lib.format.open_memmap(tmp_path / 'big.npy', mode='w+', dtype=np.float32, shape=(100_000,))
+    assert cache.adopt_array(key, big) is big and (tmp_path / 'big.npy').exists()
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=1)
+    keys = [cache_digest('layer', index) for index in range(5)]
+    for age, key in enumerate(keys):
+        cache.store_array(key, np.zeros(60_000, dtype=np.float32))  # 240 КБ, всего больше 1 МБ
+        path = cache._path(key, '.npy')
+        os.utime(path, (1000 + age, 1000 + age))
+    # Обращение обновляет время доступа: первая запись становится самой свежей
+    assert cache.load_array(keys[0]) is not None
+    cache.evict()
+    remaining = [key for key in keys if cache._path(key, '.npy').exists()]
+    assert remaining == [keys[0], keys[2], keys[3], keys[4]]
+
+def test_evict_prunes_stale_input_digests(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size_mb=16)
+    kept, removed, changed = (tmp_path / name for name in ('kept.tif', 'removed.tif', 'changed.tif'))
+    for path in (kept, removed, changed):
+        path.write_bytes(path.name.encode())
+    digests = {path.name: cache.input_digest(path) for path in (kept, removed, changed)}
+    removed.unlink()
+    changed.write_bytes(b'other content')
+    cache.evict()
+    with open(tmp_path / 'cache' / 'digests.json') as f:
+        memo = json.load(f)
+    assert list(memo.values()) == [digests['kept.tif']]
+    assert cache.input_digest(changed) != digests['changed.tif']
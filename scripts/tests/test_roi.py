@@ -0,0 +1,75 @@
+"""Область интереса: окно читает ровно свой срез, результаты совпадают с вырезанным растром, source_pixel_coords"""
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import containers
+import image_processor as ip
+import sites
+
+ROI = (13, 7, 61, 45)
+
+def test_resolve_roi_clips_and_rejects(lunar_dataset):
+    assert ip.resolve_roi(lunar_dataset, [-5, 10, 30, 500]) == (0, 10, 30, 60)
+    with pytest.raises(ValueError):
+        ip.resolve_roi(lunar_dataset, [80, 0, 90, 10])
+    with pytest.raises(ValueError):
+        ip.resolve_roi(lunar_dataset, [0, 0, 10, 10], [0, 0, 1, 1])
+    # Без проекции область в lon/lat недоступна
+    with pytest.raises(ValueError):
+        ip.resolve_roi(lunar_dataset, roi_lonlat=[0, -90, 10, -80])
+
+def test_window_reads_and_georeferencing(lunar_dataset):
+    window = ip.RasterWindow(lunar_dataset, *ROI)
+    x0, y0, x1, y1 = ROI
+    assert (window.RasterXSize, window.RasterYSize, window.RasterCount) == (x1 - x0, y1 - y0, 6)
+    assert ip.raster_window(window) == list(ROI) and ip.raster_window(lunar_dataset) == [0, 0, 80, 60]
+    band = window.GetRasterBand(5)
+    np.testing.assert_array_equal(band.ReadAsArray(), lunar_dataset.bands[4, y0:y1, x0:x1])
+    np.testing.assert_array_equal(band.ReadAsArray(3, 4, 10, 2), lunar_dataset.bands[4, y0 + 4:y0 + 6, x0 + 3:x0 + 13])
+    assert window.GetRasterBand(7) is None
+    # Пиксель (0, 0) окна - пиксель (x0, y0) исходного растра
+    gt = window.GetGeoTransform()
+    source = lunar_dataset.GetGeoTransform()
+    assert (gt[0], gt[3]) == (source[0] + x0 * source[1], source[3] + y0 * source[5])
+
+def test_window_layers_match_cropped_raster(tmp_path, lunar_dataset, make_dataset):
+    x0, y0, x1, y1 = ROI
+    window = ip.RasterWindow(lunar_dataset, *ROI)
+    cropped = make_dataset(lunar_dataset.bands[:, y0:y1, x0:x1])
+    for process in (ip.process_elevation_layer, ip.process_slope_layer, ip.process_shadow_layer,
+                    ip.process_illumination_layer):
+        result = process(window)
+        assert result is not None
+        np.testing.assert_array_equal(result, process(cropped))
+
+    # Куб по окну: те же значения, окно записано в заголовок
+    tile_processor = ip.TileProcessor(window, num_tiles=4)
+    layers = {'slope': ip.process_slope_layer(window)}
+    containers.write_layer_cube(tmp_path / 'cube.bin', layers, window=tile_processor.window)
+    cube = containers.LayerCube(tmp_path / 'cube.bin')
+    assert cube.window == list(ROI) and (cube.width, cube.height) == (x1 - x0, y1 - y0)
+    np.testing.assert_array_equal(cube.values[:, :, 0], layers['slope'])
+
+@pytest.mark.parametrize('roi', [None, ROI])
+def test_source_pixel_coords_only_with_roi(tmp_path, lunar_dataset, roi):
+    ds = lunar_dataset if roi is None else ip.RasterWindow(lunar_dataset, *roi)
+    x0, y0 = ip.raster_window(ds)[:2]
+    tile_processor = ip.TileProcessor(ds, num_tiles=4)
+    tiles = tile_processor.process_tiles({'slope': ip.process_slope_layer(ds)})
+    found = [{"x": 3, "y": 5, "score": 0.5, "ice_mean": 0.1, "illumination_fraction": 0.2,
+              "shadow_coverage": 0.0, "slope_max": 4.0, "valid_fraction": 1.0}]
+    sites.write_sites_json(tmp_path / 'sites.json', found, tile_processor, 8)
+    with open(tmp_path / 'sites.json', encoding='utf-8') as f:
+        written = json.load(f)
+    assert written["window"] == ip.raster_window(ds)
+    entries = tiles + written["sites"]
+    if roi is None:
+        assert not any('source_pixel_coords' in entry for entry in entries)
+        return
+    for entry in entries:
+        pixel = entry["pixel_coords"]
+        assert entry["source_pixel_coords"] == {"x_min": pixel["x_min"] + x0, "y_min": pixel["y_min"] + y0,
+                                                "x_max": pixel["x_max"] + x0, "y_max": pixel["y_max"] + y0}
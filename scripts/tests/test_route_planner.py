@@ -0,0 +1,92 @@
+"""route_planner: связность грубых уровней, тонкие стены, бюджет графов поиска"""
+import numpy as np
+import pytest
+
+import containers
+import route_planner as rp
+from result_cache import ResultCache
+
+WALL = 90.0
+
+@pytest.fixture(autouse=True)
+def small_coarse_size(monkeypatch):
+    # Небольшие растры тоже получают уровни компонент (2 и выше)
+    monkeypatch.setattr(rp, 'ROUTE_COARSE_SIZE', 16)
+
+def make_pyramid(tmp_path, slope, **kwargs):
+    path = tmp_path / 'cube.bin'
+    containers.write_layer_cube(str(path), {'slope': np.asarray(slope, dtype=np.float32)})
+    return rp.CostPyramid(path, **kwargs)
+
+def exact_cost(pyramid, start, goal):
+    """Стоимость поиска по всему полному разрешению или None"""
+    width = pyramid.width
+    dist, _, reached, _ = pyramid.graph(0).search([start[1] * width + start[0]], goal[1] * width + goal[0])
+    return None if reached is None else dist[reached]
+
+def wall_slope(gap_row=None):
+    slope = np.zeros((128, 128), dtype=np.float32)
+    slope[:, 64] = WALL
+    if gap_row is not None:
+        slope[gap_row, 64] = 0
+    return slope
+
+def test_thin_wall_is_crossed_only_at_gap(tmp_path):
+    pyramid = make_pyramid(tmp_path, wall_slope(gap_row=100))
+    assert pyramid.coarse_level == 3
+    route = rp.find_route(pyramid, (10, 10), (120, 10))
+    pixels = np.array(route["pixels"])
+    assert pixels[0].tolist() == [10, 10] and pixels[-1].tolist() == [120, 10]
+    assert pixels[pixels[:, 0] == 64, 1].tolist() == [100]
+    assert route["cost"] == pytest.approx(exact_cost(pyramid, (10, 10), (120, 10)), rel=0.05)
+    # Уточнение идет в коридорах, а не по уровням целиком
+    for stats in route["search"][1:]:
+        assert stats["cells"] < pyramid.level_size(stats["level"]) / 2
+
+def test_thin_wall_without_gap_blocks_every_level(tmp_path):
+    pyramid = make_pyramid(tmp_path, wall_slope())
+    assert rp.find_route(pyramid, (10, 10), (120, 10)) is None
+    for level in range(pyramid.coarse_level + 1):
+        start, goal = pyramid.node((10, 10), level), pyramid.node((120, 10), level)
+        assert pyramid.graph(level).search([start], goal)[2] is None
+
+@pytest.mark.parametrize('seed', range(4))
+def test_random_obstacles_match_full_resolution(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    slope = np.where(rng.random((45, 70)) < 0.4, WALL, rng.uniform(0, 20, (45, 70)))
+    pyramid = make_pyramid(tmp_path, slope)
+    free = np.argwhere(slope <= 25)[:, ::-1]
+    for _ in range(10):
+        start, goal = (tuple(int(v) for v in free[i]) for i in rng.integers(len(free), size=2))
+        exact = exact_cost(pyramid, start, goal)
+        route = rp.find_route(pyramid, start, goal)
+        # Грубые уровни связны ровно там, где связно полное разрешение
+        for level in range(1, pyramid.coarse_level + 1):
+            reached = pyramid.graph(level).search([pyramid.node(start, level)], pyramid.node(goal, level))[2]
+            assert (reached is None) == (exact is None)
+        if exact is None:
+            assert route is None
+        else:
+            assert exact - 1e-6 <= route["cost"] <= exact * 1.5
+            steps = np.abs(np.diff(np.array(route["pixels"]), axis=0))
+            assert steps.max() == 1 and (slope[tuple(np.array(route["pixels"])[:, ::-1].T)] <= 25).all()
+
+def test_graph_over_budget_fails_clearly(tmp_path):
+    pyramid = make_pyramid(tmp_path, np.zeros((128, 128)), memory_budget_mb=1)
+    with pytest.raises(ValueError, match='memory-budget'):
+        rp.find_route(pyramid, (0, 0), (127, 127))
+
+def test_facility_field_respects_walls(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', 64)
+    slope = wall_slope()
+    pyramid = make_pyramid(tmp_path, slope, cache=cache)
+    field = rp.cost_distance_field(pyramid, [(10, 10)], cache=cache)
+    assert rp.route_to_nearest(field, (120, 120)) is None
+    route = rp.route_to_nearest(field, (40, 120))
+    assert route["facility"] == 0 and route["pixels"][-1] == [10, 10]
+    # Пирамида и поле повторно берутся из кэша
+    cached = make_pyramid(tmp_path, slope, cache=cache)
+    for name, data in pyramid.arrays.items():
+        np.testing.assert_array_equal(np.asarray(cached.arrays[name]), np.asarray(data))
+    cached_field = rp.cost_distance_field(cached, [(10, 10)], cache=cache)
+    np.testing.assert_array_equal(np.asarray(cached_field.dist), np.asarray(field.dist))
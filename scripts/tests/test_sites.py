@@ -0,0 +1,76 @@
+"""Поиск площадок: top-K по карте оценок против перебора всех окон, оконные суммы и максимумы"""
+import numpy as np
+import pytest
+
+import sites
+
+FOOTPRINT = 5
+
+def make_layers(seed):
+    rng = np.random.default_rng(seed)
+    shape = (43, 57)
+    layers = {
+        'ice': rng.random(shape).astype(np.float32),
+        'slope': rng.uniform(0, 16, shape).astype(np.float32),
+        'shadows': rng.integers(0, 2, shape).astype(np.float32),
+        'illumination': rng.uniform(0, 8, shape).astype(np.float32),
+    }
+    layers['ice'][rng.random(shape) < 0.05] = np.nan
+    layers['slope'][10:14, 20:30] = np.nan
+    return layers
+
+def brute_force_sites(layers, model, top_k):
+    """Оценки всех окон по определению модели и жадный выбор непересекающихся по убыванию"""
+    size = FOOTPRINT
+    height, width = layers['ice'].shape
+    illumination_max = np.nanmax(layers['illumination'])
+    candidates = []
+    for y in range(height - size + 1):
+        for x in range(width - size + 1):
+            window = {name: values[y:y + size, x:x + size].astype(np.float64) for name, values in layers.items()}
+            valid = ~np.any([np.isnan(values) for values in window.values()], axis=0)
+            slope = window['slope'][~np.isnan(window['slope'])]
+            max_slope = slope.max() if slope.size else -np.inf
+            if valid.sum() < max(1.0, model['min_valid'] * size * size) or not max_slope <= model['slope_max']:
+                continue
+            score = (model['ice_weight'] * window['ice'][valid].mean()
+                     + model['illumination_weight'] * window['illumination'][valid].mean() / illumination_max
+                     + model['shadow_weight'] * np.mean(window['shadows'][valid] == model['shadow_value'])
+                     + model['slope_weight'] * (1 - max_slope / model['slope_max']))
+            candidates.append((score, y, x))
+    selected = []
+    for score, y, x in sorted(candidates, reverse=True):
+        if all(abs(y - sy) >= size or abs(x - sx) >= size for _, sy, sx in selected):
+            selected.append((score, y, x))
+        if len(selected) == top_k:
+            break
+    return selected
+
+@pytest.mark.parametrize('seed', range(3))
+def test_top_sites_match_brute_force(monkeypatch, seed):
+    # Малые блоки и бюджет: куча по многим блокам и карта оценок в несколько полос
+    monkeypatch.setattr(sites, 'SITE_BLOCK_SIZE', 8)
+    layers = make_layers(seed)
+    model = sites.resolve_site_model({'min_valid': 0.8})
+    found = sites.find_sites(layers, footprint=FOOTPRINT, top_k=12, site_model=model, memory_budget_mb=1)
+    expected = brute_force_sites(layers, model, 12)
+    assert [(site['y'], site['x']) for site in found] == [(y, x) for _, y, x in expected]
+    for site, (score, _, _) in zip(found, expected):
+        assert site['score'] == pytest.approx(score, abs=1e-5)
+
+def test_no_sites_when_every_window_is_excluded():
+    layers = make_layers(0)
+    layers['slope'][:] = 40
+    assert sites.find_sites(layers, footprint=FOOTPRINT, top_k=3) == []
+    assert sites.find_sites(layers, footprint=100, top_k=3) == []
+
+@pytest.mark.parametrize('size', [1, 2, 5, 8])
+def test_window_filters_match_brute_force(size):
+    values = np.random.default_rng(size).normal(size=(13, 11))
+    sums = sites._box_sums(values, size)
+    maxima = sites._sliding_max(sites._sliding_max(values, size, 1), size, 0)
+    assert sums.shape == maxima.shape == (14 - size, 12 - size)
+    for y in range(14 - size):
+        for x in range(12 - size):
+            assert sums[y, x] == pytest.approx(values[y:y + size, x:x + size].sum())
+            assert maxima[y, x] == values[y:y + size, x:x + size].max()
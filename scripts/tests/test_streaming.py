@@ -0,0 +1,62 @@
+"""Потоковый режим: слои и статистика как в памяти, PNG в исходном разрешении полосами"""
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('osgeo')
+import containers
+import image_processor as ip
+
+@pytest.fixture
+def output_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(ip, 'IMAGES_DIR', tmp_path / 'images')
+    monkeypatch.setattr(ip, 'LAYERS_DIR', tmp_path / 'layers')
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'layers').mkdir()
+    return tmp_path
+
+def test_png_writer_matches_pillow(tmp_path):
+    rng = np.random.default_rng(1)
+    rgba = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    ip.write_png_rows(tmp_path / 'rows.png', 53, 37, (rgba[y:y + 5] for y in range(0, 37, 5)))
+    with Image.open(tmp_path / 'rows.png') as image:
+        assert image.mode == 'RGBA'
+        np.testing.assert_array_equal(np.asarray(image), rgba)
+    with pytest.raises(ValueError):
+        ip.write_png_rows(tmp_path / 'short.png', 53, 37, [rgba[:10]])
+
+@pytest.mark.parametrize('downsample', [1, 3])
+def test_layer_png_is_rendered_in_strips(tmp_path, output_dirs, downsample):
+    rng = np.random.default_rng(2)
+    data = np.lib.format.open_memmap(tmp_path / 'layer.npy', mode='w+', dtype=np.float32, shape=(70, 45))
+    data[:] = rng.uniform(-5, 5, data.shape)
+    data[10:20, 5:9] = np.nan
+    ip.save_layer_png(data, 'slope', 'strips', 'viridis', downsample=downsample, chunk_pixels=45 * 4)
+    expected = ip.render_layer_rgba(np.asarray(data), 'viridis', *ip.data_range(data), downsample=downsample)
+    with Image.open(output_dirs / 'images' / 'strips_slope.png') as image:
+        np.testing.assert_array_equal(np.asarray(image), expected)
+    assert (output_dirs / 'layers' / 'strips_slope.png').is_file()
+
+def test_render_chunk_follows_budget():
+    assert ip.render_chunk_for_budget(4096) == ip.RENDER_CHUNK_PIXELS
+    assert ip.render_chunk_for_budget(1, workers=4) == 1024 * 1024 // (4 * ip.RENDER_BYTES_PER_PIXEL)
+
+def test_streaming_layers_and_stats_match_in_memory(tmp_path, lunar_dataset, monkeypatch):
+    # Полосы по 7 строк при бюджете 1 МБ
+    monkeypatch.setattr(containers, 'STREAMING_BYTES_PER_PIXEL', 1024 * 1024 // (80 * 7))
+    assert len(list(ip.iter_row_windows(lunar_dataset, 1))) == 9
+    tile_processor = ip.TileProcessor(lunar_dataset, num_tiles=4, include_edges=True)
+    layers_data, layers_stats = ip.process_layers_streaming(lunar_dataset, tile_processor, tmp_path, 1,
+                                                            with_std=True)
+    expected = {
+        'elevation': ip.process_elevation_layer(lunar_dataset),
+        'slope': ip.process_slope_layer(lunar_dataset),
+        'shadows': ip.process_shadow_layer(lunar_dataset),
+        'illumination': ip.process_illumination_layer(lunar_dataset),
+    }
+    expected['ice'] = ip.process_ice_layer(expected['elevation'], expected['slope'], expected['shadows'])
+    for name, data in expected.items():
+        np.testing.assert_array_equal(layers_data[name], data)
+        single_pass = tile_processor.compute_stats(data, with_std=True)
+        for key, values in single_pass.items():
+            np.testing.assert_allclose(layers_stats[name][key], values, rtol=1e-6)
@@ -0,0 +1,136 @@
+"""tile_stats: статистика тайлов против прямого счета по каждому тайлу и формат tiles.bin"""
+import json
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import tile_stats
+
+def brute_tile(data, x_edges, y_edges, i, j):
+    tile = data[y_edges[i]:y_edges[i + 1], x_edges[j]:x_edges[j + 1]].astype(np.float64)
+    return tile[~np.isnan(tile)]
+
+@pytest.fixture
+def layer():
+    rng = np.random.default_rng(5)
+    data = rng.normal(10, 3, (47, 61)).astype(np.float32)
+    data[rng.random(data.shape) < 0.2] = np.nan
+    data[:9, :12] = np.nan  # тайл без данных
+    return data
+
+def test_tile_edges():
+    assert tile_stats.tile_edges(47, 5).tolist() == [0, 9, 18, 27, 36, 45]
+    assert tile_stats.tile_edges(47, 5, include_edges=True).tolist() == [0, 9, 18, 27, 36, 47]
+
+@pytest.mark.parametrize('include_edges', [False, True])
+def test_reduce_matches_brute_force(layer, include_edges):
+    x_edges = tile_stats.tile_edges(61, 5, include_edges)
+    y_edges = tile_stats.tile_edges(47, 5, include_edges)
+    stats = tile_stats.reduce_tile_stats(layer, x_edges, y_edges, with_m2=True)
+    percentiles = tile_stats.compute_tile_percentiles(layer, x_edges, y_edges, [10, 50])
+    for i in range(5):
+        for j in range(5):
+            valid = brute_tile(layer, x_edges, y_edges, i, j)
+            assert stats['count'][i, j] == valid.size
+            if not valid.size:
+                assert np.isnan(stats['min'][i, j]) and np.isnan(percentiles[50][i, j])
+                continue
+            assert stats['sum'][i, j] == pytest.approx(valid.sum())
+            assert stats['m2'][i, j] == pytest.approx(np.square(valid - valid.mean()).sum())
+            assert stats['min'][i, j] == valid.min() and stats['max'][i, j] == valid.max()
+            assert percentiles[10][i, j] == pytest.approx(np.percentile(valid, 10), rel=1e-6)
+            assert percentiles[50][i, j] == pytest.approx(np.percentile(valid, 50), rel=1e-6)
+
+def test_accumulator_by_strips_matches_single_pass(layer):
+    grid = SimpleNamespace(x_edges=tile_stats.tile_edges(61, 4, True), y_edges=tile_stats.tile_edges(47, 4, True))
+    accumulator = tile_stats.TileAccumulator(grid, ['slope'], with_std=True)
+    for yoff in range(0, 47, 10):
+        accumulator.update('slope', layer[yoff:yoff + 10], yoff)
+    expected = tile_stats.reduce_tile_stats(layer, grid.x_edges, grid.y_edges, with_m2=True)
+    for key, values in expected.items():
+        np.testing.assert_allclose(accumulator.stats['slope'][key], values, rtol=1e-6)
+
+def test_summary_matches_brute_force(layer):
+    x_edges = tile_stats.tile_edges(61, 5)
+    y_edges = tile_stats.tile_edges(47, 5)
+    stats = tile_stats.reduce_tile_stats(layer, x_edges, y_edges, with_m2=True)
+    stats['percentiles'] = tile_stats.compute_tile_percentiles(layer, x_edges, y_edges, [50])
+    has_data, summary = tile_stats.summarize_tile_stats(stats)
+    assert sorted(summary) == ['max', 'mean', 'min', 'p50', 'std']
+    for i in range(5):
+        for j in range(5):
+            valid = brute_tile(layer, x_edges, y_edges, i, j)
+            assert has_data[i, j] == bool(valid.size)
+            if valid.size:
+                assert summary['mean'][i, j] == pytest.approx(valid.mean())
+                assert summary['std'][i, j] == pytest.approx(valid.std(), abs=1e-5)
+
+def test_std_keeps_precision_at_elevation_scale():
+    # Высоты порядка 10^6 с шумом 0.01: sumsq / count - mean^2 дает 0 или шум
+    rng = np.random.default_rng(6)
+    data = (1e6 + rng.normal(0, 0.01, (40, 40))).astype(np.float64)
+    grid = SimpleNamespace(x_edges=tile_stats.tile_edges(40, 2), y_edges=tile_stats.tile_edges(40, 2))
+    single = tile_stats.reduce_tile_stats(data, grid.x_edges, grid.y_edges, with_m2=True)
+    accumulator = tile_stats.TileAccumulator(grid, ['elevation'], with_std=True)
+    for yoff in range(0, 40, 7):
+        accumulator.update('elevation', data[yoff:yoff + 7], yoff)
+    for stats in (single, accumulator.stats['elevation']):
+        _, summary = tile_stats.summarize_tile_stats(stats)
+        for i in range(2):
+            for j in range(2):
+                tile = data[i * 20:(i + 1) * 20, j * 20:(j + 1) * 20]
+                assert summary['std'][i, j] == pytest.approx(tile.std(), rel=1e-6)
+
+def tile_grid(num_tiles=5, lattice=False):
+    """Сетка тайлов окна (10, 5)-(71, 52) с интерфейсом TileProcessor"""
+    x_edges = tile_stats.tile_edges(61, num_tiles)
+    y_edges = tile_stats.tile_edges(47, num_tiles)
+    corners = (None, None)
+    if lattice:
+        lon, lat = np.meshgrid(x_edges / 10.0, -80 - y_edges / 100.0)
+        corners = (lon, lat)
+    return SimpleNamespace(x_edges=x_edges, y_edges=y_edges, width=61, height=47, window=[10, 5, 71, 52],
+                           geotransform=(0.0, 1.0, 0.0, 0.0, 0.0, -1.0), projection='',
+                           corner_lattice=lambda: corners)
+
+def test_binary_round_trip_and_bbox_query(tmp_path, layer):
+    grid = tile_grid()
+    stats = {'slope': tile_stats.reduce_tile_stats(layer, grid.x_edges, grid.y_edges), 'ice': None}
+    tile_stats.write_tile_stats_binary(tmp_path / 'tiles.bin', grid, stats)
+    reader = tile_stats.TileStatsReader(tmp_path / 'tiles.bin')
+    assert reader.layers == ['slope', 'ice'] and reader.layer_stats('ice') is None
+    assert reader.window == [10, 5, 71, 52] and reader.corner_lattice() == (None, None)
+    _, summary = tile_stats.summarize_tile_stats(stats['slope'])
+    columns = reader.layer_stats('slope')
+    np.testing.assert_array_equal(columns['count'], stats['slope']['count'])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        np.testing.assert_array_equal(columns['mean'], summary['mean'].astype(np.float32))
+
+    result = reader.query_pixel_bbox(13, 20, 30, 21)
+    rows, cols = np.divmod(result['tile_id'], 5)
+    inside = [(i, j) for i in range(5) for j in range(5)
+              if reader.x_edges[j] < 30 and reader.x_edges[j + 1] > 13
+              and reader.y_edges[i] < 21 and reader.y_edges[i + 1] > 20]
+    assert sorted(zip(rows.tolist(), cols.tolist())) == inside
+    np.testing.assert_array_equal(result['layers']['slope']['count'], stats['slope']['count'][rows, cols])
+
+def test_lonlat_bbox_query_uses_lattice(tmp_path, layer):
+    grid = tile_grid(lattice=True)
+    stats = {'slope': tile_stats.reduce_tile_stats(layer, grid.x_edges, grid.y_edges)}
+    tile_stats.write_tile_stats_binary(tmp_path / 'tiles.bin', grid, stats)
+    reader = tile_stats.TileStatsReader(tmp_path / 'tiles.bin')
+    np.testing.assert_array_equal(reader.corner_lattice()[0], grid.corner_lattice()[0])
+    # lon = x / 10, lat = -80 - y / 100: столбцы тайлов 1-2, строки 0-1
+    result = reader.query_lonlat_bbox(1.5, -80.15, 3.0, -80.05)
+    rows, cols = np.divmod(result['tile_id'], 5)
+    assert sorted(set(cols.tolist())) == [1, 2] and sorted(set(rows.tolist())) == [0, 1]
+
+def test_tiles_json_is_streamed_like_json_dump(tmp_path):
+    tiles = [{"tile_id": i, "layers": {"ice": {"mean": i / 3, "std": None}}} for i in range(3)]
+    tile_stats.write_tiles_json(tmp_path / 'tiles.json', iter(tiles))
+    assert (tmp_path / 'tiles.json').read_text() == json.dumps(tiles, indent=2)
+    tile_stats.write_tiles_json(tmp_path / 'empty.json', iter([]))
+    assert json.loads((tmp_path / 'empty.json').read_text()) == []
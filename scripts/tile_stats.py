@@ -0,0 +1,304 @@
+"""Статистика по тайлам: свертка слоев по сетке тайлов и ее форматы (tiles.json, tiles.bin)."""
+import json
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from containers import container_array, container_layout, open_container
+
+# Бинарный формат статистики тайлов (<prefix>_tiles.bin); версия 3 - std по центрированному второму моменту,
+# версия 4 - source_pixel_coords в tiles.json только с областью интереса
+TILE_STATS_MAGIC = b'LTSTATS\0'
+TILE_STATS_VERSION = 4
+
+def _segment_reduce(ufunc, values, edges, axis, fill, dtype=None):
+    """ufunc.reduceat по сегментам [edges[k], edges[k+1]) вдоль оси; пустые сегменты = fill"""
+    sizes = np.diff(edges)
+    nonempty = np.flatnonzero(sizes > 0)
+    shape = list(values.shape)
+    shape[axis] = len(sizes)
+    out = np.full(shape, fill, dtype=dtype or values.dtype)
+    if len(nonempty):
+        reduced = ufunc.reduceat(values, edges[nonempty], axis=axis, dtype=dtype)
+        index = [slice(None)] * values.ndim
+        index[axis] = nonempty
+        out[tuple(index)] = reduced
+    return out
+
+def _centered_m2(data, x_edges, y_edges, mean):
+    """Суммы квадратов отклонений от среднего тайла (mean) по всем тайлам, по одной строке тайлов"""
+    m2 = np.zeros(mean.shape, dtype=np.float64)
+    column_mean = np.repeat(np.nan_to_num(mean), np.diff(x_edges), axis=1)
+    for i in range(len(y_edges) - 1):
+        if y_edges[i + 1] <= y_edges[i]:
+            continue
+        deviation = np.asarray(data[y_edges[i]:y_edges[i + 1], x_edges[0]:], dtype=np.float64) - column_mean[i]
+        # NaN (нет данных) не учитываются
+        column_m2 = np.nansum(np.square(deviation, out=deviation), axis=0)
+        m2[i] = _segment_reduce(np.add, column_m2, x_edges - x_edges[0], 0, 0)
+    return m2
+
+def reduce_tile_stats(data, x_edges, y_edges, with_m2=False):
+    """Суммарные статистики (count/sum/min/max[/m2]) всех тайлов за один проход.
+
+    Тайл (i, j) покрывает строки [y_edges[i], y_edges[i+1]) и столбцы
+    [x_edges[j], x_edges[j+1]); пиксели за последними границами не учитываются.
+    m2 - сумма квадратов отклонений от среднего тайла (второй проход по
+    данным): разность суммы квадратов и квадрата суммы на значениях порядка
+    высот теряет точность целиком.
+    """
+    data = data[:y_edges[-1], :x_edges[-1]]
+    valid = ~np.isnan(data)
+    filled = np.where(valid, data, 0)
+
+    # Сначала сворачиваем столбцы внутри каждой строки, затем строки
+    columns = {
+        'count': _segment_reduce(np.add, valid, x_edges, 1, 0, np.int64),
+        'sum': _segment_reduce(np.add, filled, x_edges, 1, 0, np.float64),
+        'min': _segment_reduce(np.fmin, data, x_edges, 1, np.nan),
+        'max': _segment_reduce(np.fmax, data, x_edges, 1, np.nan),
+    }
+    del valid, filled
+
+    stats = {
+        'count': _segment_reduce(np.add, columns['count'], y_edges, 0, 0),
+        'sum': _segment_reduce(np.add, columns['sum'], y_edges, 0, 0),
+        'min': _segment_reduce(np.fmin, columns['min'], y_edges, 0, np.nan),
+        'max': _segment_reduce(np.fmax, columns['max'], y_edges, 0, np.nan),
+    }
+    if with_m2:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = stats['sum'] / stats['count']
+        stats['m2'] = _centered_m2(data, x_edges, y_edges, mean)
+    return stats
+
+def compute_tile_percentiles(data, x_edges, y_edges, percentiles):
+    """Перцентили по тайлам: по одной строке тайлов за раз (работает и с memmap)"""
+    x_sizes = np.diff(x_edges)
+    result = {q: np.full((len(y_edges) - 1, len(x_sizes)), np.nan, dtype=np.float32) for q in percentiles}
+    for i in range(len(y_edges) - 1):
+        if y_edges[i + 1] <= y_edges[i]:
+            continue
+        band = np.asarray(data[y_edges[i]:y_edges[i + 1]])
+        # Тайлы одинаковой ширины обрабатываются одним вызовом
+        for width in np.unique(x_sizes[x_sizes > 0]):
+            cols = np.flatnonzero(x_sizes == width)
+            index = x_edges[cols][:, None] + np.arange(width)
+            values = band[:, index].transpose(1, 0, 2).reshape(len(cols), -1)
+            with warnings.catch_warnings():
+                # Тайлы без данных дают NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                computed = np.nanpercentile(values, list(percentiles), axis=1)
+            for q, row in zip(percentiles, computed):
+                result[q][i, cols] = row
+    return result
+
+def tile_edges(size, num_tiles, include_edges=False):
+    """Границы тайлов вдоль одной оси.
+
+    По умолчанию остаток size % num_tiles отбрасывается (как в исходной
+    сетке), с include_edges он присоединяется к последнему тайлу.
+    """
+    edges = np.arange(num_tiles + 1, dtype=np.int64) * (size // num_tiles)
+    if include_edges:
+        edges[-1] = size
+    return edges
+
+class TileAccumulator:
+    """Накопление статистики по тайлам при чтении растра полосами"""
+    def __init__(self, tile_processor, layer_names, with_std=False):
+        self.x_edges = tile_processor.x_edges
+        self.y_edges = tile_processor.y_edges
+        self.with_std = with_std
+        shape = (len(self.y_edges) - 1, len(self.x_edges) - 1)
+        self.stats = {}
+        for name in layer_names:
+            self.stats[name] = {
+                'count': np.zeros(shape, dtype=np.int64),
+                'sum': np.zeros(shape, dtype=np.float64),
+                # NaN - нейтральный элемент для np.fmin/np.fmax
+                'min': np.full(shape, np.nan, dtype=np.float32),
+                'max': np.full(shape, np.nan, dtype=np.float32),
+            }
+            if with_std:
+                self.stats[name]['m2'] = np.zeros(shape, dtype=np.float64)
+
+    def update(self, layer_name, block, y_offset):
+        """Добавление полосы данных слоя, начинающейся со строки y_offset"""
+        # Границы строк тайлов относительно полосы: тайлы вне полосы получают пустые сегменты
+        local_edges = np.clip(self.y_edges - y_offset, 0, block.shape[0])
+        if local_edges[-1] <= local_edges[0]:
+            return
+        part = reduce_tile_stats(block, self.x_edges, local_edges, with_m2=self.with_std)
+        stats = self.stats[layer_name]
+        if self.with_std:
+            # Объединение вторых моментов двух частей тайла (Chan et al.):
+            # m2 = m2_a + m2_b + (mean_b - mean_a)^2 * n_a * n_b / n
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = part['sum'] / part['count'] - stats['sum'] / stats['count']
+                correction = np.square(delta) * stats['count'] * part['count'] / (stats['count'] + part['count'])
+            # Пустая часть (NaN) поправки не дает
+            stats['m2'] += part['m2'] + np.nan_to_num(correction)
+        stats['count'] += part['count']
+        stats['sum'] += part['sum']
+        np.fmin(stats['min'], part['min'], out=stats['min'])
+        np.fmax(stats['max'], part['max'], out=stats['max'])
+
+def summarize_tile_stats(stats):
+    """Итоговые величины тайлов (mean/max/min[/std][/pXX]) и маска тайлов с данными"""
+    count = stats['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary = {
+            "mean": stats['sum'] / count,
+            "max": stats['max'],
+            "min": stats['min'],
+        }
+        if 'm2' in stats:
+            summary["std"] = np.sqrt(stats['m2'] / count)
+    for q, values in stats.get('percentiles', {}).items():
+        summary[f"p{q:g}"] = values
+    return count > 0, summary
+
+def write_tiles_json(path, tiles):
+    """Потоковая запись тайлов в JSON (тот же текст, что json.dump(list(tiles), f, indent=2))"""
+    with open(path, 'w') as f:
+        first = True
+        for tile in tiles:
+            f.write('[\n  ' if first else ',\n  ')
+            f.write(json.dumps(tile, indent=2).replace('\n', '\n  '))
+            first = False
+        f.write('[]' if first else '\n]')
+
+def write_tile_stats_binary(path, tile_processor, layers_stats):
+    """Колоночный бинарный формат статистики тайлов.
+
+    Структура файла: TILE_STATS_MAGIC, длина заголовка (uint32 LE), заголовок
+    JSON (сетка, границы тайлов, окно в исходном растре, геопривязка, смещения
+    массивов), затем
+    выровненные по CONTAINER_ALIGNMENT массивы: для каждого слоя count
+    (uint32) и по одному float32 массиву на каждую величину (mean, max, min,
+    ...), а также решетка углов тайлов lon/lat (float64), если она есть.
+    """
+    arrays = []
+    layers_header = {}
+    for layer_name, stats in layers_stats.items():
+        if stats is None:
+            layers_header[layer_name] = None
+            continue
+        has_data, summary = summarize_tile_stats(stats)
+        layers_header[layer_name] = {}
+        columns = {"count": stats['count'].astype('<u4')}
+        columns.update({key: np.where(has_data, values, np.nan).astype('<f4') for key, values in summary.items()})
+        for key, values in columns.items():
+            layers_header[layer_name][key] = len(arrays)
+            arrays.append(values)
+
+    lattice_header = None
+    lattice_lon, lattice_lat = tile_processor.corner_lattice()
+    if lattice_lon is not None:
+        lattice_header = {"lon": len(arrays), "lat": len(arrays) + 1}
+        arrays.extend([lattice_lon.astype('<f8'), lattice_lat.astype('<f8')])
+
+    header = {
+        "version": TILE_STATS_VERSION,
+        "grid": [len(tile_processor.y_edges) - 1, len(tile_processor.x_edges) - 1],
+        "width": tile_processor.width,
+        "height": tile_processor.height,
+        "window": tile_processor.window,
+        "x_edges": tile_processor.x_edges.tolist(),
+        "y_edges": tile_processor.y_edges.tolist(),
+        "geotransform": list(tile_processor.geotransform) if tile_processor.geotransform else None,
+        "projection": tile_processor.projection or None,
+        "layers": layers_header,
+        "lattice": lattice_header,
+        "arrays": [],
+    }
+    encoded = container_layout(TILE_STATS_MAGIC, header, [(values.dtype, values.shape) for values in arrays])
+
+    with open(path, 'wb') as f:
+        f.write(TILE_STATS_MAGIC)
+        f.write(np.uint32(len(encoded)).astype('<u4').tobytes())
+        f.write(encoded)
+        for entry, values in zip(header["arrays"], arrays):
+            f.write(b'\0' * (entry["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(values).tobytes())
+
+class TileStatsReader:
+    """Чтение бинарной статистики тайлов через memory-map без загрузки файла целиком"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header, self._mmap = open_container(self.path, TILE_STATS_MAGIC, "tile statistics")
+
+        self.grid_shape = tuple(self.header["grid"])
+        self.width = self.header["width"]
+        self.height = self.header["height"]
+        self.x_edges = np.asarray(self.header["x_edges"], dtype=np.int64)
+        self.y_edges = np.asarray(self.header["y_edges"], dtype=np.int64)
+        # Файлы до TILE_STATS_VERSION 2 строились только по всему растру
+        self.window = self.header.get("window") or [0, 0, self.width, self.height]
+        self.geotransform = self.header["geotransform"]
+        self.projection = self.header["projection"]
+
+    def _array(self, index):
+        return container_array(self._mmap, self.header["arrays"][index])
+
+    @property
+    def layers(self):
+        return list(self.header["layers"])
+
+    def layer_stats(self, layer_name):
+        """Полные массивы (ny, nx) статистики слоя: {'count': ..., 'mean': ..., ...} или None"""
+        columns = self.header["layers"].get(layer_name)
+        if columns is None:
+            return None
+        return {key: self._array(index) for key, index in columns.items()}
+
+    def corner_lattice(self):
+        """Решетка углов тайлов (lon, lat) формы (ny+1, nx+1) или (None, None)"""
+        lattice = self.header["lattice"]
+        if lattice is None:
+            return None, None
+        return self._array(lattice["lon"]), self._array(lattice["lat"])
+
+    def query_pixel_bbox(self, x_min, y_min, x_max, y_max, layers=None):
+        """Тайлы, пересекающие пиксельный прямоугольник [x_min, x_max) x [y_min, y_max)"""
+        col_start = max(0, int(np.searchsorted(self.x_edges, x_min, side='right')) - 1)
+        col_stop = min(self.grid_shape[1], int(np.searchsorted(self.x_edges, x_max, side='left')))
+        row_start = max(0, int(np.searchsorted(self.y_edges, y_min, side='right')) - 1)
+        row_stop = min(self.grid_shape[0], int(np.searchsorted(self.y_edges, y_max, side='left')))
+        rows = np.arange(row_start, max(row_start, row_stop))
+        cols = np.arange(col_start, max(col_start, col_stop))
+        mask = np.zeros(self.grid_shape, dtype=bool)
+        mask[np.ix_(rows, cols)] = True
+        return self._select(mask, layers)
+
+    def query_lonlat_bbox(self, lon_min, lat_min, lon_max, lat_max, layers=None):
+        """Тайлы, чей охват по четырем углам пересекает прямоугольник lon/lat"""
+        lon, lat = self.corner_lattice()
+        if lon is None:
+            raise ValueError(f"{self.path} has no geographic lattice")
+        corners_lon = np.stack([lon[:-1, :-1], lon[:-1, 1:], lon[1:, :-1], lon[1:, 1:]])
+        corners_lat = np.stack([lat[:-1, :-1], lat[:-1, 1:], lat[1:, :-1], lat[1:, 1:]])
+        mask = ((corners_lon.max(axis=0) >= lon_min) & (corners_lon.min(axis=0) <= lon_max) &
+                (corners_lat.max(axis=0) >= lat_min) & (corners_lat.min(axis=0) <= lat_max))
+        return self._select(mask, layers)
+
+    def _select(self, mask, layers=None):
+        """Выборка тайлов по маске: идентификаторы, пиксельные границы и статистика слоев"""
+        rows, cols = np.nonzero(mask)
+        result = {
+            "tile_id": rows * self.grid_shape[1] + cols,
+            "x_min": self.x_edges[cols],
+            "y_min": self.y_edges[rows],
+            "x_max": self.x_edges[cols + 1],
+            "y_max": self.y_edges[rows + 1],
+            "layers": {},
+        }
+        for layer_name in layers or self.layers:
+            stats = self.layer_stats(layer_name)
+            result["layers"][layer_name] = None if stats is None else {
+                key: values[rows, cols] for key, values in stats.items()
+            }
+        return result
+